@@ -0,0 +1,293 @@
+import io
+import json
+import argparse
+import contextlib
+import numpy as np
+from score import *
+from engine import score_pairs
+from eligibility import get_pair_eligibility
+from csr import from_counts, normalize_score_matrix
+
+'''
+ann.py
+------
+Approximate candidate generation, for populations too large to score every
+pair. Each user's answers to the similarity and activity questions are
+embedded as an int8 vector, weighted so the L1 distance between two vectors
+is the distance those questions contribute to score() (see score.py), in
+quarter points:
+
+    similarity questions, chill category    1/2 per answer point
+    activity questions                      1/4 per answer point
+    contact, hangout category               2/4 per answer point
+
+The vectors are indexed with a random projection forest: each tree splits
+the users in halves along a random direction, recursively, until the
+leaves hold at most leaf_size users. A user's neighbours are the nearest
+(by L1 distance) of the users sharing a leaf with them in any tree. Only
+neighbour pairs, in either direction, go through the filters and the exact
+score; everything else is never scored.
+
+Users who rate similarity as unimportant (or prefer people unlike them)
+are matched on other answers, so their best candidates are not always
+among their nearest neighbours. Run this module on a responses csv for a
+recall report of how many exact greedy matches the approximate pipeline
+recovers:
+
+    python ann.py --responses First_343_Responses_Manually_Parsed.csv --neighbours 100
+'''
+
+# Likert columns of the answer vectors, and the weight of each in quarter points
+VECTOR_COLUMNS = ([(idx, 2) for idx in SIMILARITY_QUESTION_IDX] +
+                  [(idx, 1) for idx in ACTIVITY_QUESTION_IDX] +
+                  [(CONTACT_IDX, 2)])
+
+# Weights of the category columns (see ResponseStore in store.py), in quarter points
+CHILL_WEIGHT = 2
+HANGOUT_WEIGHT = 2
+
+# Default nearest neighbours per user, trees in the forest and max users per leaf.
+# Recall is driven by the neighbour count, not the forest (see ANN_NEIGHBOURS in squad.py)
+N_NEIGHBOURS = 100
+N_TREES = 16
+LEAF_SIZE = 128
+
+# Users queried at a time, and pairs scored at a time; bounds the temporaries
+QUERY_BLOCK_SIZE = 256
+SCORE_CHUNK_SIZE = 2**18
+
+def get_answer_vectors(store):
+    '''
+    Embeds every user's similarity and activity answers (see module docstring).
+
+    Arguments:
+        store (ResponseStore): compiled responses
+
+    Returns:
+        vectors (np.ndarray): (N, D) int8 answer vectors
+    '''
+    columns = [store.likert[:, idx]*weight for idx, weight in VECTOR_COLUMNS]
+    columns.append(store.chill*CHILL_WEIGHT)
+    columns.append(store.hangout*HANGOUT_WEIGHT)
+    return np.stack(columns, axis=1).astype(np.int8)
+
+def build_tree(vectors, leaf_size, rng):
+    '''
+    Builds one random projection tree. All the nodes of a level are split
+    at once: users are sorted by (node, projection on the node's random
+    direction), and every node larger than leaf_size is cut in half.
+
+    Arguments:
+        vectors (np.ndarray): (N, D) answer vectors
+        leaf_size (int): max number of users per leaf
+        rng (np.random.Generator): source of the random directions
+
+    Returns:
+        leaves (np.ndarray): (N,) leaf of each user
+        members (np.ndarray): (n_leaves, leaf_size) int32 users of each leaf, padded with -1
+    '''
+    n, d = vectors.shape
+    vectors = vectors.astype(np.float32)
+    order = np.arange(n)
+    sizes = np.array([n], dtype=np.int64)
+    while sizes.max() > leaf_size:
+        nodes = np.repeat(np.arange(len(sizes)), sizes)
+        split = sizes > leaf_size
+        directions = rng.standard_normal((len(sizes), d)).astype(np.float32)
+        projections = np.einsum('ij,ij->i', vectors[order], directions[nodes])
+        projections[~split[nodes]] = 0
+        order = order[np.lexsort((projections, nodes))]
+        halves = np.stack([np.where(split, sizes//2, sizes), np.where(split, sizes - sizes//2, 0)], axis=1).ravel()
+        sizes = halves[halves > 0]
+
+    leaves = np.empty(n, dtype=np.int64)
+    leaves[order] = np.repeat(np.arange(len(sizes)), sizes)
+    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+    members = np.full((len(sizes), leaf_size), -1, dtype=np.int32)
+    members[leaves[order], np.arange(n) - np.repeat(starts, sizes)] = order
+    return leaves, members
+
+def build_forest(vectors, n_trees=N_TREES, leaf_size=LEAF_SIZE, seed=0):
+    '''
+    Builds a random projection forest over the answer vectors.
+
+    Arguments:
+        vectors (np.ndarray): (N, D) answer vectors
+        n_trees (int): number of trees
+        leaf_size (int): max number of users per leaf
+        seed (int): random seed of the projections
+
+    Returns:
+        forest (list): (leaves, members) of each tree (see build_tree)
+    '''
+    rng = np.random.default_rng(seed)
+    return [build_tree(vectors, leaf_size, rng) for _ in range(n_trees)]
+
+def get_neighbours_block(vectors, forest, user_ids, n_neighbours):
+    '''
+    Finds the nearest neighbours of a block of users among their leaf mates.
+
+    Arguments:
+        vectors (np.ndarray): (N, D) answer vectors
+        forest (list): random projection forest (see build_forest)
+        user_ids (np.ndarray): ids of the users to query
+        n_neighbours (int): number of neighbours per user
+
+    Returns:
+        neighbours (np.ndarray): (len(user_ids), n_neighbours) int32 ids, nearest
+            first, ties towards the lower id; -1 pads users with fewer leaf mates
+    '''
+    n = len(vectors)
+    candidates = np.concatenate([members[leaves[user_ids]] for leaves, members in forest], axis=1)
+    candidates[(candidates < 0) | (candidates == user_ids[:, None])] = n
+    candidates.sort(axis=1)
+    candidates[:, 1:][candidates[:, 1:] == candidates[:, :-1]] = n
+
+    # users share many leaf mates across trees; sort the duplicates to the end and drop them
+    candidates.sort(axis=1)
+    found = candidates < n
+    width = max(found.sum(axis=1).max(), 1)
+    candidates, found = candidates[:, :width], found[:, :width]
+    differences = vectors[np.where(found, candidates, 0)] - vectors[user_ids][:, None, :]
+    distances = np.abs(differences).sum(axis=2, dtype=np.int32)
+    distances[~found] = np.iinfo(np.int32).max
+    nearest = np.argsort(distances, axis=1, kind='stable')[:, :n_neighbours]
+    rows = np.arange(len(user_ids))[:, None]
+    neighbours = np.where(found[rows, nearest], candidates[rows, nearest], -1).astype(np.int32)
+    if neighbours.shape[1] < n_neighbours:
+        padding = np.full((len(user_ids), n_neighbours - neighbours.shape[1]), -1, dtype=np.int32)
+        neighbours = np.concatenate([neighbours, padding], axis=1)
+    return neighbours
+
+def get_neighbours(store, n_neighbours=N_NEIGHBOURS, n_trees=N_TREES, leaf_size=LEAF_SIZE, seed=0):
+    '''
+    Finds the approximate nearest neighbours of every user by answer vector.
+
+    Arguments:
+        store (ResponseStore): compiled responses
+        n_neighbours (int): number of neighbours per user
+        n_trees (int): number of trees in the forest
+        leaf_size (int): max number of users per leaf
+        seed (int): random seed of the forest
+
+    Returns:
+        neighbours (np.ndarray): (N, n_neighbours) int32 ids, nearest first, -1 padded
+    '''
+    vectors = get_answer_vectors(store)
+    forest = build_forest(vectors, n_trees, leaf_size, seed)
+    neighbours = np.full((store.n_users, n_neighbours), -1, dtype=np.int32)
+    for start in range(0, store.n_users, QUERY_BLOCK_SIZE):
+        user_ids = np.arange(start, min(start + QUERY_BLOCK_SIZE, store.n_users))
+        neighbours[user_ids] = get_neighbours_block(vectors, forest, user_ids, n_neighbours)
+    return neighbours
+
+def get_candidate_pairs(neighbours):
+    '''
+    Turns neighbour lists into candidate pairs: (u, v) is a pair if either
+    user is a neighbour of the other, so both directions of an edge exist.
+
+    Arguments:
+        neighbours (np.ndarray): (N, k) neighbour ids, -1 padded
+
+    Returns:
+        user_ids (np.ndarray): int64 user of each pair
+        c_ids (np.ndarray): int64 candidate of each pair, in (user, candidate) order
+    '''
+    n = len(neighbours)
+    users = np.repeat(np.arange(n, dtype=np.int64), neighbours.shape[1])
+    candidates = neighbours.ravel().astype(np.int64)
+    found = candidates >= 0
+    users, candidates = users[found], candidates[found]
+    keys = np.concatenate([users*n + candidates, candidates*n + users])
+    keys.sort()
+    keys = keys[np.concatenate([[True], keys[1:] != keys[:-1]])]
+    return keys//n, keys % n
+
+def get_ann_scores(store, n_neighbours=N_NEIGHBOURS, n_trees=N_TREES, leaf_size=LEAF_SIZE, seed=0):
+    '''
+    Gets the normalized scores of every user's approximate candidates:
+    their valid candidates among the candidate pairs (see get_candidate_pairs),
+    scored exactly.
+
+    Arguments:
+        store (ResponseStore): compiled responses
+        n_neighbours (int): number of neighbours per user
+        n_trees (int): number of trees in the forest
+        leaf_size (int): max number of users per leaf
+        seed (int): random seed of the forest
+
+    Returns:
+        scores (ScoreMatrix): normalized scores of each user's candidates (see csr.py);
+            a user whose candidates all score the same gets 1 for each
+        n_pairs (int): number of candidate pairs, before filtering
+    '''
+    user_ids, c_ids = get_candidate_pairs(get_neighbours(store, n_neighbours, n_trees, leaf_size, seed))
+    n_pairs = len(user_ids)
+    eligible = get_pair_eligibility(store, user_ids, c_ids)
+    user_ids, c_ids = user_ids[eligible], c_ids[eligible]
+
+    scores = np.empty(len(user_ids))
+    for start in range(0, len(user_ids), SCORE_CHUNK_SIZE):
+        chunk = slice(start, start + SCORE_CHUNK_SIZE)
+        scores[chunk] = score_pairs(store, user_ids[chunk], c_ids[chunk])
+    counts = np.bincount(user_ids, minlength=store.n_users)
+    return normalize_score_matrix(from_counts(counts, c_ids, scores), strict=False), n_pairs
+
+def get_recall_report(exact_pairs, approx_pairs, approx_scores):
+    '''
+    Compares the greedy matches of the approximate pipeline to the exact ones.
+
+    Arguments:
+        exact_pairs (np.ndarray): (n, 2) user ids of the matches of the exact pipeline
+        approx_pairs (np.ndarray): (n, 2) user ids of the matches of the approximate pipeline
+        approx_scores (ScoreMatrix): candidate scores of the approximate pipeline
+
+    Returns:
+        report (dict): numbers of exact and approximate matches, exact matches
+            recovered, exact matches that were mutual candidates at all, and recall
+    '''
+    exact = set(tuple(sorted(pair)) for pair in np.asarray(exact_pairs).tolist())
+    approx = set(tuple(sorted(pair)) for pair in np.asarray(approx_pairs).tolist())
+    reachable = [pair for pair in exact
+                 if approx_scores.get(pair[0], pair[1]) is not None and approx_scores.get(pair[1], pair[0]) is not None]
+    recovered = len(exact & approx)
+    return {'exact_matches': len(exact),
+            'approx_matches': len(approx),
+            'recovered_matches': recovered,
+            'candidate_matches': len(reachable),
+            'recall': recovered/float(len(exact)) if exact else 1.0,
+            'candidate_recall': len(reachable)/float(len(exact)) if exact else 1.0}
+
+def main():
+    '''
+    Command-line entry point: prints the recall report of a responses csv.
+    '''
+    import squad
+    parser = argparse.ArgumentParser(description='Recall of approximate candidate generation against exact matching.')
+    parser.add_argument('--responses', default=squad.RESPONSES_CSV, help='form responses csv to read')
+    parser.add_argument('--neighbours', type=int, default=N_NEIGHBOURS, help='nearest neighbours per user')
+    parser.add_argument('--trees', type=int, default=N_TREES, help='trees in the random projection forest')
+    parser.add_argument('--leaf-size', type=int, default=LEAF_SIZE, help='max users per leaf')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of the forest')
+    parser.add_argument('--report-json', help='json file to also write the report to')
+    args = parser.parse_args()
+
+    squad.load_responses(args.responses, None, None)
+    with contextlib.redirect_stdout(io.StringIO()):
+        exact_pairs = squad.get_all_pairings(squad.get_all_scores())
+        approx_scores, n_pairs = get_ann_scores(squad.store, args.neighbours, args.trees, args.leaf_size, args.seed)
+        approx_pairs = squad.get_all_pairings(approx_scores)
+
+    report = get_recall_report(exact_pairs, approx_pairs, approx_scores)
+    report['n_users'] = squad.N_users
+    report['candidate_pairs'] = n_pairs
+    report['all_pairs'] = squad.N_users*(squad.N_users - 1)
+    for name in ['n_users', 'all_pairs', 'candidate_pairs', 'exact_matches', 'approx_matches',
+                 'candidate_matches', 'recovered_matches', 'candidate_recall', 'recall']:
+        print('%-18s %s' % (name, report[name]))
+    if args.report_json:
+        with open(args.report_json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == '__main__':
+    main()
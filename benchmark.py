@@ -0,0 +1,226 @@
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import contextlib
+import engine
+import squad
+from squad import RESPONSES_CSV
+from profiling import StageProfiler
+from create_auto_email_sheet import create_auto_email_sheet
+from eligibility import get_filter_classes
+from generate_responses import write_responses_csv
+
+'''
+benchmark.py
+------------
+Times each stage of the matching pipeline on synthetic responses (see
+generate_responses.py), and reports wall time and peak memory per stage:
+
+    load                     load_responses: read the csv and compile the responses
+    filter                   group users into filter classes (see eligibility.py)
+    score                    get_all_scores, excluding normalization
+    normalization            normalize_rows calls made while scoring
+    get_all_pairings         mutual edges, sorting and greedy matching
+    format_and_save          write Results.csv
+    create_auto_email_sheet  write Auto_email_sheet.csv from the results
+
+Peak memory is the largest amount allocated by the stage on top of what was
+allocated before it started, as traced by tracemalloc (see profiling.py).
+Tracing slows down the pure python stages; pass --no-memory for wall times only.
+
+Each size runs in a scratch directory that holds the generated csv and
+the files the pipeline writes.
+
+Usage:
+    python benchmark.py --sizes 1000 10000 50000 --save-baseline bench_baseline.json
+    python benchmark.py --baseline bench_baseline.json
+'''
+
+STAGES = ['load', 'filter', 'score', 'normalization', 'get_all_pairings',
+          'format_and_save', 'create_auto_email_sheet']
+
+DEFAULT_SIZES = [1000, 10000, 50000]
+
+# Candidates kept per user; dense scoring doesn't fit in memory at 50k users
+DEFAULT_TOP_K = 100
+
+# A stage regresses if it is this much slower or larger than the baseline...
+REGRESSION_TOLERANCE = 0.25
+
+# ...and the difference is above these floors, so tiny stages don't flag on noise
+MIN_SECONDS_DELTA = 0.05
+MIN_PEAK_MB_DELTA = 1.0
+
+def run_pipeline(workdir, top_k, profiler):
+    '''
+    Runs every stage on the responses csv in workdir.
+
+    Arguments:
+        workdir (string): scratch directory holding the responses csv
+        top_k (int): candidates kept per user, or None to score densely
+        profiler (StageProfiler): records the measurements
+
+    Returns:
+        None
+    '''
+    responses_csv = os.path.join(workdir, RESPONSES_CSV)
+    results_csv = os.path.join(workdir, 'Results.csv')
+
+    # the snapshot cache and quarantine csv would otherwise land in the current directory
+    with profiler.stage('load'):
+        squad.load_responses(responses_csv, os.path.join(workdir, 'Quarantined_responses.csv'), None)
+    default_top_k = squad.TOP_K
+    squad.TOP_K = top_k
+    try:
+        with profiler.stage('filter'):
+            get_filter_classes(squad.store)
+
+        # normalize_rows is looked up in engine's globals at call time, so this measures every call
+        normalize_rows = engine.normalize_rows
+        engine.normalize_rows = profiler.wrap('normalization', normalize_rows)
+        try:
+            with profiler.stage('score'):
+                scores = squad.get_all_scores()
+        finally:
+            engine.normalize_rows = normalize_rows
+        profiler.subtract('score', 'normalization')
+
+        with profiler.stage('get_all_pairings'):
+            match_pairs = squad.get_all_pairings(scores)
+        del scores
+
+        with profiler.stage('format_and_save'):
+            squad.format_and_save(match_pairs, results_csv)
+
+        with profiler.stage('create_auto_email_sheet'):
+            create_auto_email_sheet(results_csv, os.path.join(workdir, 'Auto_email_sheet.csv'))
+    finally:
+        squad.TOP_K = default_top_k
+
+def benchmark_size(n_users, top_k=DEFAULT_TOP_K, seed=0, trace_memory=True, workdir=None):
+    '''
+    Benchmarks every stage on n_users synthetic responses.
+
+    Arguments:
+        n_users (int): number of responses
+        top_k (int): candidates kept per user, or None to score densely
+        seed (int): random seed of the responses
+        trace_memory (bool): whether to measure peak memory
+        workdir (string): scratch directory; a temporary one is used (and removed) if None
+
+    Returns:
+        results (dict): stage -> {'seconds': float, 'peak_mb': float or None}
+    '''
+    scratch_dir = workdir or tempfile.mkdtemp(prefix='squad_bench_')
+    if not os.path.isdir(scratch_dir):
+        os.makedirs(scratch_dir)
+    profiler = StageProfiler(trace_memory)
+    try:
+        write_responses_csv(os.path.join(scratch_dir, RESPONSES_CSV), n_users, seed)
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            run_pipeline(scratch_dir, top_k, profiler)
+    finally:
+        if workdir is None:
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+    return dict((stage, profiler.results[stage]) for stage in STAGES)
+
+def compare_to_baseline(report, baseline, tolerance=REGRESSION_TOLERANCE):
+    '''
+    Finds stages that got slower or larger than in the baseline.
+
+    Arguments:
+        report (dict): size (string) -> stage -> measurements, as saved by this script
+        baseline (dict): same format, from an earlier run
+        tolerance (float): allowed relative increase
+
+    Returns:
+        regressions (list): (size, stage, metric, baseline value, current value) tuples
+    '''
+    regressions = []
+    for size, stages in report.items():
+        for stage, result in stages.items():
+            base = baseline.get(size, {}).get(stage)
+            if base is None:
+                continue
+            for metric, min_delta in [('seconds', MIN_SECONDS_DELTA), ('peak_mb', MIN_PEAK_MB_DELTA)]:
+                if result.get(metric) is None or base.get(metric) is None:
+                    continue
+                if result[metric] > base[metric]*(1 + tolerance) and result[metric] - base[metric] > min_delta:
+                    regressions.append((size, stage, metric, base[metric], result[metric]))
+    return regressions
+
+def format_change(value, base_value):
+    '''
+    Formats the relative change from a baseline value, e.g. '+12%'.
+
+    Arguments:
+        value (float): current value
+        base_value (float): baseline value, or None
+
+    Returns:
+        change (string): relative change, or '' if there is nothing to compare
+    '''
+    if value is None or base_value is None or base_value == 0:
+        return ''
+    return '%+.0f%%' % (100*(value - base_value)/base_value)
+
+def print_report(report, baseline=None):
+    '''
+    Prints a table of the measurements, with changes from the baseline if given.
+
+    Arguments:
+        report (dict): size (string) -> stage -> measurements
+        baseline (dict): earlier report to compare against, or None
+
+    Returns:
+        None
+    '''
+    baseline = baseline or {}
+    print('%8s  %-24s %10s %8s %12s %8s' % ('users', 'stage', 'seconds', 'change', 'peak MiB', 'change'))
+    for size, stages in report.items():
+        for stage, result in stages.items():
+            base = baseline.get(size, {}).get(stage, {})
+            peak = '-' if result['peak_mb'] is None else '%.1f' % result['peak_mb']
+            print('%8s  %-24s %10.3f %8s %12s %8s'
+                  % (size, stage, result['seconds'], format_change(result['seconds'], base.get('seconds')),
+                     peak, format_change(result['peak_mb'], base.get('peak_mb'))))
+        print('%8s  %-24s %10.3f' % (size, 'total', sum(r['seconds'] for r in stages.values())))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the Squad matching pipeline on synthetic responses.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help='numbers of users to benchmark')
+    parser.add_argument('--top-k', type=int, default=DEFAULT_TOP_K,
+                        help='candidates kept per user (0 to score every valid candidate)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of the synthetic responses')
+    parser.add_argument('--no-memory', action='store_true', help="don't trace memory (faster, less distorted timings)")
+    parser.add_argument('--workdir', help='scratch directory to keep the generated files in')
+    parser.add_argument('--baseline', help='json report from an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=REGRESSION_TOLERANCE,
+                        help='allowed relative increase over the baseline')
+    parser.add_argument('--save-baseline', help='path to save this run\'s json report to')
+    args = parser.parse_args()
+
+    report = {}
+    for n_users in args.sizes:
+        workdir = os.path.join(args.workdir, str(n_users)) if args.workdir else None
+        report[str(n_users)] = benchmark_size(n_users, args.top_k or None, args.seed, not args.no_memory, workdir)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if baseline is not None:
+        regressions = compare_to_baseline(report, baseline, args.tolerance)
+        for size, stage, metric, base_value, value in regressions:
+            print('REGRESSION: %s users, %s %s: %.3f -> %.3f' % (size, stage, metric, base_value, value))
+        if regressions:
+            sys.exit(1)
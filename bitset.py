@@ -0,0 +1,103 @@
+import numpy as np
+
+'''
+bitset.py
+---------
+Packed bitsets for the multi-select questions. A user's selections are
+stored as an integer bitset (bit i set iff they selected vocabulary item i),
+packed into as many 64-bit words as the vocabulary needs, so the size of
+the intersection of two answers is a popcount of their AND.
+'''
+
+WORD_BITS = 64
+
+# Number of set bits in each byte value, for numpy versions without bitwise_count
+POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+def get_n_words(vocab_size):
+    '''
+    Returns the number of 64-bit words needed for a bitset over vocab_size items.
+
+    Arguments:
+        vocab_size (int): number of items in the vocabulary
+
+    Returns:
+        n_words (int): number of words, at least 1
+    '''
+    return max(1, (vocab_size + WORD_BITS - 1)//WORD_BITS)
+
+def pack_bitsets(bitsets, vocab_size):
+    '''
+    Packs integer bitsets into an array of 64-bit words.
+
+    Arguments:
+        bitsets (list): integer bitset per user
+        vocab_size (int): number of items in the vocabulary
+
+    Returns:
+        packed (np.ndarray): (len(bitsets), n_words) uint64 array; word w holds bits 64w..64w+63
+    '''
+    n_words = get_n_words(vocab_size)
+    word_mask = (1 << WORD_BITS) - 1
+    packed = np.zeros((len(bitsets), n_words), dtype=np.uint64)
+    for w in range(n_words):
+        packed[:, w] = [(bits >> (WORD_BITS*w)) & word_mask for bits in bitsets]
+    return packed
+
+def unpack_bitsets(packed):
+    '''
+    Unpacks an array of 64-bit words back into integer bitsets (inverse of pack_bitsets).
+
+    Arguments:
+        packed (np.ndarray): (n, n_words) uint64 array
+
+    Returns:
+        bitsets (list): integer bitset per row
+    '''
+    packed = np.ascontiguousarray(packed, dtype='<u8')
+    return [int.from_bytes(row, 'little') for row in map(bytes, packed)]
+
+def popcount(words):
+    '''
+    Counts the set bits of each element of a uint64 array.
+
+    Arguments:
+        words (np.ndarray): uint64 array
+
+    Returns:
+        counts (np.ndarray): uint8 array of the same shape with the number of set bits
+    '''
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(words)
+    words = np.ascontiguousarray(words)
+    return POPCOUNT_TABLE[words.view(np.uint8)].reshape(words.shape + (8,)).sum(axis=-1, dtype=np.uint8)
+
+def get_intersection_sizes(u_packed, c_packed):
+    '''
+    Computes the size of the intersection of pairs of bitsets.
+
+    Arguments:
+        u_packed (np.ndarray): (..., n_words) packed bitsets
+        c_packed (np.ndarray): (..., n_words) packed bitsets, broadcastable against
+            u_packed; e.g. (B, 1, n_words) and (1, C, n_words) for every pair of B x C
+
+    Returns:
+        sizes (np.ndarray): int array of the broadcast shape without the words axis;
+            sizes[i] = |u_i & c_i|
+    '''
+    sizes = np.zeros(np.broadcast_shapes(u_packed.shape[:-1], c_packed.shape[:-1]), dtype=np.int32)
+    for w in range(u_packed.shape[-1]):
+        sizes += popcount(u_packed[..., w] & c_packed[..., w])
+    return sizes
+
+def get_set_sizes(packed):
+    '''
+    Computes the size of each bitset.
+
+    Arguments:
+        packed (np.ndarray): (..., n_words) packed bitsets
+
+    Returns:
+        sizes (np.ndarray): int array of set sizes, without the words axis
+    '''
+    return popcount(packed).sum(axis=-1, dtype=np.int32)
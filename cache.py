@@ -0,0 +1,127 @@
+import os
+import glob
+import json
+import hashlib
+import importlib
+import numpy as np
+
+'''
+cache.py
+--------
+On-disk cache of the sorted mutual edges, so reruns that only change the
+greedy matching parameters (MIN_MATCHES, MATCH_THRESHOLD) skip scoring
+entirely. The edges are saved as a single .npy file of
+(user1, user2, score) records and memory-mapped on load, so reading them
+costs no copy.
+
+The cache key hashes the responses csv contents, the source of the
+scoring modules and the scoring parameters. A cache written under any
+other key is stale: it is ignored, and removed when the new one is saved.
+'''
+
+# Bump when the on-disk format changes
+CACHE_VERSION = 1
+
+# Modules whose source determines the scores
+SCORING_MODULES = ['score', 'store', 'bitset', 'eligibility', 'engine', 'parallel', 'pairing', 'fused', 'ann', 'csr',
+                   'ingest', 'history']
+
+EDGE_DTYPE = np.dtype([('user1', '<i4'), ('user2', '<i4'), ('score', '<f8')])
+
+def hash_file(path, hasher):
+    '''
+    Feeds the contents of a file into a hasher, a chunk at a time.
+
+    Arguments:
+        path (string): path of the file
+        hasher (hashlib hash): hash to update
+
+    Returns:
+        None
+    '''
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(2**20), b''):
+            hasher.update(chunk)
+
+def get_cache_key(responses_csv, params):
+    '''
+    Computes the cache key for a responses csv and scoring parameters.
+
+    Arguments:
+        responses_csv (string): path of the responses csv
+        params (dict): json-serializable parameters that affect the scores
+
+    Returns:
+        key (string): hex digest
+    '''
+    hasher = hashlib.sha256()
+    hasher.update(json.dumps({'version': CACHE_VERSION, 'params': params}, sort_keys=True).encode())
+    hash_file(responses_csv, hasher)
+    for name in SCORING_MODULES:
+        hash_file(importlib.import_module(name).__file__, hasher)
+    return hasher.hexdigest()
+
+def get_cache_path(cache_dir, key):
+    '''
+    Returns the path of the edges file for a cache key.
+
+    Arguments:
+        cache_dir (string): cache directory
+        key (string): cache key
+
+    Returns:
+        path (string): path of the .npy file
+    '''
+    return os.path.join(cache_dir, 'edges-%s.npy' % key)
+
+def load_edges(cache_dir, key):
+    '''
+    Memory-maps the cached sorted edges for key, if they exist.
+
+    Arguments:
+        cache_dir (string): cache directory
+        key (string): cache key
+
+    Returns:
+        edges (tuple): (edge_u, edge_v, edge_scores) read-only array views, best
+            edge first, or None if there is no cache for key
+    '''
+    path = get_cache_path(cache_dir, key)
+    if not os.path.exists(path):
+        return None
+    edges = np.load(path, mmap_mode='r')
+    if edges.dtype != EDGE_DTYPE:
+        return None
+    return edges['user1'], edges['user2'], edges['score']
+
+def save_edges(cache_dir, key, edge_u, edge_v, edge_scores):
+    '''
+    Saves sorted edges under key, and removes caches saved under any other key.
+
+    Arguments:
+        cache_dir (string): cache directory, created if needed
+        key (string): cache key
+        edge_u (np.ndarray): first user of each edge, best edge first
+        edge_v (np.ndarray): second user of each edge
+        edge_scores (np.ndarray): mutual score of each edge
+
+    Returns:
+        None
+    '''
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    edges = np.empty(len(edge_scores), dtype=EDGE_DTYPE)
+    edges['user1'] = edge_u
+    edges['user2'] = edge_v
+    edges['score'] = edge_scores
+
+    # write to a temporary file first, so an interrupted run never leaves a partial cache
+    path = get_cache_path(cache_dir, key)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.save(f, edges)
+    os.replace(tmp_path, path)
+
+    for stale_path in glob.glob(os.path.join(cache_dir, 'edges-*.npy')):
+        if stale_path != path:
+            os.remove(stale_path)
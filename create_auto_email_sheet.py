@@ -1,9 +1,8 @@
-import os
-import re
 import csv
-import math
-import pandas as pd
-import numpy as np
+import html
+import argparse
+import itertools
+from collections import deque
 
 '''
 create_auto_email_sheet.py
@@ -23,14 +22,38 @@ Each row contains two columns:
 
 Resource to auto-send from sheets:
 https://developers.google.com/apps-script/articles/sending_emails
+
+The results are streamed: rows are read CHUNK_ROWS at a time, each chunk
+is rendered into one block of utf-8 csv (optionally in worker processes),
+and the blocks are written in order through a large write buffer, so
+memory stays constant however many matches there are. The message
+template is split into its static segments once, and each message is a
+join of those segments with the (html-escaped) names and blurbs.
+
+Importing this module has no side effects; run it from the command line:
+
+    python create_auto_email_sheet.py --results Results_final.csv --dest Auto_email_sheet.csv
+    python create_auto_email_sheet.py --results Results_test.csv --dest Auto_email_sheet_test.csv
 '''
 
-# Source file with matching results
+# Default source file with matching results
 RESULTS_CSV = 'Results_final.csv'
 
-# Destination file to write the auto email sheet
+# Default destination file to write the auto email sheet
 DEST_CSV = 'Auto_email_sheet.csv'
 
+# Columns of the results csv that are read (see format_and_save in squad.py)
+RESULT_COLUMNS = ['name1', 'email1', 'blurb1', 'name2', 'email2', 'blurb2']
+
+# Number of result rows rendered at a time
+CHUNK_ROWS = 4096
+
+# Size of the destination file's write buffer, in bytes
+WRITE_BUFFER_SIZE = 2**20
+
+# Chunks handed to the worker pool ahead of the one being written, per worker
+CHUNKS_AHEAD_PER_WORKER = 2
+
 FORM_URL = 'https://docs.google.com/forms/d/e/1FAIpQLSfTbME3RNBvIS72547_0wYmlJalA5cmyhjUaER94MnM90RaEg/viewform'
 
 HTML_MESSAGE_BASE = "<div dir='ltr'> Hey %s and %s,&nbsp;<div>&nbsp;</div>" + \
@@ -49,51 +72,187 @@ HTML_MESSAGE_BASE = "<div dir='ltr'> Hey %s and %s,&nbsp;<div>&nbsp;</div>" + \
                     "<div>Also, please check your Spam folder - it's possible some of your other matches may have gone there, and you won't want to miss them!</div><div>&nbsp;</div>" + \
                     "<span style='color: #000000;'>- The Squad team</span></div></div>"
 
-def create_auto_email_sheet():
+# Static segments of HTML_MESSAGE_BASE around its %s fields (first names (2),
+# then full name and blurb of each person (4)), with csv quotes already doubled
+MESSAGE_SEGMENTS = [segment.replace('"', '""') for segment in HTML_MESSAGE_BASE.split('%s')]
+
+# Characters that make the csv writer quote a field (csv.QUOTE_MINIMAL)
+CSV_SPECIAL_CHARACTERS = [',', '"', '\r', '\n']
+
+def iterate_result_chunks(results_csv, chunk_rows=CHUNK_ROWS):
     '''
-    Reads in the Responses_final.csv and writes a csv properly formatted 
-    for auto-email sending with google sheets.
+    Streams the matches of a results csv, chunk_rows at a time.
 
-    Each row contains two columns:
-    - recipients: the two recipient emails, comma-separated
-    - message: the html formatted message, with the custom names and blurbs
+    Arguments:
+        results_csv (string): matching results csv to read
+        chunk_rows (int): number of rows per chunk
 
+    Returns:
+        chunks (generator): lists of [name1, email1, blurb1, name2, email2, blurb2] rows
+    '''
+    with open(results_csv, newline='') as f:
+        csv_reader = csv.reader(f)
+        header = next(csv_reader, None)
+        if header is None:
+            return
+        indices = [header.index(column) for column in RESULT_COLUMNS]
+        while True:
+            rows = list(itertools.islice(csv_reader, chunk_rows))
+            if not rows:
+                return
+            yield [[row[i] for i in indices] for row in rows]
 
-        recipients, names, message
-        p1@, p2@ , Bob and Sally, <html msg>
-        ...
+def capitalize_names(names):
+    '''
+    Capitalizes every word of a batch of names.
 
     Arguments:
-        None
+        names (list): names as written in the form
 
     Returns:
-        None
+        fullnames (list): names with every word capitalized
+        firstnames (list): first word of each capitalized name
     '''
+    fullnames = [' '.join([n.capitalize() for n in name.split()]) for name in names]
+    firstnames = [fullname.split(' ', 1)[0] for fullname in fullnames]
+    return fullnames, firstnames
 
-    with open(DEST_CSV, mode='w') as f:
-        csv_writer = csv.writer(f, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+def escape_fields(values):
+    '''
+    Html-escapes a batch of message fields and doubles their csv quotes,
+    ready to be joined with MESSAGE_SEGMENTS.
 
-        # write header
-        header = ['recipients', 'names', 'message']
-        csv_writer.writerow(header)
+    Arguments:
+        values (list): names or blurbs
 
-        # open results file to read from
-        df = pd.read_csv(RESULTS_CSV)
+    Returns:
+        escaped (list): escaped values
+    '''
+    return [html.escape(value, quote=False).replace('"', '""') for value in values]
 
-        for index, row in df.iterrows():
-            name1, email1, blurb1 = row['name1'], row['email1'], row['blurb1']
-            name2, email2, blurb2 = row['name2'], row['email2'], row['blurb2']
+def quote_fields(values):
+    '''
+    Writes a batch of short fields the way csv.writer does with QUOTE_MINIMAL.
 
-            fullname1 = ' '.join([n.capitalize() for n in name1.split()])
-            fullname2 = ' '.join([n.capitalize() for n in name2.split()])
+    Arguments:
+        values (list): field values
 
-            firstname1 = fullname1.split()[0]
-            firstname2 = fullname2.split()[0]
+    Returns:
+        fields (list): values, quoted if they hold a CSV_SPECIAL_CHARACTERS character
+    '''
+    return ['"%s"' % value.replace('"', '""') if any(c in value for c in CSV_SPECIAL_CHARACTERS) else value
+            for value in values]
+
+def render_chunk(rows):
+    '''
+    Renders a chunk of matches as rows of the auto-email sheet. The rows
+    are encoded directly, as csv.writer would, since it is slow to scan
+    the long messages for characters to quote, and their static segments
+    are already encoded.
 
-            recipients = '%s,%s' % (email1, email2)  # emails, comma-separated
-            names = '%s and %s' % (firstname1, firstname2)
-            message = HTML_MESSAGE_BASE % (firstname1, firstname2, fullname1, blurb1, fullname2, blurb2)
+    Arguments:
+        rows (list): rows yielded by iterate_result_chunks
+
+    Returns:
+        data (bytes): the chunk's [recipients, names, message] rows as utf-8 csv
+    '''
+    names1, emails1, blurbs1, names2, emails2, blurbs2 = zip(*rows)
+    fullnames1, firstnames1 = capitalize_names(names1)
+    fullnames2, firstnames2 = capitalize_names(names2)
 
-            csv_writer.writerow([recipients, names, message])
+    recipients = quote_fields(['%s,%s' % pair for pair in zip(emails1, emails2)])  # emails, comma-separated
+    names = quote_fields(['%s and %s' % pair for pair in zip(firstnames1, firstnames2)])
+    s0, s1, s2, s3, s4, s5, s6 = MESSAGE_SEGMENTS
+    # a message always holds commas, so it is always quoted
+    return ''.join(['%s,%s,"%s"\r\n' % (recipient, name, ''.join((s0, first1, s1, first2, s2, full1, s3, blurb1,
+                                                                   s4, full2, s5, blurb2, s6)))
+                    for recipient, name, first1, first2, full1, blurb1, full2, blurb2
+                    in zip(recipients, names, escape_fields(firstnames1), escape_fields(firstnames2),
+                           escape_fields(fullnames1), escape_fields(blurbs1),
+                           escape_fields(fullnames2), escape_fields(blurbs2))]).encode('utf-8')
+
+def render_chunks(chunks, n_workers=1):
+    '''
+    Renders chunks of matches in order, in a process pool if n_workers > 1.
+    At most CHUNKS_AHEAD_PER_WORKER chunks per worker are in flight, so
+    reading doesn't run ahead of writing. Every chunk's output is sent back
+    from its worker, so workers only pay off when escaping long blurbs
+    costs more than that copy; a single process keeps up with the disk.
+
+    Arguments:
+        chunks (iterable): chunks yielded by iterate_result_chunks
+        n_workers (int): number of processes to render chunks in
+
+    Returns:
+        chunks (generator): utf-8 csv of each chunk (see render_chunk), in chunk order
+    '''
+    if n_workers <= 1:
+        yield from map(render_chunk, chunks)
+        return
+    from multiprocessing import Pool
+    with Pool(n_workers) as pool:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.apply_async(render_chunk, (chunk,)))
+            if len(pending) >= n_workers*CHUNKS_AHEAD_PER_WORKER:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+def open_sheet(dest_csv):
+    '''
+    Opens an auto-email sheet for writing chunks rendered by render_chunk, and writes its header.
+
+    Arguments:
+        dest_csv (string): destination csv
+
+    Returns:
+        f (file): the sheet, opened in binary mode; the caller must close it
+    '''
+    f = open(dest_csv, mode='wb', buffering=WRITE_BUFFER_SIZE)
+    header = ['recipients', 'names', 'message']
+    f.write((','.join(header) + '\r\n').encode('utf-8'))
+    return f
+
+def create_auto_email_sheet(results_csv=RESULTS_CSV, dest_csv=DEST_CSV, chunk_rows=CHUNK_ROWS, n_workers=1):
+    '''
+    Reads in the matching results and writes a csv properly formatted
+    for auto-email sending with google sheets.
+
+    Each row contains three columns:
+    - recipients: the two recipient emails, comma-separated
+    - names: 'firstname1 and firstname2'
+    - message: the html formatted message, with the custom names and blurbs
+
+
+        recipients, names, message
+        p1@, p2@ , Bob and Sally, <html msg>
+        ...
+
+    Arguments:
+        results_csv (string): matching results csv to read
+        dest_csv (string): destination csv
+        chunk_rows (int): number of rows rendered at a time
+        n_workers (int): number of processes to render chunks in
+
+    Returns:
+        None
+    '''
+    with open_sheet(dest_csv) as f:
+        for data in render_chunks(iterate_result_chunks(results_csv, chunk_rows), n_workers):
+            f.write(data)
+
+def main():
+    '''
+    Command-line entry point; see python create_auto_email_sheet.py --help.
+    '''
+    parser = argparse.ArgumentParser(description='Write the auto-email sheet for the Squad matches.')
+    parser.add_argument('--results', default=RESULTS_CSV, help='matching results csv to read')
+    parser.add_argument('--dest', default=DEST_CSV, help='csv to write the email sheet to')
+    parser.add_argument('--chunk-rows', type=int, default=CHUNK_ROWS, help='number of rows rendered at a time')
+    parser.add_argument('--workers', type=int, default=1, help='number of processes to render chunks in')
+    args = parser.parse_args()
+    create_auto_email_sheet(args.results, args.dest, args.chunk_rows, args.workers)
 
-create_auto_email_sheet()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+import numpy as np
+
+'''
+csr.py
+------
+Compressed sparse row (CSR) storage of every user's candidate scores, in
+place of a list of {candidate id: score} dicts. Row u holds user u's
+candidates in increasing id order:
+
+    indices[indptr[u]:indptr[u+1]]    candidate ids (int32)
+    data[indptr[u]:indptr[u+1]]       scores
+
+That is 12 bytes per (user, candidate) entry instead of 100+ for a dict
+entry, and since rows are sorted, entries are globally ordered by
+(user, candidate), so a pair can be looked up with a binary search.
+'''
+
+# dtype of the scores. float32 would save another third of the memory, but
+# rounds scores enough to reorder near-tied match edges, so it changes matches.
+SCORES_DTYPE = np.float64
+
+class ScoreMatrix:
+    '''
+    Candidate scores of all users in CSR form (see module docstring).
+
+    Attributes:
+        n_users (int): number of users (rows)
+        indptr (np.ndarray): int64 array of n_users + 1 row offsets
+        indices (np.ndarray): int32 candidate id of each entry, increasing within a row
+        data (np.ndarray): SCORES_DTYPE score of each entry
+    '''
+    def __init__(self, indptr, indices, data):
+        self.n_users = len(indptr) - 1
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+
+    def __len__(self):
+        return self.n_users
+
+    @property
+    def nnz(self):
+        return len(self.indices)
+
+    @property
+    def nbytes(self):
+        return self.indptr.nbytes + self.indices.nbytes + self.data.nbytes
+
+    def get_counts(self):
+        '''
+        Returns the number of candidates of each user.
+
+        Arguments:
+            None
+
+        Returns:
+            counts (np.ndarray): int64 number of entries per row
+        '''
+        return np.diff(self.indptr)
+
+    def get_users(self):
+        '''
+        Returns the user (row) of each entry.
+
+        Arguments:
+            None
+
+        Returns:
+            users (np.ndarray): int64 row of each entry
+        '''
+        return np.repeat(np.arange(self.n_users, dtype=np.int64), self.get_counts())
+
+    def get_row(self, user_id):
+        '''
+        Returns a user's candidates and scores.
+
+        Arguments:
+            user_id (int): id of the user
+
+        Returns:
+            ids (np.ndarray): candidate ids, increasing (a view)
+            scores (np.ndarray): scores of ids (a view)
+        '''
+        start, stop = self.indptr[user_id], self.indptr[user_id + 1]
+        return self.indices[start:stop], self.data[start:stop]
+
+    def get(self, user_id, c_id, default=None):
+        '''
+        Looks up a user's score for a candidate.
+
+        Arguments:
+            user_id (int): id of the user
+            c_id (int): id of the candidate
+            default (object): returned if c_id is not a candidate of user_id
+
+        Returns:
+            score (float): the score, or default
+        '''
+        ids, scores = self.get_row(user_id)
+        i = np.searchsorted(ids, c_id)
+        if i < len(ids) and ids[i] == c_id:
+            return float(scores[i])
+        return default
+
+    def to_scores_maps(self):
+        '''
+        Converts the matrix into a list of scores maps.
+
+        Arguments:
+            None
+
+        Returns:
+            scores_map_list (list of int->float dicts): scores map per user
+        '''
+        indices, data = self.indices.tolist(), self.data.tolist()
+        bounds = self.indptr.tolist()
+        return [dict(zip(indices[start:stop], data[start:stop])) for start, stop in zip(bounds[:-1], bounds[1:])]
+
+def from_counts(counts, ids, scores, sort=False):
+    '''
+    Builds a ScoreMatrix from entries concatenated in user order.
+
+    Arguments:
+        counts (np.ndarray): number of entries of each user
+        ids (np.ndarray): candidate ids of all users, concatenated
+        scores (np.ndarray): scores of ids
+        sort (boolean): whether ids still need to be sorted within each user
+
+    Returns:
+        matrix (ScoreMatrix): the scores
+    '''
+    indptr = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    ids = np.asarray(ids, dtype=np.int32)
+    scores = np.asarray(scores, dtype=SCORES_DTYPE)
+    if sort and len(ids):
+        rows = np.repeat(np.arange(len(counts), dtype=np.int64), counts)
+        order = np.argsort(rows*(int(ids.max()) + 1) + ids)
+        ids, scores = ids[order], scores[order]
+    return ScoreMatrix(indptr, ids, scores)
+
+def from_candidates(candidates, sort=False):
+    '''
+    Builds a ScoreMatrix from per-user candidate arrays.
+
+    Arguments:
+        candidates (list): per user, (ids, scores) arrays
+        sort (boolean): whether ids still need to be sorted within each user
+
+    Returns:
+        matrix (ScoreMatrix): the scores
+    '''
+    counts = np.array([len(ids) for ids, _ in candidates], dtype=np.int64)
+    if not len(candidates):
+        return from_counts(counts, np.zeros(0, dtype=np.int32), np.zeros(0))
+    ids = np.concatenate([ids for ids, _ in candidates])
+    scores = np.concatenate([scores for _, scores in candidates])
+    return from_counts(counts, ids, scores, sort)
+
+def from_scores_maps(scores_map_list):
+    '''
+    Builds a ScoreMatrix from a list of scores maps.
+
+    Arguments:
+        scores_map_list (list of int->float dicts): scores map per user
+
+    Returns:
+        matrix (ScoreMatrix): the scores
+    '''
+    candidates = [(np.fromiter(m.keys(), dtype=np.int32, count=len(m)),
+                   np.fromiter(m.values(), dtype=SCORES_DTYPE, count=len(m))) for m in scores_map_list]
+    return from_candidates(candidates, sort=True)
+
+def normalize_score_matrix(matrix, strict=True):
+    '''
+    Normalizes every row so its scores lie between 0 and 1, like
+    get_normalized_map in squad.py does for one scores map.
+
+    Arguments:
+        matrix (ScoreMatrix): raw scores
+        strict (boolean): if True, a row whose scores are all equal raises
+            ZeroDivisionError, as get_normalized_map does; if False, its scores
+            all normalize to 1
+
+    Returns:
+        normalized (ScoreMatrix): normalized scores, with the same indptr and indices
+    '''
+    counts = matrix.get_counts()
+    nonempty = np.flatnonzero(counts)
+    data = np.asarray(matrix.data, dtype=np.float64)
+    min_score = np.zeros(matrix.n_users)
+    max_score = np.zeros(matrix.n_users)
+    if len(nonempty):
+        min_score[nonempty] = np.minimum.reduceat(data, matrix.indptr[nonempty])
+        max_score[nonempty] = np.maximum.reduceat(data, matrix.indptr[nonempty])
+    score_range = max_score - min_score
+    constant = score_range == 0
+    if strict and np.any(constant[nonempty]):
+        raise ZeroDivisionError('float division by zero')
+    score_range[constant] = 1
+    users = matrix.get_users()
+    normalized = (data - min_score[users])/score_range[users]
+    normalized[constant[users]] = 1
+    return ScoreMatrix(matrix.indptr, matrix.indices, normalized.astype(SCORES_DTYPE))
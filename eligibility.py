@@ -0,0 +1,366 @@
+import numpy as np
+
+'''
+eligibility.py
+--------------
+Bitmask implementation of the hard filters (gender, religion and political
+party preferences) used by filter() in squad.py.
+
+Each distinct identity answer gets a bit position, and each user's
+preference answer is encoded as the bitmask of the identities it accepts,
+so checking a candidate is a single AND instead of substring tests on
+raw strings.
+'''
+
+# (name, identity question idx, preference question idx); see indices.txt
+FILTER_QUESTIONS = [('gender', 6, 7),
+                    ('religion', 8, 9),
+                    ('party', 10, 11)]
+
+ANY_PREFERENCE = 'Any/all of the above'
+
+# Preference mask that accepts every identity
+ANY_MASK = np.uint64(0xFFFFFFFFFFFFFFFF)
+
+# Max number of distinct identity answers per question, one bit each
+MAX_IDENTITIES = 64
+
+def get_preference_mask(preference, identity_vocab):
+    '''
+    Encodes a preference answer as the bitmask of the identities it accepts.
+    An identity is accepted if it appears in the preference answer, or if
+    the answer contains 'Any/all of the above'.
+
+    Arguments:
+        preference (string): raw preference answer
+        identity_vocab (dict): identity answer -> bit position
+
+    Returns:
+        mask (np.uint64): bit b is set iff the identity with bit position b is accepted
+    '''
+    if ANY_PREFERENCE in preference:
+        return ANY_MASK
+    mask = 0
+    for identity, bit in identity_vocab.items():
+        if identity in preference:
+            mask |= 1 << bit
+    return np.uint64(mask)
+
+def get_preference_masks(preference_codes, preference_vocab, identity_vocab, exempt_ids=()):
+    '''
+    Encodes every user's preference answer as a bitmask.
+
+    Arguments:
+        preference_codes (np.ndarray): code into preference_vocab per user
+        preference_vocab (dict): preference answer -> code
+        identity_vocab (dict): identity answer -> bit position
+        exempt_ids (list): ids of users that accept every identity regardless of their answer
+
+    Returns:
+        masks (np.ndarray): uint64 preference bitmask per user
+    '''
+    if len(identity_vocab) > MAX_IDENTITIES:
+        raise ValueError('%d distinct identity answers, at most %d are supported'
+                         % (len(identity_vocab), MAX_IDENTITIES))
+    mask_table = np.zeros(len(preference_vocab), dtype=np.uint64)
+    for preference, code in preference_vocab.items():
+        mask_table[code] = get_preference_mask(preference, identity_vocab)
+    masks = mask_table[preference_codes]
+    exempt_ids = [i for i in exempt_ids if i < len(masks)]
+    masks[exempt_ids] = ANY_MASK
+    return masks
+
+def get_filter_block(store, user_ids, c_ids):
+    '''
+    Computes which candidates pass each user's filters, for every pair in
+    user_ids x c_ids, without excluding a user as their own candidate.
+
+    Arguments:
+        store (ResponseStore): compiled responses
+        user_ids (np.ndarray): ids of users (rows of the block)
+        c_ids (np.ndarray): ids of candidates (columns of the block)
+
+    Returns:
+        passes (np.ndarray): (len(user_ids), len(c_ids)) boolean matrix;
+            True iff the candidate passes all of the user's filters
+    '''
+    user_ids = np.asarray(user_ids, dtype=np.intp)
+    c_ids = np.asarray(c_ids, dtype=np.intp)
+    passes = np.ones((len(user_ids), len(c_ids)), dtype=bool)
+    for name, _, _ in FILTER_QUESTIONS:
+        passes &= get_question_block(store, name, user_ids, c_ids)
+    return passes
+
+def get_question_block(store, name, user_ids, c_ids):
+    '''
+    Computes which candidates pass one of each user's filters, for every
+    pair in user_ids x c_ids.
+
+    Arguments:
+        store (ResponseStore): compiled responses
+        name (string): filter name (see FILTER_QUESTIONS)
+        user_ids (np.ndarray): ids of users (rows of the block)
+        c_ids (np.ndarray): ids of candidates (columns of the block)
+
+    Returns:
+        passes (np.ndarray): (len(user_ids), len(c_ids)) boolean matrix;
+            True iff the candidate's identity is accepted by the user's preference
+    '''
+    u_mask = store.preference_mask[name][user_ids][:, None]
+    c_bit = np.left_shift(np.uint64(1), store.identity[name][c_ids].astype(np.uint64))[None, :]
+    return (u_mask & c_bit) != 0
+
+def get_history_block(store, user_ids, c_ids):
+    '''
+    Computes which pairs in user_ids x c_ids were not matched in an earlier
+    round (see history.py).
+
+    Arguments:
+        store (ResponseStore): compiled responses
+        user_ids (np.ndarray): ids of users (rows of the block)
+        c_ids (np.ndarray): ids of candidates (columns of the block)
+
+    Returns:
+        allowed (np.ndarray): (len(user_ids), len(c_ids)) boolean matrix;
+            False iff the pair is excluded by the pair history
+    '''
+    user_ids = np.asarray(user_ids, dtype=np.int64)
+    c_ids = np.asarray(c_ids, dtype=np.int64)
+    allowed = np.ones((len(user_ids), len(c_ids)), dtype=bool)
+    keys = store.excluded_keys
+    if not len(keys):
+        return allowed
+
+    # the excluded candidates of each row are the keys in [user_id*N, (user_id + 1)*N)
+    n = store.n_users
+    starts = np.searchsorted(keys, user_ids*n)
+    counts = np.searchsorted(keys, (user_ids + 1)*n) - starts
+    if not counts.sum():
+        return allowed
+    rows = np.repeat(np.arange(len(user_ids)), counts)
+    excluded = keys[np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())] % n
+
+    # columns of the excluded candidates that are in the block
+    order = np.argsort(c_ids, kind='stable')
+    positions = np.searchsorted(c_ids, excluded, sorter=order)
+    found = positions < len(c_ids)
+    found[found] = c_ids[order[positions[found]]] == excluded[found]
+    allowed[rows[found], order[positions[found]]] = False
+    return allowed
+
+def get_eligibility_block(store, user_ids, c_ids):
+    '''
+    Computes which candidates pass each user's filters, for every pair in
+    user_ids x c_ids. A user is never a candidate for themselves, nor for
+    anyone they were matched with in an earlier round.
+
+    Arguments:
+        store (ResponseStore): compiled responses
+        user_ids (np.ndarray): ids of users (rows of the block)
+        c_ids (np.ndarray): ids of candidates (columns of the block)
+
+    Returns:
+        eligible (np.ndarray): (len(user_ids), len(c_ids)) boolean matrix;
+            True iff the candidate is valid for the user
+    '''
+    user_ids = np.asarray(user_ids, dtype=np.intp)
+    c_ids = np.asarray(c_ids, dtype=np.intp)
+    eligible = get_filter_block(store, user_ids, c_ids) & (user_ids[:, None] != c_ids[None, :])
+    if len(store.excluded_keys):
+        eligible &= get_history_block(store, user_ids, c_ids)
+    return eligible
+
+def get_pair_eligibility(store, user_ids, c_ids):
+    '''
+    Computes whether c_ids[i] is a valid candidate for user_ids[i], for
+    arbitrary pairs of users rather than a block.
+
+    Arguments:
+        store (ResponseStore): compiled responses
+        user_ids (np.ndarray): ids of the users
+        c_ids (np.ndarray): ids of the candidates, broadcastable against user_ids
+
+    Returns:
+        eligible (np.ndarray): boolean array of the broadcast shape;
+            True iff the candidate is valid for the user
+    '''
+    user_ids = np.asarray(user_ids, dtype=np.intp)
+    c_ids = np.asarray(c_ids, dtype=np.intp)
+    eligible = user_ids != c_ids
+    for name, _, _ in FILTER_QUESTIONS:
+        c_bit = np.left_shift(np.uint64(1), store.identity[name][c_ids].astype(np.uint64))
+        eligible &= (store.preference_mask[name][user_ids] & c_bit) != 0
+    if len(store.excluded_keys):
+        keys = np.broadcast_to(user_ids, eligible.shape).astype(np.int64)*store.n_users + c_ids
+        positions = np.minimum(np.searchsorted(store.excluded_keys, keys), len(store.excluded_keys) - 1)
+        eligible &= store.excluded_keys[positions] != keys
+    return eligible
+
+def get_eligibility_matrix(store):
+    '''
+    Computes the N x N eligibility matrix for all users.
+
+    Arguments:
+        store (ResponseStore): compiled responses
+
+    Returns:
+        eligible (np.ndarray): (N, N) boolean matrix; eligible[i, j] = True iff
+            j is a valid candidate for user i
+    '''
+    all_ids = np.arange(store.n_users)
+    return get_eligibility_block(store, all_ids, all_ids)
+
+class FilterClasses:
+    '''
+    Users grouped into equivalence classes by their filter answers.
+
+    Whether c is a valid candidate for u depends only on u's preference
+    answers and c's identity answers. So users are grouped by identity
+    (gender, religion, party), and then by the set of identity classes
+    their preferences accept. Every user in a preference class has the
+    same candidates, and eligibility is computed once per
+    (preference class, identity class) pair instead of once per pair of users.
+
+    Attributes:
+        identity_class (np.ndarray): identity class of each user
+        identity_members (list): user ids of each identity class
+        preference_class (np.ndarray): preference class of each user
+        preference_members (list): user ids of each preference class
+        accepts (np.ndarray): (n preference classes, n identity classes) boolean matrix;
+            True iff members of the preference class accept members of the identity class
+    '''
+    def __init__(self, identity_class, preference_class, accepts):
+        self.identity_class = identity_class
+        self.identity_members = get_members(identity_class, accepts.shape[1])
+        self.preference_class = preference_class
+        self.preference_members = get_members(preference_class, accepts.shape[0])
+        self.accepts = accepts
+
+    def get_candidates(self, preference_class):
+        '''
+        Returns the ids of users that pass the filters of a preference class.
+
+        Arguments:
+            preference_class (int): preference class
+
+        Returns:
+            c_ids (np.ndarray): sorted user ids (including the class's own members)
+        '''
+        accepted = np.flatnonzero(self.accepts[preference_class])
+        c_ids = [self.identity_members[k] for k in accepted]
+        return np.sort(np.concatenate(c_ids)) if c_ids else np.zeros(0, dtype=np.intp)
+
+def get_members(class_ids, n_classes):
+    '''
+    Groups user ids by class.
+
+    Arguments:
+        class_ids (np.ndarray): class of each user
+        n_classes (int): number of classes
+
+    Returns:
+        members (list): sorted user ids of each class
+    '''
+    order = np.argsort(class_ids, kind='stable')
+    bounds = np.searchsorted(class_ids[order], np.arange(1, n_classes))
+    return np.split(order, bounds)
+
+def get_filter_classes(store):
+    '''
+    Groups users into identity and preference classes (see FilterClasses).
+
+    Arguments:
+        store (ResponseStore): compiled responses
+
+    Returns:
+        classes (FilterClasses): filter classes of all users
+    '''
+    identities = np.stack([store.identity[name] for name, _, _ in FILTER_QUESTIONS], axis=1)
+    _, representatives, identity_class = get_row_classes(identities)
+
+    # which identity classes each user accepts, then group users with the same accepted set;
+    # packbits keeps the lexicographic order of the rows, so classes are numbered as if sorting the rows
+    accepted = get_filter_block(store, np.arange(store.n_users), representatives)
+    packed = np.packbits(accepted, axis=1)
+    packed = np.pad(packed, ((0, 0), (0, -packed.shape[1] % 8)))
+    _, first_index, preference_class = get_row_classes(packed.view('>u8').astype(np.uint64))
+    return FilterClasses(identity_class, preference_class, accepted[first_index].reshape(-1, len(representatives)))
+
+def get_row_classes(rows):
+    '''
+    Numbers the distinct rows of a 2-D array in lexicographic order. Same as
+    np.unique(rows, axis=0, return_index=True, return_inverse=True), but
+    sorts with a lexsort over the columns, which is much faster than
+    np.unique's sort of whole rows.
+
+    Arguments:
+        rows (np.ndarray): (N, M) integer array
+
+    Returns:
+        unique_rows (np.ndarray): distinct rows, in lexicographic order
+        first_index (np.ndarray): index of the first occurrence of each distinct row
+        inverse (np.ndarray): class (index into unique_rows) of each row
+    '''
+    order = np.lexsort(rows.T[::-1])
+    sorted_rows = rows[order]
+    is_new = np.ones(len(rows), dtype=bool)
+    is_new[1:] = (sorted_rows[1:] != sorted_rows[:-1]).any(axis=1)
+    inverse = np.empty(len(rows), dtype=np.intp)
+    inverse[order] = np.cumsum(is_new) - 1
+    return sorted_rows[is_new], order[is_new], inverse
+
+def get_pruning_stats(classes):
+    '''
+    Computes how much of the N x N candidate space the filters rule out.
+
+    Arguments:
+        classes (FilterClasses): filter classes of all users
+
+    Returns:
+        stats (dict): n_users, n_identity_classes, n_preference_classes,
+            candidate_pairs (ordered pairs of distinct users), eligible_pairs,
+            and pruned_fraction (share of candidate_pairs that are never scored)
+    '''
+    n_users = len(classes.identity_class)
+    identity_sizes = np.array([len(m) for m in classes.identity_members], dtype=np.int64)
+    preference_sizes = np.array([len(m) for m in classes.preference_members], dtype=np.int64)
+    n_candidates = classes.accepts.astype(np.int64) @ identity_sizes
+
+    # users that accept their own identity class counted themselves as a candidate
+    self_accepted = classes.accepts[classes.preference_class, classes.identity_class].sum()
+    eligible_pairs = int(preference_sizes @ n_candidates - self_accepted)
+    candidate_pairs = n_users*(n_users - 1)
+    return {'n_users': n_users,
+            'n_identity_classes': len(identity_sizes),
+            'n_preference_classes': len(preference_sizes),
+            'candidate_pairs': candidate_pairs,
+            'eligible_pairs': eligible_pairs,
+            'pruned_fraction': 1 - eligible_pairs/candidate_pairs if candidate_pairs else 0.0}
+
+def get_rejection_counts(store, classes):
+    '''
+    Counts the (user, candidate) pairs rejected by each filter. Like filter()
+    in squad.py, filters are checked in FILTER_QUESTIONS order and a pair is
+    counted against the first one it fails. A user is never counted as their
+    own rejected candidate.
+
+    Arguments:
+        store (ResponseStore): compiled responses
+        classes (FilterClasses): filter classes of all users
+
+    Returns:
+        rejections (dict): filter name -> number of rejected pairs
+    '''
+    # a candidate's identity class determines which of a user's filters it passes
+    all_ids = np.arange(store.n_users)
+    representatives = np.array([members[0] for members in classes.identity_members], dtype=np.intp)
+    identity_sizes = np.array([len(members) for members in classes.identity_members], dtype=np.int64)
+
+    rejected = np.zeros((store.n_users, len(representatives)), dtype=bool)
+    rejections = {}
+    for name, _, _ in FILTER_QUESTIONS:
+        first_failed = ~get_question_block(store, name, all_ids, representatives) & ~rejected
+        rejected |= first_failed
+        n_self = int(first_failed[all_ids, classes.identity_class].sum())
+        rejections[name] = int((first_failed.astype(np.int64) @ identity_sizes).sum()) - n_self
+    return rejections
@@ -0,0 +1,417 @@
+import numpy as np
+from score import *
+from bitset import get_intersection_sizes, get_set_sizes
+from eligibility import get_eligibility_block, get_history_block
+
+'''
+engine.py
+---------
+Vectorized all-pairs scoring. Computes score(user_id, c_id) from squad.py for
+a whole block of (user, candidate) pairs at once with numpy broadcasting,
+reading from a compiled ResponseStore (see store.py).
+
+Every component is combined in the same order, and with the same float
+operations, as the per-pair functions in score.py, so results are
+numerically equal to score().
+'''
+
+# Number of users scored per block in get_score_matrix; bounds the size
+# of the temporary (block x N) arrays
+BLOCK_SIZE = 1024
+
+# Rough upper bound on the bytes of temporaries per (user, candidate) pair of a tile
+BYTES_PER_PAIR = 128
+
+# Default memory budget for the temporaries of tiled scoring
+MEMORY_BUDGET = 256*2**20
+
+def get_distance_sum(store, user_ids, c_ids, question_idx, offset, scale):
+    '''
+    Computes the sum of get_distance over several questions for pairs of users.
+    Sums the integer distances before dividing; this is exact (and equal to
+    summing get_distance per question) because scale is a power of two.
+
+    Arguments:
+        store (ResponseStore): compiled responses
+        user_ids (np.ndarray): ids of the users, broadcastable against c_ids
+        c_ids (np.ndarray): ids of the candidates
+        question_idx (list): likert columns to sum over
+        offset (int): see get_distance
+        scale (float): see get_distance
+
+    Returns:
+        score (np.ndarray): summed distance score of each pair
+    '''
+    total = np.zeros(np.broadcast_shapes(user_ids.shape, c_ids.shape), dtype=np.int16)
+    for q in question_idx:
+        # gathering from the column view is faster than indexing the 2-D array with a pair of indices
+        answers = store.likert[:, q]
+        total += np.abs(answers[user_ids].astype(np.int16) - answers[c_ids])
+    return (len(question_idx)*(5 + offset) - total)/scale
+
+def get_block_ids(user_ids, c_ids):
+    '''
+    Shapes user and candidate ids so the pair functions below compute a
+    block of every pair in user_ids x c_ids.
+
+    The pair functions take ids of any two broadcastable shapes: (B, 1) and
+    (1, C) ids give a (B, C) block, and two (P,) arrays give P single pairs
+    (user_ids[i], c_ids[i]).
+
+    Arguments:
+        user_ids (list or np.ndarray): ids of users (rows of the block)
+        c_ids (list or np.ndarray): ids of candidates (columns of the block)
+
+    Returns:
+        user_ids (np.ndarray): (B, 1) ids
+        c_ids (np.ndarray): (1, C) ids
+    '''
+    return np.asarray(user_ids, dtype=np.intp)[:, None], np.asarray(c_ids, dtype=np.intp)[None, :]
+
+def get_shared_components(store, user_ids, c_ids):
+    '''
+    Computes the parts of score(user_id, c_id) that are symmetric in the
+    user and the candidate (distances between answers, and sizes of answer
+    intersections), for pairs of users. The components of the reversed
+    pairs are the transposes of these (see transpose_components), so scoring
+    both directions of a pair only computes them once.
+
+    Arguments:
+        store (ResponseStore): compiled responses
+        user_ids (np.ndarray): ids of the users, broadcastable against c_ids (see get_block_ids)
+        c_ids (np.ndarray): ids of the candidates
+
+    Returns:
+        shared (dict): component name -> array of the broadcast shape of the ids
+    '''
+    u_class = store.socioeconomic[user_ids]
+    c_class = store.socioeconomic[c_ids]
+    return {'socioeconomic_distance': get_distance(u_class, c_class, -3, 2.0),
+            'socioeconomic_answered': (u_class >= 0) & (c_class >= 0),
+            'same_major': store.major[user_ids] == store.major[c_ids],
+            'same_school': (store.schools[user_ids] & store.schools[c_ids]) != 0,
+            'music_sizes': get_intersection_sizes(store.music_bits[user_ids], store.music_bits[c_ids]),
+            'enjoy_talking_sizes': get_intersection_sizes(store.enjoy_talking_bits[user_ids],
+                                                          store.enjoy_talking_bits[c_ids]),
+            'similarity_distance': get_distance_sum(store, user_ids, c_ids, SIMILARITY_QUESTION_IDX, -3, 2.0),
+            'chill_distance': get_distance(store.chill[user_ids], store.chill[c_ids], -3, 2.0),
+            'activity': get_activity_block(store, user_ids, c_ids)}
+
+def transpose_components(shared):
+    '''
+    Returns the shared components of the transposed block (see get_shared_components).
+
+    Arguments:
+        shared (dict): components of a (B, C) block
+
+    Returns:
+        shared (dict): components of the (C, B) block (transposed views)
+    '''
+    return dict((name, component.T) for name, component in shared.items())
+
+def get_socioeconomic_block(store, user_ids, shared):
+    '''
+    Vectorized get_socioeconomic_score.
+
+    Arguments:
+        store (ResponseStore): compiled responses
+        user_ids (np.ndarray): ids of the users, shaped as in shared
+        shared (dict): shared components of the pairs (see get_shared_components)
+
+    Returns:
+        score (np.ndarray): score of each pair
+    '''
+    preference = (store.likert[user_ids, SOCIOECONOMIC_PREFER_IDX] - 1)/4.0
+    scaled_score = shared['socioeconomic_distance']*preference
+    return np.where(shared['socioeconomic_answered'], scaled_score*2, 0)
+
+def get_majors_block(store, user_ids, c_ids, shared):
+    '''
+    Vectorized get_majors_score.
+
+    Arguments:
+        store (ResponseStore): compiled responses
+        user_ids (np.ndarray): ids of the users, broadcastable against c_ids
+        c_ids (np.ndarray): ids of the candidates
+        shared (dict): shared components of the pairs (see get_shared_components)
+
+    Returns:
+        score (np.ndarray): score of each pair
+    '''
+    preference = store.likert[user_ids, MAJOR_PREFER_IDX]
+    same_major = shared['same_major']
+    same_school = shared['same_school']
+    different_school = (store.schools[user_ids] & ~store.schools[c_ids]) != 0
+    other = (preference != 1) & (preference != 3) & (preference != 4) & (preference != 5)
+    is_match = (((preference == 5) & same_major) | ((preference == 1) & ~same_major) |
+                ((preference == 4) & same_school) | (other & different_school))
+    return np.where(preference == 3, 1, np.where(is_match, 2, 0))
+
+def get_intelligence_block(store, user_ids, c_ids):
+    '''
+    Vectorized get_intelligence_score.
+
+    Arguments:
+        store (ResponseStore): compiled responses
+        user_ids (np.ndarray): ids of the users, broadcastable against c_ids
+        c_ids (np.ndarray): ids of the candidates
+
+    Returns:
+        score (np.ndarray): score of each pair
+    '''
+    u_rating = store.likert[user_ids, INTELLIGENCE_IDX]
+    c_rating = store.likert[c_ids, INTELLIGENCE_IDX]
+    raw_score = np.where(u_rating <= c_rating, 1, -1)
+    preference = (store.likert[user_ids, INTELLIGENCE_PREFER_IDX] - 3)/2.0
+    scaled_score = raw_score*preference
+    return scaled_score*2
+
+def get_similarity_block(store, user_ids, shared, music):
+    '''
+    Vectorized get_similarity_score.
+
+    Arguments:
+        store (ResponseStore): compiled responses
+        user_ids (np.ndarray): ids of the users, shaped as in shared
+        shared (dict): shared components of the pairs (see get_shared_components)
+        music (np.ndarray): music score of each pair
+
+    Returns:
+        score (np.ndarray): score of each pair
+    '''
+    similarity_weight = (store.likert[user_ids, SIMILARITY_WEIGHT_IDX] - 3)/2.0
+    score = shared['similarity_distance'] + music
+    score += shared['chill_distance']
+    return score*similarity_weight
+
+def get_activity_block(store, user_ids, c_ids):
+    '''
+    Vectorized get_activity_score. The activity score is symmetric, so it is
+    one of the shared components.
+
+    Arguments:
+        store (ResponseStore): compiled responses
+        user_ids (np.ndarray): ids of the users, broadcastable against c_ids
+        c_ids (np.ndarray): ids of the candidates
+
+    Returns:
+        score (np.ndarray): score of each pair
+    '''
+    score = get_distance_sum(store, user_ids, c_ids, ACTIVITY_QUESTION_IDX, -1, 4.0)
+    score += get_distance(store.likert[user_ids, CONTACT_IDX], store.likert[c_ids, CONTACT_IDX], -1, 4.0)*2
+    score += get_distance(store.hangout[user_ids], store.hangout[c_ids], -1, 4.0)*2
+    return score
+
+def score_shared_block(store, user_ids, c_ids, shared):
+    '''
+    Computes score(user_id, c_id) for pairs of users from their shared
+    components, applying the users' own preference weights.
+
+    Arguments:
+        store (ResponseStore): compiled responses
+        user_ids (np.ndarray): ids of the users, broadcastable against c_ids (see get_block_ids)
+        c_ids (np.ndarray): ids of the candidates
+        shared (dict): shared components of the pairs (see get_shared_components)
+
+    Returns:
+        scores (np.ndarray): float64 raw score of each pair
+    '''
+    music = 1.0*shared['music_sizes']/get_set_sizes(store.music_bits[user_ids])
+    enjoy_talking = 1.0*shared['enjoy_talking_sizes']/get_set_sizes(store.enjoy_talking_bits[user_ids])*2
+
+    score = get_socioeconomic_block(store, user_ids, shared)
+    score += get_majors_block(store, user_ids, c_ids, shared)
+    score += get_intelligence_block(store, user_ids, c_ids)
+    score += enjoy_talking
+    score += get_similarity_block(store, user_ids, shared, music)
+    score += shared['activity']
+    return score
+
+def score_block(store, user_ids, c_ids):
+    '''
+    Vectorized score(user_id, c_id) for every pair in user_ids x c_ids.
+
+    Arguments:
+        store (ResponseStore): compiled responses
+        user_ids (np.ndarray): ids of users (rows of the block)
+        c_ids (np.ndarray): ids of candidates (columns of the block)
+
+    Returns:
+        scores (np.ndarray): (len(user_ids), len(c_ids)) float64 raw scores
+    '''
+    user_ids, c_ids = get_block_ids(user_ids, c_ids)
+    return score_shared_block(store, user_ids, c_ids, get_shared_components(store, user_ids, c_ids))
+
+def score_pairs(store, user_ids, c_ids):
+    '''
+    Vectorized score(user_ids[i], c_ids[i]) for arbitrary pairs of users.
+
+    Arguments:
+        store (ResponseStore): compiled responses
+        user_ids (np.ndarray): ids of the users, any shape
+        c_ids (np.ndarray): ids of the candidates, broadcastable against user_ids
+
+    Returns:
+        scores (np.ndarray): float64 raw score of each pair
+    '''
+    user_ids = np.asarray(user_ids, dtype=np.intp)
+    c_ids = np.asarray(c_ids, dtype=np.intp)
+    return score_shared_block(store, user_ids, c_ids, get_shared_components(store, user_ids, c_ids))
+
+def get_score_matrix(store, block_size=BLOCK_SIZE):
+    '''
+    Computes the full N x N raw score matrix, block_size users at a time.
+
+    Arguments:
+        store (ResponseStore): compiled responses
+        block_size (int): number of users scored per block
+
+    Returns:
+        scores (np.ndarray): (N, N) float64 matrix, scores[i, j] = score(i, j)
+    '''
+    n = store.n_users
+    c_ids = np.arange(n)
+    scores = np.empty((n, n), dtype=np.float64)
+    for start in range(0, n, block_size):
+        user_ids = np.arange(start, min(start + block_size, n))
+        scores[start:start + len(user_ids)] = score_block(store, user_ids, c_ids)
+    return scores
+
+def normalize_rows(scores, eligible, min_score=None, max_score=None):
+    '''
+    Vectorized get_normalized_map: min-max normalizes each row of scores over
+    its eligible entries, so they lie between 0 and 1. Ineligible entries are 0.
+
+    Arguments:
+        scores (np.ndarray): (B, C) raw scores
+        eligible (np.ndarray): (B, C) boolean mask of valid candidates
+        min_score (np.ndarray): optional (B,) row minimums to normalize with, if the
+            row holds only some of the user's candidates; by default the min over eligible
+        max_score (np.ndarray): optional (B,) row maximums, as above
+
+    Returns:
+        normalized (np.ndarray): (B, C) normalized scores
+    '''
+    has_candidates = eligible.any(axis=1)
+    if min_score is None:
+        min_score = np.where(eligible, scores, np.inf).min(axis=1, initial=np.inf)
+    if max_score is None:
+        max_score = np.where(eligible, scores, -np.inf).max(axis=1, initial=-np.inf)
+    score_range = max_score - min_score
+    if np.any(score_range[has_candidates] == 0):
+        raise ZeroDivisionError('float division by zero')
+    score_range = np.where(has_candidates, score_range, 1)
+    min_score = np.where(has_candidates, min_score, 0)
+    normalized = (scores - min_score[:, None])/score_range[:, None]
+    normalized[~eligible] = 0
+    return normalized
+
+def get_tile_size(n_users, memory_budget):
+    '''
+    Returns the side of the square (users x candidates) tiles that fit in memory_budget.
+
+    Arguments:
+        n_users (int): number of users
+        memory_budget (int): bytes available for the temporaries of one tile
+
+    Returns:
+        tile_size (int): number of users (and of candidates) per tile
+    '''
+    tile_size = int((memory_budget/BYTES_PER_PAIR)**0.5)
+    return max(1, min(n_users, tile_size))
+
+def get_top_k_block(store, user_ids, k, tile_size):
+    '''
+    Gets the top k normalized candidate scores for a block of users, scoring
+    tile_size candidates at a time. Only the running top k raw scores and the
+    running min/max of each user are kept between tiles; since normalization
+    preserves order, the top k raw scores are also the top k normalized scores.
+    Ties are broken towards the lower candidate id.
+
+    Arguments:
+        store (ResponseStore): compiled responses
+        user_ids (np.ndarray): ids of users in the block
+        k (int): number of candidates to keep per user
+        tile_size (int): number of candidates scored at a time
+
+    Returns:
+        top_ids (np.ndarray): (len(user_ids), k) int32 candidate ids, best first; -1 pads
+            users with fewer than k valid candidates
+        top_scores (np.ndarray): (len(user_ids), k) normalized scores of top_ids (0 for padding)
+    '''
+    user_ids = np.asarray(user_ids, dtype=np.intp)
+    n_block = len(user_ids)
+    top_ids = np.full((n_block, k), -1, dtype=np.int32)
+    top_raw = np.full((n_block, k), -np.inf)
+    min_score = np.full(n_block, np.inf)
+    max_score = np.full(n_block, -np.inf)
+
+    for start in range(0, store.n_users, tile_size):
+        c_ids = np.arange(start, min(start + tile_size, store.n_users))
+        eligible = get_eligibility_block(store, user_ids, c_ids)
+        scores = score_block(store, user_ids, c_ids)
+        min_score = np.minimum(min_score, np.where(eligible, scores, np.inf).min(axis=1))
+        max_score = np.maximum(max_score, np.where(eligible, scores, -np.inf).max(axis=1))
+
+        # merge this tile into the running top k, best score first, then lowest id
+        merged_ids = np.hstack([top_ids, np.where(eligible, c_ids[None, :], -1).astype(np.int32)])
+        merged_raw = np.hstack([top_raw, np.where(eligible, scores, -np.inf)])
+        padding = merged_ids < 0
+        order = np.lexsort((np.where(padding, store.n_users, merged_ids), -merged_raw), axis=1)[:, :k]
+        top_ids = np.take_along_axis(merged_ids, order, axis=1)
+        top_raw = np.take_along_axis(merged_raw, order, axis=1)
+
+    valid = top_ids >= 0
+    top_scores = normalize_rows(top_raw, valid, min_score, max_score)
+    return top_ids, top_scores
+
+def get_top_k_scores(store, k, memory_budget=MEMORY_BUDGET):
+    '''
+    Gets the top k normalized candidate scores of every user with tiled scoring,
+    so peak memory depends on memory_budget and k rather than on N x N.
+
+    Arguments:
+        store (ResponseStore): compiled responses
+        k (int): number of candidates to keep per user
+        memory_budget (int): bytes available for the temporaries of one tile
+
+    Returns:
+        top_ids (np.ndarray): (N, k) int32 candidate ids per user, best first, -1 padded
+        top_scores (np.ndarray): (N, k) normalized scores of top_ids
+    '''
+    n = store.n_users
+    tile_size = get_tile_size(n, memory_budget)
+    top_ids = np.full((n, k), -1, dtype=np.int32)
+    top_scores = np.zeros((n, k))
+    for start in range(0, n, tile_size):
+        user_ids = np.arange(start, min(start + tile_size, n))
+        top_ids[user_ids], top_scores[user_ids] = get_top_k_block(store, user_ids, k, tile_size)
+    return top_ids, top_scores
+
+def get_class_candidates(store, classes, block_size=BLOCK_SIZE):
+    '''
+    Scores every user against only their valid candidates: users in the same
+    filter preference class (see FilterClasses in eligibility.py) share their
+    candidates, so each class is scored as dense blocks of members x candidates,
+    and pairs ruled out by the filters are never scored. Pairs excluded by the
+    pair history (see history.py) are dropped from the blocks.
+
+    Arguments:
+        store (ResponseStore): compiled responses
+        classes (FilterClasses): filter classes of all users
+        block_size (int): number of class members scored per block
+
+    Returns:
+        candidates (list): per user, (ids, scores) arrays of their valid candidates
+            (sorted by id) and normalized scores
+    '''
+    candidates = [None] * store.n_users
+    for preference_class, members in enumerate(classes.preference_members):
+        c_ids = classes.get_candidates(preference_class)
+        for start in range(0, len(members), block_size):
+            user_ids = members[start:start + block_size]
+            eligible = (user_ids[:, None] != c_ids[None, :]) & get_history_block(store, user_ids, c_ids)
+            normalized = normalize_rows(score_block(store, user_ids, c_ids), eligible)
+            for row, user_id in enumerate(user_ids.tolist()):
+                candidates[user_id] = (c_ids[eligible[row]], normalized[row, eligible[row]])
+    return candidates
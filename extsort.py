@@ -0,0 +1,171 @@
+import os
+import heapq
+import shutil
+import tempfile
+import numpy as np
+from pairing import assign_matches_from_pairs
+
+'''
+extsort.py
+----------
+External-memory matching, for edge sets that don't fit in memory. Edges
+are streamed in from the scorer (see iterate_fused_edges in fused.py) and
+buffered up to a memory budget; each full buffer is sorted and written to
+a temporary file as a binary run. The runs are then merged with a k-way
+heap merge, which streams the edges in decreasing score order straight
+into the greedy assignment, so the sorted edge list is never in memory.
+
+Runs are sorted by (-score, user1, user2) and merged on the same key, so
+edges come out in exactly the order (and with the same tie-breaking) as
+sort_edges in pairing.py, and the matches are the same as in memory.
+'''
+
+# Record of one edge in a run file
+EDGE_DTYPE = np.dtype([('user1', '<i4'), ('user2', '<i4'), ('score', '<f8')])
+
+# Rough upper bound on the bytes per buffered edge while a run is sorted
+BYTES_PER_EDGE = 64
+
+# Number of edges read from each run file at a time during the merge
+READ_CHUNK_EDGES = 2**16
+
+def get_run_edges(memory_budget):
+    '''
+    Returns the number of edges per run that fits in a memory budget.
+
+    Arguments:
+        memory_budget (int): bytes available for buffering and sorting a run
+
+    Returns:
+        run_edges (int): edges per run, at least 1
+    '''
+    return max(1, memory_budget//BYTES_PER_EDGE)
+
+def write_run(path, edge_u, edge_v, edge_scores):
+    '''
+    Sorts edges by (-score, user1, user2) and writes them to a run file.
+
+    Arguments:
+        path (string): destination file
+        edge_u (np.ndarray): first user of each edge
+        edge_v (np.ndarray): second user of each edge
+        edge_scores (np.ndarray): match score S of each edge
+
+    Returns:
+        None
+    '''
+    order = np.lexsort((edge_v, edge_u, -edge_scores))
+    run = np.empty(len(order), dtype=EDGE_DTYPE)
+    run['user1'] = edge_u[order]
+    run['user2'] = edge_v[order]
+    run['score'] = edge_scores[order]
+    run.tofile(path)
+
+def write_sorted_runs(edges, run_dir, run_edges):
+    '''
+    Buffers a stream of edges into sorted run files of run_edges edges each
+    (the last one may be shorter); blocks are split across runs as needed.
+
+    Arguments:
+        edges (iterable): (edge_u, edge_v, edge_scores) arrays, in any order
+        run_dir (string): directory to write the runs to
+        run_edges (int): edges per run
+
+    Returns:
+        run_paths (list): paths of the run files
+        n_edges (int): total number of edges
+    '''
+    run_paths = []
+    buffered = []
+    n_buffered = n_edges = 0
+    for block in edges:
+        n_edges += len(block[0])
+        start = 0
+        while start < len(block[0]):
+            end = start + run_edges - n_buffered
+            buffered.append(tuple(array[start:end] for array in block))
+            n_buffered += len(buffered[-1][0])
+            start = end
+            if n_buffered >= run_edges:
+                run_paths.append(flush_run(run_dir, len(run_paths), buffered))
+                buffered, n_buffered = [], 0
+    if n_buffered:
+        run_paths.append(flush_run(run_dir, len(run_paths), buffered))
+    return run_paths, n_edges
+
+def flush_run(run_dir, run_index, buffered):
+    '''
+    Writes buffered edge blocks as one sorted run.
+
+    Arguments:
+        run_dir (string): directory to write the run to
+        run_index (int): number of the run
+        buffered (list): (edge_u, edge_v, edge_scores) arrays
+
+    Returns:
+        path (string): path of the run file
+    '''
+    path = os.path.join(run_dir, 'run-%05d.bin' % run_index)
+    edge_u, edge_v, edge_scores = [np.concatenate(arrays) for arrays in zip(*buffered)]
+    write_run(path, edge_u, edge_v, edge_scores)
+    return path
+
+def iterate_run(path, chunk_edges=READ_CHUNK_EDGES):
+    '''
+    Streams the edges of a run file, chunk_edges at a time.
+
+    Arguments:
+        path (string): run file
+        chunk_edges (int): number of edges read at a time
+
+    Returns:
+        edges (generator): (-score, user1, user2) tuples, in run order
+    '''
+    with open(path, 'rb') as f:
+        while True:
+            chunk = np.fromfile(f, dtype=EDGE_DTYPE, count=chunk_edges)
+            if not len(chunk):
+                return
+            yield from zip((-chunk['score']).tolist(), chunk['user1'].tolist(), chunk['user2'].tolist())
+
+def merge_runs(run_paths):
+    '''
+    Merges sorted runs into one stream of edges in decreasing score order.
+
+    Arguments:
+        run_paths (list): run files
+
+    Returns:
+        pairs (generator): (user1, user2) of each edge, best first
+    '''
+    for _, user1, user2 in heapq.merge(*[iterate_run(path) for path in run_paths]):
+        yield user1, user2
+
+def assign_matches_external(edges, n_users, min_matches, match_threshold, memory_budget, run_dir=None):
+    '''
+    Greedily assigns matches from a stream of unsorted edges, sorting them
+    out of core (see module docstring).
+
+    Arguments:
+        edges (iterable): (edge_u, edge_v, edge_scores) arrays, in any order
+        n_users (int): number of users
+        min_matches (int): see assign_matches in pairing.py
+        match_threshold (int): see assign_matches in pairing.py
+        memory_budget (int): bytes available for buffering and sorting a run
+        run_dir (string): parent directory of the temporary run files; None for the system default
+
+    Returns:
+        match_pairs (list): matches as tuples of user ids, in assignment order
+        match_cnts (list): match_cnts[i] = number of matches of user i
+        stats (dict): edges, runs and greedy iterations
+    '''
+    temp_dir = tempfile.mkdtemp(prefix='squad_runs_', dir=run_dir)
+    try:
+        run_paths, n_edges = write_sorted_runs(edges, temp_dir, get_run_edges(memory_budget))
+        merged = merge_runs(run_paths)
+        match_pairs, match_cnts, n_iterations = assign_matches_from_pairs(merged, n_users, min_matches,
+                                                                          match_threshold)
+        merged.close()
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    return match_pairs, match_cnts, {'edges': n_edges, 'runs': len(run_paths), 'greedy_iterations': n_iterations}
@@ -0,0 +1,304 @@
+import numpy as np
+from engine import BLOCK_SIZE, get_shared_components, score_shared_block
+from eligibility import get_eligibility_block, get_filter_classes
+from pairing import exp
+
+'''
+fused.py
+--------
+Fused mutual-edge kernel: builds the sorted mutual edges (see pairing.py)
+straight from the compiled responses, without materializing either user's
+candidate scores.
+
+Users are split into blocks in filter class order (see FilterClasses in
+eligibility.py), and pairs of blocks whose users rule each other out in both
+directions are skipped without scoring them. Every other unordered pair of
+users is visited once, and only the directions of a pair that pass the
+filters are scored, as in the per-user path. The symmetric components of
+the pairs (see get_shared_components in engine.py) are computed once, and
+the valid directions are scored from them with each side's own preference
+weights. While
+visiting, each user's min/max raw score over their valid candidates is
+accumulated, and the raw scores of both directions are kept for mutual
+pairs only. Once every block has been visited, the kept scores are
+normalized with the final min/max and combined into
+
+    S(A, B) = exp(A's score for B) + exp(B's score for A)
+
+All floats are computed the same way as in the per-user path, so the edges
+(and their tie order) are identical to get_mutual_edges + sort_edges.
+
+iterate_fused_edges streams the edges instead, for edge sets that don't fit
+in memory (see extsort.py); it visits the blocks twice, since the min/max
+must be final before any edge can be scored.
+'''
+
+def get_block_pair_edges(store, user_ids, c_ids, diagonal):
+    '''
+    Scores both directions of every pair in user_ids x c_ids, but only the
+    directions that pass the filters: the other entries are left at 0, and
+    pairs ruled out both ways are never scored.
+
+    Arguments:
+        store (ResponseStore): compiled responses
+        user_ids (np.ndarray): ids of the first block
+        c_ids (np.ndarray): ids of the second block
+        diagonal (boolean): whether both blocks are the same block
+
+    Returns:
+        forward (np.ndarray): (len(user_ids), len(c_ids)) raw scores of users for candidates
+        forward_eligible (np.ndarray): (len(user_ids), len(c_ids)) valid candidates of users
+        backward (np.ndarray): (len(c_ids), len(user_ids)) raw scores of candidates for users
+        backward_eligible (np.ndarray): (len(c_ids), len(user_ids)) valid candidates of candidates
+    '''
+    forward_eligible = get_eligibility_block(store, user_ids, c_ids)
+    backward_eligible = forward_eligible if diagonal else get_eligibility_block(store, c_ids, user_ids)
+    forward = np.zeros(forward_eligible.shape)
+    backward = forward if diagonal else np.zeros(backward_eligible.shape)
+
+    # the symmetric components of a pair are computed once for both of its valid directions;
+    # on the diagonal block, (row, col) and (col, row) are the same pair
+    backward_pairs = backward_eligible.T
+    for forward_valid, backward_valid in [(True, True), (True, False), (False, True)]:
+        pairs = (forward_eligible == forward_valid) & (backward_pairs == backward_valid)
+        rows, cols = np.nonzero(np.triu(pairs, 1) if diagonal else pairs)
+        u, c = user_ids[rows], c_ids[cols]
+        shared = get_shared_components(store, u, c)
+        if forward_valid:
+            forward[rows, cols] = score_shared_block(store, u, c, shared)
+        if backward_valid:
+            backward[cols, rows] = score_shared_block(store, c, u, shared)
+    return forward, forward_eligible, backward, backward_eligible
+
+def get_pairs_scored(user_ids, c_ids, diagonal, forward, forward_eligible, backward, backward_eligible):
+    '''
+    Counts the (user, candidate) pairs get_block_pair_edges scored for a block pair.
+
+    Arguments:
+        user_ids, c_ids, diagonal, forward, forward_eligible, backward, backward_eligible:
+            a block pair, as yielded by iterate_block_pairs
+
+    Returns:
+        n_pairs (int): number of valid (user, candidate) pairs in the block pair
+    '''
+    n_pairs = int(forward_eligible.sum())
+    return n_pairs if diagonal else n_pairs + int(backward_eligible.sum())
+
+def update_min_max(min_score, max_score, ids, scores, eligible):
+    '''
+    Folds a block of raw scores into the running min/max of its rows' users.
+
+    Arguments:
+        min_score (np.ndarray): (N,) running min over valid candidates, updated in place
+        max_score (np.ndarray): (N,) running max over valid candidates, updated in place
+        ids (np.ndarray): ids of the block's rows
+        scores (np.ndarray): (len(ids), C) raw scores
+        eligible (np.ndarray): (len(ids), C) valid candidates
+
+    Returns:
+        None
+    '''
+    min_score[ids] = np.minimum(min_score[ids], np.where(eligible, scores, np.inf).min(axis=1, initial=np.inf))
+    max_score[ids] = np.maximum(max_score[ids], np.where(eligible, scores, -np.inf).max(axis=1, initial=-np.inf))
+
+class ScoreRanges:
+    '''
+    Running min/max raw score of every user over their valid candidates.
+
+    Attributes:
+        min_score (np.ndarray): (N,) min over valid candidates seen so far
+        max_score (np.ndarray): (N,) max over valid candidates seen so far
+        has_candidates (np.ndarray): (N,) whether any valid candidate was seen
+    '''
+    def __init__(self, n_users):
+        self.min_score = np.full(n_users, np.inf)
+        self.max_score = np.full(n_users, -np.inf)
+        self.has_candidates = np.zeros(n_users, dtype=bool)
+
+    def update(self, user_ids, c_ids, diagonal, forward, forward_eligible, backward, backward_eligible):
+        '''
+        Folds both directions of a block pair into the running min/max.
+
+        Arguments:
+            user_ids, c_ids, diagonal, forward, forward_eligible, backward, backward_eligible:
+                a block pair, as yielded by iterate_block_pairs
+
+        Returns:
+            None
+        '''
+        update_min_max(self.min_score, self.max_score, user_ids, forward, forward_eligible)
+        self.has_candidates[user_ids] |= forward_eligible.any(axis=1)
+        if not diagonal:
+            update_min_max(self.min_score, self.max_score, c_ids, backward, backward_eligible)
+            self.has_candidates[c_ids] |= backward_eligible.any(axis=1)
+
+    def get_range(self):
+        '''
+        Returns the score range of every user, like get_normalized_map raising
+        ZeroDivisionError if a user's valid candidates all score the same.
+
+        Arguments:
+            None
+
+        Returns:
+            score_range (np.ndarray): (N,) max - min score of each user
+        '''
+        score_range = self.max_score - self.min_score
+        if np.any(score_range[self.has_candidates] == 0):
+            raise ZeroDivisionError('float division by zero')
+        return score_range
+
+def get_filter_blocks(classes, block_size=BLOCK_SIZE):
+    '''
+    Splits the users into blocks in filter class order, so users that filter
+    alike share blocks.
+
+    Arguments:
+        classes (FilterClasses): filter classes of all users
+        block_size (int): number of users per block
+
+    Returns:
+        blocks (list): sorted user ids of each block
+        needed (np.ndarray): (B, B) boolean matrix; False iff no user of either
+            block passes the filters of any user of the other
+    '''
+    order = np.lexsort([classes.preference_class, classes.identity_class])
+    blocks = [np.sort(order[start:start + block_size]) for start in range(0, len(order), block_size)]
+    identities = [np.unique(classes.identity_class[ids]) for ids in blocks]
+    preferences = [np.unique(classes.preference_class[ids]) for ids in blocks]
+    accepts = np.array([[classes.accepts[np.ix_(prefs, idents)].any() for idents in identities]
+                        for prefs in preferences], dtype=bool).reshape(len(blocks), len(blocks))
+    return blocks, accepts | accepts.T
+
+def iterate_block_pairs(store, block_size=BLOCK_SIZE, classes=None):
+    '''
+    Visits every unordered pair of users once, in blocks, scoring both
+    directions. Pairs of blocks whose users rule each other out (see
+    get_filter_blocks) are skipped without scoring them.
+
+    Arguments:
+        store (ResponseStore): compiled responses
+        block_size (int): number of users per block
+        classes (FilterClasses): filter classes of all users, or None to compute them
+
+    Returns:
+        block_pairs (generator): (user_ids, c_ids, diagonal, forward, forward_eligible,
+            backward, backward_eligible) tuples (see get_block_pair_edges); diagonal
+            iff c_ids is user_ids
+    '''
+    if classes is None:
+        classes = get_filter_classes(store)
+    blocks, needed = get_filter_blocks(classes, block_size)
+    for bi, user_ids in enumerate(blocks):
+        for bj in np.flatnonzero(needed[bi, bi:]) + bi:
+            c_ids = blocks[bj]
+            diagonal = bi == bj
+            yield (user_ids, c_ids, diagonal) + get_block_pair_edges(store, user_ids, c_ids, diagonal)
+
+def get_mutual_block(user_ids, c_ids, diagonal, forward, forward_eligible, backward, backward_eligible):
+    '''
+    Finds the mutual pairs of a block pair.
+
+    Arguments:
+        user_ids, c_ids, diagonal, forward, forward_eligible, backward, backward_eligible:
+            a block pair, as yielded by iterate_block_pairs
+
+    Returns:
+        edge_u (np.ndarray): first user of each mutual pair
+        edge_v (np.ndarray): second user of each mutual pair, edge_u < edge_v
+        forward_raw (np.ndarray): raw score of edge_u for edge_v
+        backward_raw (np.ndarray): raw score of edge_v for edge_u
+    '''
+    # mutual pairs (u, v) with u < v; on the diagonal block, u < v is the upper triangle
+    mutual = forward_eligible & backward_eligible.T
+    if diagonal:
+        mutual &= user_ids[:, None] < c_ids[None, :]
+    rows, cols = np.nonzero(mutual)
+    edge_u, edge_v, forward_raw, backward_raw = user_ids[rows], c_ids[cols], forward[rows, cols], backward[cols, rows]
+
+    # blocks in filter class order aren't in id order, so edges are turned around where needed
+    reverse = edge_v < edge_u
+    return (np.where(reverse, edge_v, edge_u), np.where(reverse, edge_u, edge_v),
+            np.where(reverse, backward_raw, forward_raw), np.where(reverse, forward_raw, backward_raw))
+
+def get_edge_scores(edge_u, edge_v, forward_raw, backward_raw, min_score, score_range):
+    '''
+    Normalizes the raw scores of mutual pairs and combines them into match scores S.
+
+    Arguments:
+        edge_u (np.ndarray): first user of each edge
+        edge_v (np.ndarray): second user of each edge
+        forward_raw (np.ndarray): raw score of edge_u for edge_v
+        backward_raw (np.ndarray): raw score of edge_v for edge_u
+        min_score (np.ndarray): (N,) min score of every user
+        score_range (np.ndarray): (N,) score range of every user
+
+    Returns:
+        edge_scores (np.ndarray): float64 match score S of each edge
+    '''
+    forward_normalized = (forward_raw - min_score[edge_u])/score_range[edge_u]
+    backward_normalized = (backward_raw - min_score[edge_v])/score_range[edge_v]
+    return exp(forward_normalized) + exp(backward_normalized)
+
+def get_fused_edges(store, block_size=BLOCK_SIZE, ranges=None, classes=None):
+    '''
+    Builds the mutual edges of all users, sorted by decreasing match score S
+    (see module docstring).
+
+    Arguments:
+        store (ResponseStore): compiled responses
+        block_size (int): number of users per block
+        ranges (ScoreRanges): receives every user's min/max raw score, if given
+        classes (FilterClasses): filter classes of all users, or None to compute them
+
+    Returns:
+        edge_u (np.ndarray): int64 first user of each edge, best edge first
+        edge_v (np.ndarray): int64 second user of each edge, edge_u < edge_v
+        edge_scores (np.ndarray): float64 match score S of each edge
+        n_pairs (int): number of (user, candidate) pairs scored
+    '''
+    if ranges is None:
+        ranges = ScoreRanges(store.n_users)
+    blocks = []
+    n_pairs = 0
+    for block_pair in iterate_block_pairs(store, block_size, classes):
+        n_pairs += get_pairs_scored(*block_pair)
+        ranges.update(*block_pair)
+        blocks.append(get_mutual_block(*block_pair))
+    score_range = ranges.get_range()
+
+    if not blocks:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0), n_pairs
+    edge_u, edge_v, forward_raw, backward_raw = [np.concatenate(arrays) for arrays in zip(*blocks)]
+    edge_u, edge_v = edge_u.astype(np.int64), edge_v.astype(np.int64)
+    edge_scores = get_edge_scores(edge_u, edge_v, forward_raw, backward_raw, ranges.min_score, score_range)
+
+    # decreasing score, ties in (user1, user2) order, as sort_edges orders get_mutual_edges' output
+    order = np.lexsort((edge_v, edge_u, -edge_scores))
+    return edge_u[order], edge_v[order], edge_scores[order], n_pairs
+
+def iterate_fused_edges(store, block_size=BLOCK_SIZE, classes=None):
+    '''
+    Streams the mutual edges of all users one block pair at a time, in no
+    particular order, holding only one block pair's edges in memory. Every
+    block pair is scored twice: a first pass gathers each user's min/max
+    score, which the match scores of the second pass are normalized with.
+
+    Arguments:
+        store (ResponseStore): compiled responses
+        block_size (int): number of users per block
+        classes (FilterClasses): filter classes of all users, or None to compute them
+
+    Returns:
+        edges (generator): (edge_u, edge_v, edge_scores) arrays per block pair, as in get_fused_edges
+    '''
+    if classes is None:
+        classes = get_filter_classes(store)
+    ranges = ScoreRanges(store.n_users)
+    for block_pair in iterate_block_pairs(store, block_size, classes):
+        ranges.update(*block_pair)
+    score_range = ranges.get_range()
+    for block_pair in iterate_block_pairs(store, block_size, classes):
+        edge_u, edge_v, forward_raw, backward_raw = get_mutual_block(*block_pair)
+        edge_u, edge_v = edge_u.astype(np.int64), edge_v.astype(np.int64)
+        yield edge_u, edge_v, get_edge_scores(edge_u, edge_v, forward_raw, backward_raw, ranges.min_score, score_range)
@@ -0,0 +1,151 @@
+import os
+import csv
+import random
+import argparse
+from score import *
+from eligibility import ANY_PREFERENCE
+from ingest import get_header
+
+'''
+generate_responses.py
+---------------------
+Generates synthetic questionnaire responses with the same columns as the
+real form export (see indices.txt), for testing and benchmarking at sizes
+we don't have real data for. 1-5 questions get values 1-5, category
+questions get the strings score.py expects, and multi-select and
+preference questions get comma-separated lists.
+
+Usage:
+    python generate_responses.py 10000 Synthetic_Responses.csv --seed 0
+'''
+
+GENDERS = ['Male', 'Female', 'Non-binary', 'Prefer not to say']
+RELIGIONS = ['Christianity', 'Judaism', 'Islam', 'Hinduism', 'Buddhism', 'Atheism', 'Agnosticism', 'Other']
+PARTIES = ['Democrat', 'Republican', 'Independent', 'Libertarian', 'None']
+OTHER_MAJORS = ['Economics', 'English', 'History', 'Psychology', 'Mechanical Engineering',
+                'Electrical Engineering', 'CS + Linguistics', 'International Relations', 'Undeclared']
+MUSIC = ['Pop', 'Rock', 'Hip Hop', 'Rap', 'R&B', 'Jazz', 'Classical', 'Country', 'EDM', 'Indie', 'K-Pop', 'Folk']
+TOPICS = ['Politics', 'Sports', 'Movies and TV', 'Books', 'Technology', 'Food', 'Travel', 'Music',
+          'Science', 'Art', 'Philosophy', 'Relationships', 'Current events', 'Fashion']
+FIRST_NAMES = ['alex', 'sam', 'jordan', 'taylor', 'morgan', 'casey', 'riley', 'jamie', 'avery', 'quinn',
+               'maria', 'wei', 'priya', 'kofi', 'lena', 'omar', 'yuki', 'diego', 'nina', 'arjun']
+LAST_NAMES = ['smith', 'nguyen', 'garcia', 'kim', 'patel', 'chen', 'johnson', 'williams', 'brown',
+              'lopez', 'okafor', 'cohen', 'tanaka', 'silva', 'muller', 'rossi']
+
+# Probability that a preference question is answered with ANY_PREFERENCE
+ANY_PREFERENCE_PROBABILITY = 0.6
+
+def get_preference(rng, options, identity):
+    '''
+    Generates a preference answer: either ANY_PREFERENCE, or a list of
+    options that usually includes the respondent's own identity.
+
+    Arguments:
+        rng (random.Random): random number generator
+        options (list): possible identity answers
+        identity (string): respondent's own identity answer
+
+    Returns:
+        preference (string): comma-separated preference answer
+    '''
+    if rng.random() < ANY_PREFERENCE_PROBABILITY:
+        return ANY_PREFERENCE
+    chosen = set(rng.sample(options, rng.randint(1, len(options))))
+    if rng.random() < 0.8:
+        chosen.add(identity)
+    return ', '.join(o for o in options if o in chosen)
+
+def get_rating(rng):
+    '''
+    Generates a 1-5 answer, slightly favouring the middle of the scale.
+
+    Arguments:
+        rng (random.Random): random number generator
+
+    Returns:
+        rating (int): answer between 1 and 5
+    '''
+    return rng.choice([1, 2, 2, 3, 3, 3, 4, 4, 5])
+
+def generate_response(rng, user_id, n_columns):
+    '''
+    Generates one synthetic response row.
+
+    Arguments:
+        rng (random.Random): random number generator
+        user_id (int): index of the response, used to make names and emails unique
+        n_columns (int): number of columns in the csv
+
+    Returns:
+        row (list): csv row of strings
+    '''
+    row = [''] * n_columns
+    first_name = rng.choice(FIRST_NAMES)
+    last_name = '%s%d' % (rng.choice(LAST_NAMES), user_id)
+    email = '%s.%s@example.edu' % (first_name, last_name)
+    row[0] = '11/%d/2018 12:%02d:%02d' % (rng.randint(1, 20), rng.randint(0, 59), rng.randint(0, 59))
+    row[1] = email
+    row[2] = first_name
+    row[3] = last_name
+    row[4] = email
+    row[5] = str(rng.choice([2019, 2020, 2021, 2022]))
+
+    for options, identity_idx in [(GENDERS, 6), (RELIGIONS, 8), (PARTIES, 10)]:
+        identity = rng.choice(options)
+        row[identity_idx] = identity
+        row[identity_idx + 1] = get_preference(rng, options, identity)
+
+    # socioeconomic background is optional
+    row[SOCIOECONOMIC_IDX] = rng.choice(list(CLASS_IDX) + [''])
+    row[MAJOR_IDX] = rng.choice(list(SCHOOL_IDX) + OTHER_MAJORS)
+    for idx in LIKERT_IDX:
+        row[idx] = str(get_rating(rng))
+    row[HANGOUT_IDX] = rng.choice(list(HANGOUT_CATEGORY_IDX))
+    row[CHILL_IDX] = rng.choice(list(CHILL_CATEGORY_IDX))
+    row[MUSIC_IDX] = ', '.join(rng.sample(MUSIC, rng.randint(1, 5)))
+    row[ENJOY_TALKING_IDX] = ', '.join(rng.sample(TOPICS, 3))
+    if rng.random() < 0.7:
+        row[46] = 'Hi! I like %s and %s.' % (rng.choice(MUSIC).lower(), rng.choice(TOPICS).lower())
+    row[47] = str(rng.choice([80, 90, 95, 100]))
+    return row
+
+def generate_responses(n_users, seed=0):
+    '''
+    Generates synthetic response rows.
+
+    Arguments:
+        n_users (int): number of responses
+        seed (int): random seed; the same seed always gives the same responses
+
+    Returns:
+        rows (generator): csv rows of strings, without the header
+    '''
+    rng = random.Random(seed)
+    n_columns = len(get_header())
+    for user_id in range(n_users):
+        yield generate_response(rng, user_id, n_columns)
+
+def write_responses_csv(path, n_users, seed=0):
+    '''
+    Writes a synthetic responses csv, with header.
+
+    Arguments:
+        path (string): destination csv
+        n_users (int): number of responses
+        seed (int): random seed
+
+    Returns:
+        None
+    '''
+    with open(path, mode='w', newline='') as f:
+        csv_writer = csv.writer(f, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+        csv_writer.writerow(get_header())
+        csv_writer.writerows(generate_responses(n_users, seed))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate synthetic Squad questionnaire responses.')
+    parser.add_argument('n_users', type=int, help='number of responses')
+    parser.add_argument('path', help='destination csv')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    args = parser.parse_args()
+    write_responses_csv(args.path, args.n_users, args.seed)
@@ -0,0 +1,229 @@
+import os
+import re
+import csv
+import glob
+import hashlib
+import argparse
+import numpy as np
+
+'''
+history.py
+----------
+Persistent history of the pairs matched in earlier rounds, so later rounds
+don't match the same people again.
+
+Users are identified across rounds by their email (stripped, lowercased),
+hashed to a 64-bit identity key. Each round is one file in the history
+directory, round-<name>.npy, holding the round's pairs as an (n, 2) uint64
+array of identity keys, sorted and without duplicates. Appending a round
+writes only that round's file, and recording a round again replaces it,
+so rerunning a round is idempotent.
+
+Before matching, the pairs of every other round are mapped to the current
+users in bulk (a binary search of both columns among the current users'
+sorted keys), giving the excluded pairs as a sorted array of int64 keys
+user_id*N + c_id, in both directions. The filters then treat an excluded
+pair like any other invalid candidate (see get_history_block in
+eligibility.py), so it is never scored or matched. This is linear in the
+history and takes a couple of seconds for millions of pairs.
+
+Usage:
+    python history.py --add Results.csv --round 2026-fall
+    python history.py --list
+'''
+
+# Default history directory
+HISTORY_DIR = 'Pair_history'
+
+# Allowed round names (they are part of a file name)
+ROUND_NAME_PATTERN = re.compile(r'^[A-Za-z0-9_.-]+$')
+
+def get_identity_keys(emails):
+    '''
+    Hashes emails to the 64-bit keys that identify users across rounds.
+
+    Arguments:
+        emails (list): email of each user
+
+    Returns:
+        keys (np.ndarray): uint64 key of each email
+    '''
+    return np.array([int.from_bytes(hashlib.blake2b(email.strip().lower().encode('utf-8'), digest_size=8).digest(),
+                                    'little') for email in emails], dtype=np.uint64)
+
+def get_pair_keys(keys1, keys2):
+    '''
+    Builds the sorted, deduplicated pairs of a round from the identity keys of both users.
+
+    Arguments:
+        keys1 (np.ndarray): uint64 identity key of the first user of each pair
+        keys2 (np.ndarray): uint64 identity key of the second user of each pair
+
+    Returns:
+        pairs (np.ndarray): (n, 2) uint64 (smaller key, larger key) of each distinct pair, sorted
+    '''
+    keys1 = np.asarray(keys1, dtype=np.uint64)
+    keys2 = np.asarray(keys2, dtype=np.uint64)
+    pairs = np.stack([np.minimum(keys1, keys2), np.maximum(keys1, keys2)], axis=1)
+    pairs = pairs[pairs[:, 0] != pairs[:, 1]]
+    pairs = pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]
+    distinct = np.ones(len(pairs), dtype=bool)
+    distinct[1:] = np.any(pairs[1:] != pairs[:-1], axis=1)
+    return pairs[distinct]
+
+def get_round_path(history_dir, round_name):
+    '''
+    Returns the file of a round.
+
+    Arguments:
+        history_dir (string): history directory
+        round_name (string): name of the round
+
+    Returns:
+        path (string): path of the round's .npy file
+    '''
+    if not ROUND_NAME_PATTERN.match(round_name):
+        raise ValueError('invalid round name %r: use letters, digits, _ . and -' % round_name)
+    return os.path.join(history_dir, 'round-%s.npy' % round_name)
+
+def list_rounds(history_dir):
+    '''
+    Lists the rounds of a history.
+
+    Arguments:
+        history_dir (string): history directory
+
+    Returns:
+        round_names (list): names of the rounds, sorted
+    '''
+    paths = glob.glob(os.path.join(history_dir, 'round-*.npy'))
+    return sorted(os.path.basename(path)[len('round-'):-len('.npy')] for path in paths)
+
+def save_round(history_dir, round_name, emails1, emails2):
+    '''
+    Records the pairs of a round, replacing any earlier record of the same round.
+
+    Arguments:
+        history_dir (string): history directory, created if needed
+        round_name (string): name of the round
+        emails1 (list): email of the first user of each pair
+        emails2 (list): email of the second user of each pair
+
+    Returns:
+        n_pairs (int): number of distinct pairs recorded
+    '''
+    pairs = get_pair_keys(get_identity_keys(emails1), get_identity_keys(emails2))
+    path = get_round_path(history_dir, round_name)
+    os.makedirs(history_dir, exist_ok=True)
+    with open(path + '.tmp', 'wb') as f:
+        np.save(f, pairs)
+    os.replace(path + '.tmp', path)
+    return len(pairs)
+
+def load_history(history_dir, skip_round=None):
+    '''
+    Loads the pairs of every round of a history.
+
+    Arguments:
+        history_dir (string): history directory; a missing directory is an empty history
+        skip_round (string): name of a round to leave out, or None
+
+    Returns:
+        pairs (np.ndarray): (n, 2) uint64 identity keys of the pairs of all rounds
+    '''
+    rounds = [np.load(get_round_path(history_dir, name), mmap_mode='r')
+              for name in list_rounds(history_dir) if name != skip_round]
+    if not rounds:
+        return np.zeros((0, 2), dtype=np.uint64)
+    return np.concatenate(rounds)
+
+def get_excluded_keys(pairs, user_keys):
+    '''
+    Maps history pairs to the current users.
+
+    Arguments:
+        pairs (np.ndarray): (n, 2) uint64 identity keys of the history pairs
+        user_keys (np.ndarray): uint64 identity key of each current user
+
+    Returns:
+        excluded_keys (np.ndarray): sorted, distinct int64 keys user_id*N + c_id of
+            the pairs of current users matched before, in both directions
+    '''
+    n = len(user_keys)
+    order = np.argsort(user_keys, kind='stable')
+    sorted_keys = user_keys[order]
+    starts = np.searchsorted(sorted_keys, pairs, side='left')
+    present = np.all(sorted_keys[np.minimum(starts, n - 1)] == pairs, axis=1) if n else np.zeros(len(pairs), dtype=bool)
+    starts = starts[present]
+
+    # a user may have responded more than once; every response with the email is excluded
+    if np.any(sorted_keys[1:] == sorted_keys[:-1]):
+        ends = np.searchsorted(sorted_keys, pairs[present], side='right')
+    else:
+        ends = starts + 1
+    single = np.all(ends - starts == 1, axis=1)
+    excluded = [(order[starts[single, 0]], order[starts[single, 1]])]
+    for (start1, start2), (end1, end2) in zip(starts[~single].tolist(), ends[~single].tolist()):
+        ids1, ids2 = order[start1:end1], order[start2:end2]
+        excluded.append((np.repeat(ids1, len(ids2)), np.tile(ids2, len(ids1))))
+    ids1, ids2 = [np.concatenate(arrays).astype(np.int64) for arrays in zip(*excluded)]
+    keys = np.concatenate([ids1*n + ids2, ids2*n + ids1])
+    keys.sort()
+    distinct = np.ones(len(keys), dtype=bool)
+    distinct[1:] = keys[1:] != keys[:-1]
+    return keys[distinct]
+
+def get_history_digest(excluded_keys):
+    '''
+    Digests the excluded pairs, for the keys of caches and match states that depend on them.
+
+    Arguments:
+        excluded_keys (np.ndarray): excluded pair keys (see get_excluded_keys)
+
+    Returns:
+        digest (string): sha256 hex digest of the keys, or None if no pair is excluded
+    '''
+    if not len(excluded_keys):
+        return None
+    return hashlib.sha256(np.ascontiguousarray(excluded_keys, dtype=np.int64).tobytes()).hexdigest()
+
+def read_results_emails(results_csv):
+    '''
+    Reads the emails of the pairs of a results csv (see format_and_save in squad.py).
+
+    Arguments:
+        results_csv (string): results csv
+
+    Returns:
+        emails1 (list): email of the first user of each pair
+        emails2 (list): email of the second user of each pair
+    '''
+    with open(results_csv, newline='') as f:
+        csv_reader = csv.reader(f)
+        header = next(csv_reader)
+        idx1, idx2 = header.index('email1'), header.index('email2')
+        rows = [(row[idx1], row[idx2]) for row in csv_reader]
+    return [row[0] for row in rows], [row[1] for row in rows]
+
+def main():
+    '''
+    Command-line entry point; see python history.py --help.
+    '''
+    parser = argparse.ArgumentParser(description='Record and list the pair history of earlier matching rounds.')
+    parser.add_argument('--history-dir', default=HISTORY_DIR, help='pair history directory')
+    parser.add_argument('--add', metavar='RESULTS_CSV', help='record the pairs of a results csv as a round')
+    parser.add_argument('--round', help='name of the round to record')
+    parser.add_argument('--list', action='store_true', help='list the rounds and their number of pairs')
+    args = parser.parse_args()
+
+    if args.add:
+        if args.round is None:
+            parser.error('--add needs --round')
+        n_pairs = save_round(args.history_dir, args.round, *read_results_emails(args.add))
+        print('Recorded %d pairs as round %s' % (n_pairs, args.round))
+    if args.list or not args.add:
+        for name in list_rounds(args.history_dir):
+            print('%-20s %d pairs' % (name, len(np.load(get_round_path(args.history_dir, name), mmap_mode='r'))))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,254 @@
+import os
+import json
+import hashlib
+import numpy as np
+from engine import BLOCK_SIZE
+from eligibility import FILTER_QUESTIONS
+from fused import ScoreRanges, get_block_pair_edges, get_pairs_scored, get_mutual_block, get_edge_scores
+from pairing import assign_matches_from_pairs
+
+'''
+incremental.py
+--------------
+Incremental re-matching for responses that arrive after a run. A run in
+incremental mode saves a match state next to its results:
+
+    - every user's min/max raw score over their valid candidates, the
+      statistics their scores are normalized with
+    - the matches, and the MIN_MATCHES / MATCH_THRESHOLD they were made with
+    - a digest of the compiled answers of the users, so a later csv is only
+      treated as an extension if its first rows are the same users
+
+When the csv has grown, only the new users are scored, against everyone
+in both directions, which costs O(new x N) rather than O(N^2). The min/max
+of existing users are updated with their scores for the new users, and the
+new mutual edges (those with a new user) are normalized with the updated
+statistics. The greedy matching then continues from the saved matches
+with the new edges only: existing matches are kept as they are, and new
+users are matched to each other and to existing users with spare capacity.
+
+Edges between existing users are not revisited. They were skipped before
+because one of their users had reached a cap, and match counts only grow,
+so they would be skipped again.
+'''
+
+# Bump when the state format changes
+STATE_VERSION = 1
+
+# ResponseStore arrays that identify the users' answers in the digest
+DIGEST_ARRAYS = ['likert', 'socioeconomic', 'hangout', 'chill', 'major', 'schools',
+                 'music_bits', 'enjoy_talking_bits']
+
+class MatchState:
+    '''
+    State of a matching run that incremental runs extend (see module docstring).
+
+    Attributes:
+        n_users (int): number of users matched
+        digest (string): digest of the users' compiled answers (see get_users_digest)
+        min_matches (int): MIN_MATCHES of the run
+        match_threshold (int): MATCH_THRESHOLD of the run
+        min_score (np.ndarray): (n_users,) min raw score over valid candidates
+        max_score (np.ndarray): (n_users,) max raw score over valid candidates
+        has_candidates (np.ndarray): (n_users,) whether the user has any valid candidate
+        match_pairs (list): matches as tuples of user ids, in assignment order
+    '''
+    def __init__(self, n_users, digest, min_matches, match_threshold, ranges, match_pairs):
+        self.n_users = n_users
+        self.digest = digest
+        self.min_matches = min_matches
+        self.match_threshold = match_threshold
+        self.min_score = ranges.min_score
+        self.max_score = ranges.max_score
+        self.has_candidates = ranges.has_candidates
+        self.match_pairs = match_pairs
+
+def get_users_digest(store, n_users, params):
+    '''
+    Hashes the compiled answers of the first n_users users, and the pairs
+    among them excluded by the pair history (see history.py).
+
+    Arguments:
+        store (ResponseStore): compiled responses
+        n_users (int): number of users to hash
+        params (dict): json-serializable parameters that also affect matching
+
+    Returns:
+        digest (string): hex digest
+    '''
+    hasher = hashlib.sha256()
+    hasher.update(json.dumps({'version': STATE_VERSION, 'params': params}, sort_keys=True).encode())
+    arrays = [getattr(store, name) for name in DIGEST_ARRAYS]
+    arrays += [store.identity[name] for name, _, _ in FILTER_QUESTIONS]
+    for array in arrays:
+        hasher.update(np.ascontiguousarray(array[:n_users]).tobytes())
+
+    # the pairs among these users excluded by the pair history, as (user_id, c_id), so the
+    # digest doesn't change when users are appended (the keys depend on store.n_users)
+    if len(store.excluded_keys):
+        user_ids, c_ids = np.divmod(store.excluded_keys, store.n_users)
+        among = (user_ids < n_users) & (c_ids < n_users)
+        hasher.update(np.stack([user_ids[among], c_ids[among]], axis=1).astype('<i8').tobytes())
+    return hasher.hexdigest()
+
+def save_match_state(path, state):
+    '''
+    Saves a match state.
+
+    Arguments:
+        path (string): destination .npz file
+        state (MatchState): state to save
+
+    Returns:
+        None
+    '''
+    metadata = {'version': STATE_VERSION, 'n_users': state.n_users, 'digest': state.digest,
+                'min_matches': state.min_matches, 'match_threshold': state.match_threshold}
+    with open(path + '.tmp', 'wb') as f:
+        np.savez(f, min_score=state.min_score, max_score=state.max_score, has_candidates=state.has_candidates,
+                 match_pairs=np.array(state.match_pairs, dtype=np.int64).reshape(-1, 2),
+                 metadata=np.frombuffer(json.dumps(metadata).encode('utf-8'), dtype=np.uint8))
+    os.replace(path + '.tmp', path)
+
+def load_match_state(path):
+    '''
+    Loads a match state, if there is one of the current version.
+
+    Arguments:
+        path (string): .npz file saved by save_match_state
+
+    Returns:
+        state (MatchState): the state, or None
+    '''
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as arrays:
+        metadata = json.loads(arrays['metadata'].tobytes().decode('utf-8'))
+        if metadata['version'] != STATE_VERSION:
+            return None
+        ranges = ScoreRanges(0)
+        ranges.min_score = arrays['min_score']
+        ranges.max_score = arrays['max_score']
+        ranges.has_candidates = arrays['has_candidates']
+        match_pairs = [tuple(pair) for pair in arrays['match_pairs'].tolist()]
+    return MatchState(metadata['n_users'], metadata['digest'], metadata['min_matches'],
+                      metadata['match_threshold'], ranges, match_pairs)
+
+def extends_state(state, store, min_matches, match_threshold, params):
+    '''
+    Returns whether the compiled responses extend the users of a match state
+    with the same matching parameters, so they can be matched incrementally.
+
+    Arguments:
+        state (MatchState): saved state, or None
+        store (ResponseStore): compiled responses
+        min_matches (int): MIN_MATCHES of this run
+        match_threshold (int): MATCH_THRESHOLD of this run
+        params (dict): parameters passed to get_users_digest
+
+    Returns:
+        extends (boolean): True iff the state's users are the first users of store
+    '''
+    return (state is not None and state.n_users <= store.n_users and
+            (state.min_matches, state.match_threshold) == (min_matches, match_threshold) and
+            state.digest == get_users_digest(store, state.n_users, params))
+
+def get_new_user_edges(store, n_old, ranges, block_size=BLOCK_SIZE):
+    '''
+    Scores the new users against every user in both directions, folding
+    the scores into the running min/max, and keeps the raw scores of the
+    mutual pairs with a new user.
+
+    Arguments:
+        store (ResponseStore): compiled responses
+        n_old (int): number of existing users; users n_old.. are new
+        ranges (ScoreRanges): min/max of every user, updated in place
+        block_size (int): number of new users scored at a time
+
+    Returns:
+        edge_u (np.ndarray): int64 first user of each edge
+        edge_v (np.ndarray): int64 second user of each edge, edge_u < edge_v
+        forward_raw (np.ndarray): raw score of edge_u for edge_v
+        backward_raw (np.ndarray): raw score of edge_v for edge_u
+        n_pairs (int): number of (user, candidate) pairs scored
+    '''
+    all_ids = np.arange(store.n_users)
+    blocks = []
+    n_pairs = 0
+    for start in range(n_old, store.n_users, block_size):
+        new_ids = np.arange(start, min(start + block_size, store.n_users))
+        block_pair = (new_ids, all_ids, False) + get_block_pair_edges(store, new_ids, all_ids, False)
+        forward, forward_eligible, backward, backward_eligible = block_pair[3:]
+        n_pairs += get_pairs_scored(*block_pair)
+        ranges.update(*block_pair)
+
+        # a pair of new users appears in both of their rows; keep it once, from the lower id
+        keep = (all_ids[None, :] < n_old) | (all_ids[None, :] > new_ids[:, None])
+        # get_mutual_block turns a new user's edges to existing users around, so user1 < user2
+        blocks.append(get_mutual_block(new_ids, all_ids, False, forward, forward_eligible & keep,
+                                       backward, backward_eligible))
+
+    if not blocks:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0), n_pairs
+    edge_u, edge_v, forward_raw, backward_raw = [np.concatenate(arrays) for arrays in zip(*blocks)]
+    return edge_u.astype(np.int64), edge_v.astype(np.int64), forward_raw, backward_raw, n_pairs
+
+def extend_score_ranges(store, n_old, old_ranges, block_size=BLOCK_SIZE):
+    '''
+    Extends the min/max of the first n_old users to every user of store, by
+    scoring the new users against everyone (see get_new_user_edges).
+
+    Arguments:
+        store (ResponseStore): compiled responses
+        n_old (int): number of users old_ranges covers; users n_old.. are new
+        old_ranges (ScoreRanges): min/max of the first n_old users (or a MatchState), left unchanged
+        block_size (int): number of new users scored at a time
+
+    Returns:
+        ranges (ScoreRanges): min/max of every user
+        n_pairs (int): number of (user, candidate) pairs scored
+    '''
+    ranges = ScoreRanges(store.n_users)
+    ranges.min_score[:n_old] = old_ranges.min_score[:n_old]
+    ranges.max_score[:n_old] = old_ranges.max_score[:n_old]
+    ranges.has_candidates[:n_old] = old_ranges.has_candidates[:n_old]
+    n_pairs = 0
+    if n_old < store.n_users:
+        n_pairs = get_new_user_edges(store, n_old, ranges, block_size)[4]
+    return ranges, n_pairs
+
+def extend_matches(store, state, block_size=BLOCK_SIZE):
+    '''
+    Matches the users added since a match state, keeping its matches (see module docstring).
+
+    Arguments:
+        store (ResponseStore): compiled responses, extending the state's users
+        state (MatchState): state of the earlier run
+        block_size (int): number of new users scored at a time
+
+    Returns:
+        match_pairs (list): the state's matches followed by the new ones
+        match_cnts (list): match_cnts[i] = number of matches of user i
+        ranges (ScoreRanges): updated min/max of every user
+        stats (dict): new users, pairs scored, new edges and greedy iterations
+    '''
+    n_old = state.n_users
+    ranges = ScoreRanges(store.n_users)
+    ranges.min_score[:n_old] = state.min_score
+    ranges.max_score[:n_old] = state.max_score
+    ranges.has_candidates[:n_old] = state.has_candidates
+
+    edge_u, edge_v, forward_raw, backward_raw, n_pairs = get_new_user_edges(store, n_old, ranges, block_size)
+    edge_scores = get_edge_scores(edge_u, edge_v, forward_raw, backward_raw, ranges.min_score, ranges.get_range())
+    order = np.lexsort((edge_v, edge_u, -edge_scores))
+
+    match_cnts = [0] * store.n_users
+    for user1, user2 in state.match_pairs:
+        match_cnts[user1] += 1
+        match_cnts[user2] += 1
+    new_pairs, match_cnts, n_iterations = assign_matches_from_pairs(
+        zip(edge_u[order].tolist(), edge_v[order].tolist()), store.n_users,
+        state.min_matches, state.match_threshold, match_cnts)
+    stats = {'new_users': store.n_users - n_old, 'pairs_scored': n_pairs,
+             'new_edges': len(edge_scores), 'greedy_iterations': n_iterations}
+    return state.match_pairs + new_pairs, match_cnts, ranges, stats
@@ -0,0 +1,236 @@
+import os
+import csv
+from score import *
+from store import N_COLUMNS, compile_responses, update_preference_masks
+
+'''
+ingest.py
+---------
+Streaming, validating ingestion of the form responses csv. Rows are read
+one at a time and checked against the schema in indices.txt. Valid rows go
+straight into the compiled ResponseStore (see store.py). Invalid rows are
+quarantined with the reasons they failed, instead of raising deep inside
+scoring. The raw string rows are never held in memory; only the few text
+fields needed for the results (name, email, blurb) are kept, in a SideTable.
+
+User ids are positions among the valid rows. Ids given in terms of the csv
+(such as users exempt from a filter) are translated with the valid rows'
+original row numbers.
+'''
+
+INDICES_TXT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'indices.txt')
+
+EMAIL_IDX = 1
+FIRST_NAME_IDX = 2
+LAST_NAME_IDX = 3
+BLURB_IDX = 46
+
+# Columns whose answer must be one of the categories score.py knows
+CATEGORY_COLUMNS = [(HANGOUT_IDX, HANGOUT_CATEGORY_IDX),
+                    (CHILL_IDX, CHILL_CATEGORY_IDX)]
+
+# Header of the quarantine csv, followed by the original columns
+QUARANTINE_HEADER = ['row', 'line', 'reasons']
+
+def get_header():
+    '''
+    Reads the csv header (question text of each column) from indices.txt.
+
+    Arguments:
+        None
+
+    Returns:
+        header (list): question text per column index
+    '''
+    header = []
+    with open(INDICES_TXT) as f:
+        for line in f:
+            index, _, question = line.strip().partition(' ')
+            if index.isdigit() and int(index) == len(header):
+                header.append(question)
+    return header
+
+def is_rating(cell):
+    '''
+    Returns whether a cell is a 1-5 answer.
+
+    Arguments:
+        cell (string): raw csv cell
+
+    Returns:
+        is_rating (boolean): True iff cell is an integer between 1 and 5
+    '''
+    cell = cell.strip()
+    return cell.isdigit() and 1 <= int(cell) <= 5
+
+def validate_row(row):
+    '''
+    Checks a response row against the schema.
+
+    Arguments:
+        row (list): csv row of strings
+
+    Returns:
+        reasons (list): why the row is invalid; empty if it is valid
+    '''
+    if len(row) != N_COLUMNS:
+        return ['expected %d columns, found %d' % (N_COLUMNS, len(row))]
+
+    reasons = []
+    for idx in LIKERT_IDX:
+        # the preference is only read when the socioeconomic question itself is answered
+        if idx == SOCIOECONOMIC_PREFER_IDX and row[SOCIOECONOMIC_IDX] not in CLASS_IDX:
+            continue
+        if not is_rating(row[idx]):
+            reasons.append('column %d: %r is not a 1-5 answer' % (idx, row[idx]))
+    for idx, categories in CATEGORY_COLUMNS:
+        if row[idx] not in categories:
+            reasons.append('column %d: unknown category %r' % (idx, row[idx]))
+    return reasons
+
+class SideTable:
+    '''
+    Text fields of the valid responses that are only needed for the results,
+    by user id.
+
+    Attributes:
+        first_names (list): first name per user
+        last_names (list): last name per user
+        emails (list): email address per user
+        blurbs (list): blurb per user ('' if none)
+        row_numbers (list): 0-based row (not counting the header) of each user in the csv
+    '''
+    def __init__(self):
+        self.first_names = []
+        self.last_names = []
+        self.emails = []
+        self.blurbs = []
+        self.row_numbers = []
+
+    def __len__(self):
+        return len(self.row_numbers)
+
+    def append(self, row, row_number):
+        '''
+        Adds the text fields of a valid response.
+
+        Arguments:
+            row (list): csv row of strings
+            row_number (int): 0-based row of the response in the csv
+
+        Returns:
+            None
+        '''
+        self.first_names.append(row[FIRST_NAME_IDX])
+        self.last_names.append(row[LAST_NAME_IDX])
+        self.emails.append(row[EMAIL_IDX])
+        self.blurbs.append(row[BLURB_IDX])
+        self.row_numbers.append(row_number)
+
+class IngestReport:
+    '''
+    Summary of an ingestion run.
+
+    Attributes:
+        n_rows (int): number of response rows read
+        n_valid (int): number of rows compiled
+        quarantined (list): (row number, line number, reasons) of each invalid row
+        header_mismatches (list): column indices whose header differs from indices.txt
+    '''
+    def __init__(self):
+        self.n_rows = 0
+        self.n_valid = 0
+        self.quarantined = []
+        self.header_mismatches = []
+
+    def to_dict(self):
+        '''
+        Returns the report as a json-serializable dict, with quarantined rows
+        summarized as counts.
+
+        Arguments:
+            None
+
+        Returns:
+            report (dict): n_rows, n_valid, n_quarantined and header_mismatches
+        '''
+        return {'n_rows': self.n_rows,
+                'n_valid': self.n_valid,
+                'n_quarantined': len(self.quarantined),
+                'header_mismatches': self.header_mismatches}
+
+def read_valid_rows(csv_reader, side_table, report, quarantine_writer=None):
+    '''
+    Yields the valid rows of a csv reader positioned after the header,
+    recording each one in the side table and quarantining the others.
+
+    Arguments:
+        csv_reader (csv.reader): reader of the responses csv
+        side_table (SideTable): receives the text fields of valid rows
+        report (IngestReport): receives counts and quarantined rows
+        quarantine_writer (csv.writer): receives quarantined rows, or None
+
+    Returns:
+        rows (generator): valid csv rows
+    '''
+    for row_number, row in enumerate(csv_reader):
+        report.n_rows += 1
+        reasons = validate_row(row)
+        if reasons:
+            report.quarantined.append((row_number, csv_reader.line_num, reasons))
+            if quarantine_writer is not None:
+                quarantine_writer.writerow([row_number, csv_reader.line_num, '; '.join(reasons)] + row)
+            continue
+        report.n_valid += 1
+        side_table.append(row, row_number)
+        yield row
+
+def ingest_responses(responses_csv, political_exempt_rows=(), quarantine_csv=None):
+    '''
+    Streams, validates and compiles the responses csv.
+
+    Arguments:
+        responses_csv (string): path of the responses csv
+        political_exempt_rows (list): 0-based rows (not counting the header) of
+            users exempt from the political party filter
+        quarantine_csv (string): path to write invalid rows to, with their row,
+            line and reasons; written only if some rows are invalid. None to not write them
+
+    Returns:
+        header (list): header row of the csv
+        store (ResponseStore): compiled valid responses
+        side_table (SideTable): text fields of the valid responses
+        report (IngestReport): what was read and quarantined
+    '''
+    side_table = SideTable()
+    report = IngestReport()
+    quarantine_file = None
+    with open(responses_csv, 'r') as f:
+        csv_reader = csv.reader(f)
+        header = next(csv_reader, [])
+        if len(header) != N_COLUMNS:
+            raise ValueError('%s: expected %d header columns, found %d' % (responses_csv, N_COLUMNS, len(header)))
+        if os.path.exists(INDICES_TXT):
+            report.header_mismatches = [idx for idx, question in enumerate(get_header())
+                                        if question.strip() != header[idx].strip()]
+        try:
+            quarantine_writer = None
+            if quarantine_csv is not None:
+                quarantine_file = open(quarantine_csv, mode='w')
+                quarantine_writer = csv.writer(quarantine_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+                quarantine_writer.writerow(QUARANTINE_HEADER + header)
+
+            # exempt ids are user ids, which are only known once every row has been validated,
+            # so they are filled in after compiling
+            store = compile_responses(read_valid_rows(csv_reader, side_table, report, quarantine_writer))
+        finally:
+            if quarantine_file is not None:
+                quarantine_file.close()
+                if not report.quarantined:
+                    os.remove(quarantine_csv)
+
+    exempt_rows = set(political_exempt_rows)
+    store.political_exempt_ids = [user_id for user_id, row_number in enumerate(side_table.row_numbers)
+                                  if row_number in exempt_rows]
+    update_preference_masks(store)
+    return header, store, side_table, report
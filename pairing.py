@@ -0,0 +1,144 @@
+import math
+import numpy as np
+
+'''
+pairing.py
+----------
+Edge construction and greedy match assignment used by get_all_pairings in
+squad.py. For people A and B who are valid candidates for each other, the
+mutual edge score is
+
+    S(A, B) = exp(A's score for B) + exp(B's score for A)
+
+Candidate scores come in as a ScoreMatrix (see csr.py). Edges are kept as
+parallel numpy arrays (user1, user2, score) with user1 < user2, in
+(user1, user2) order.
+'''
+
+def exp(values):
+    '''
+    Elementwise math.exp of an array. np.exp rounds the last bit differently
+    from math.exp for some inputs, which would reorder near-tied edges, so
+    this keeps math.exp to stay identical to the original per-pair loop.
+
+    Arguments:
+        values (np.ndarray): float64 values
+
+    Returns:
+        exp_values (np.ndarray): math.exp of each value
+    '''
+    return np.fromiter(map(math.exp, values.tolist()), dtype=np.float64, count=len(values))
+
+def get_mutual_edges(matrix):
+    '''
+    Builds the mutual edges from every user's candidate scores: an edge
+    (u, v), u < v, exists iff v is a candidate of u and u is a candidate of v.
+    The matrix's entries are ordered by (user, candidate), so the reverse
+    entry (v, u) of every entry (u, v) is found with a vectorized binary
+    search over the entry keys user*N + candidate.
+
+    Arguments:
+        matrix (ScoreMatrix): normalized candidate scores of every user (see csr.py)
+
+    Returns:
+        edge_u (np.ndarray): int64 first user of each edge
+        edge_v (np.ndarray): int64 second user of each edge, edge_u < edge_v
+        edge_scores (np.ndarray): float64 mutual score of each edge
+    '''
+    n_users = matrix.n_users
+    users = matrix.get_users()
+    candidates = matrix.indices.astype(np.int64)
+    keys = users*n_users + candidates
+
+    # look up the reverse entry (v, u) of every upper-triangle entry (u, v)
+    forward = np.flatnonzero(users < candidates)
+    del users
+    reverse_keys = candidates[forward]*n_users + keys[forward]//n_users
+    reverse = np.searchsorted(keys, reverse_keys)
+    mutual = reverse < len(keys)
+    mutual[mutual] = keys[reverse[mutual]] == reverse_keys[mutual]
+
+    forward = forward[mutual]
+    reverse = reverse[mutual]
+    edge_u = keys[forward]//n_users
+    edge_v = candidates[forward]
+    scores = np.asarray(matrix.data, dtype=np.float64)
+    edge_scores = exp(scores[forward]) + exp(scores[reverse])
+    return edge_u, edge_v, edge_scores
+
+def sort_edges(edge_scores):
+    '''
+    Orders edges by decreasing score. The sort is stable, so tied edges keep
+    their (user1, user2) order.
+
+    Arguments:
+        edge_scores (np.ndarray): mutual score of each edge
+
+    Returns:
+        order (np.ndarray): edge indices, best first
+    '''
+    return np.argsort(-edge_scores, kind='stable')
+
+def assign_matches(edge_u, edge_v, order, n_users, min_matches, match_threshold):
+    '''
+    Walks the edges in the given order and greedily assigns matches. It skips
+    a potential match if both users already have at least min_matches matches
+    or at least one of them has at least match_threshold matches. Stops early
+    once every user has reached min(min_matches, match_threshold), since every
+    remaining edge would be skipped.
+
+    Arguments:
+        edge_u (np.ndarray): first user of each edge
+        edge_v (np.ndarray): second user of each edge
+        order (np.ndarray): edge indices in the order to consider them; None
+            to consider the edges in the order given
+        n_users (int): number of users
+        min_matches (int): see above
+        match_threshold (int): see above
+
+    Returns:
+        match_pairs (list): matches as tuples of user ids, in assignment order
+        match_cnts (list): match_cnts[i] = number of matches of user i
+        n_iterations (int): number of edges considered before stopping
+    '''
+    if order is not None:
+        edge_u, edge_v = edge_u[order], edge_v[order]
+    return assign_matches_from_pairs(zip(edge_u.tolist(), edge_v.tolist()), n_users, min_matches, match_threshold)
+
+def assign_matches_from_pairs(pairs, n_users, min_matches, match_threshold, match_cnts=None):
+    '''
+    Greedily assigns matches from a stream of edges, best first (see
+    assign_matches). Stops consuming the stream once every user has reached
+    min(min_matches, match_threshold).
+
+    Arguments:
+        pairs (iterable): (user1, user2) int tuples of the edges, best first
+        n_users (int): number of users
+        min_matches (int): see assign_matches
+        match_threshold (int): see assign_matches
+        match_cnts (list): number of matches each user already has, to extend
+            an earlier assignment; None to start from no matches
+
+    Returns:
+        match_pairs (list): new matches as tuples of user ids, in assignment order
+        match_cnts (list): match_cnts[i] = number of matches of user i
+        n_iterations (int): number of edges considered before stopping
+    '''
+    match_cnts = [0] * n_users if match_cnts is None else list(match_cnts)
+    match_pairs = []
+    cap = min(min_matches, match_threshold)
+    n_below_cap = sum(cnt < cap for cnt in match_cnts)
+    n_iterations = 0
+    for user1, user2 in pairs:
+        if n_below_cap == 0:
+            break
+        n_iterations += 1
+        if match_cnts[user1] >= min_matches and match_cnts[user2] >= min_matches:
+            continue
+        elif match_cnts[user1] >= match_threshold or match_cnts[user2] >= match_threshold:
+            continue
+        match_cnts[user1] += 1
+        match_cnts[user2] += 1
+        n_below_cap -= (match_cnts[user1] == cap) + (match_cnts[user2] == cap)
+        match_pairs.append((user1, user2))
+    return match_pairs, match_cnts, n_iterations
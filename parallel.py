@@ -0,0 +1,177 @@
+import numpy as np
+from multiprocessing import Pool, shared_memory
+from store import ResponseStore
+from eligibility import FILTER_QUESTIONS, get_eligibility_block
+from engine import score_block, normalize_rows, get_top_k_block, get_tile_size, MEMORY_BUDGET
+from csr import from_counts
+
+'''
+parallel.py
+-----------
+Multi-core scoring. Users are split into chunks that a process pool scores
+with the vectorized engine (see engine.py). The compiled response arrays
+are copied once into shared memory, and every worker maps them instead of
+receiving a pickled copy. Workers return compact candidate arrays rather
+than dicts, and chunks are collected in order into a ScoreMatrix (see
+csr.py), so the result is deterministic and identical to the serial path.
+'''
+
+# Number of users per task handed to a worker
+CHUNK_SIZE = 256
+
+# Store attributes that hold plain numpy arrays needed for scoring
+SHARED_ARRAYS = ['likert', 'socioeconomic', 'hangout', 'chill', 'major', 'schools',
+                 'music_bits', 'enjoy_talking_bits', 'excluded_keys']
+
+# ResponseStore attached to shared memory in each worker process
+worker_store = None
+worker_segments = []
+
+def get_shared_arrays(store):
+    '''
+    Lists the arrays of a store that workers need, keyed by a flat name.
+
+    Arguments:
+        store (ResponseStore): compiled responses
+
+    Returns:
+        arrays (dict): name -> np.ndarray; 'identity.<filter>' and
+            'preference_mask.<filter>' for the filter questions
+    '''
+    arrays = dict((name, getattr(store, name)) for name in SHARED_ARRAYS)
+    for name, _, _ in FILTER_QUESTIONS:
+        arrays['identity.' + name] = store.identity[name]
+        arrays['preference_mask.' + name] = store.preference_mask[name]
+    return arrays
+
+def share_store(store):
+    '''
+    Copies the arrays workers need into shared memory segments.
+
+    Arguments:
+        store (ResponseStore): compiled responses
+
+    Returns:
+        segments (list): SharedMemory segments; the caller must close and unlink them
+        spec (dict): picklable description that attach_store uses to map the segments
+    '''
+    segments = []
+    spec = {'n_users': store.n_users, 'arrays': {}}
+    for name, array in get_shared_arrays(store).items():
+        segment = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=segment.buf)[...] = array
+        segments.append(segment)
+        spec['arrays'][name] = (segment.name, array.shape, array.dtype.str)
+    return segments, spec
+
+def attach_store(spec):
+    '''
+    Builds a ResponseStore whose arrays are views of the shared memory segments in spec.
+
+    Arguments:
+        spec (dict): description returned by share_store
+
+    Returns:
+        store (ResponseStore): store backed by shared memory (scoring arrays only)
+        segments (list): attached SharedMemory segments, to keep alive while store is used
+    '''
+    store = ResponseStore()
+    store.n_users = spec['n_users']
+    segments = []
+    for name, (segment_name, shape, dtype) in spec['arrays'].items():
+        segment = shared_memory.SharedMemory(name=segment_name)
+        segments.append(segment)
+        array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=segment.buf)
+        if '.' in name:
+            attribute, key = name.split('.')
+            getattr(store, attribute)[key] = array
+        else:
+            setattr(store, name, array)
+    return store, segments
+
+def init_worker(spec):
+    '''
+    Pool initializer: attaches the shared store in a worker process.
+
+    Arguments:
+        spec (dict): description returned by share_store
+
+    Returns:
+        None
+    '''
+    global worker_store, worker_segments
+    worker_store, worker_segments = attach_store(spec)
+
+def score_users(store, user_ids, k=None, tile_size=None):
+    '''
+    Scores a chunk of users against every candidate.
+
+    Arguments:
+        store (ResponseStore): compiled responses
+        user_ids (np.ndarray): ids of users in the chunk
+        k (int): if set, only keep each user's top k candidates
+        tile_size (int): candidates scored at a time when k is set
+
+    Returns:
+        counts (np.ndarray): int32 number of candidates kept per user
+        ids (np.ndarray): int32 candidate ids of all users, concatenated in user order
+        scores (np.ndarray): float64 normalized scores of ids
+    '''
+    if k is not None:
+        top_ids, top_scores = get_top_k_block(store, user_ids, k, tile_size)
+        valid = top_ids >= 0
+        return valid.sum(axis=1).astype(np.int32), top_ids[valid], top_scores[valid]
+
+    all_ids = np.arange(store.n_users)
+    eligible = get_eligibility_block(store, user_ids, all_ids)
+    normalized = normalize_rows(score_block(store, user_ids, all_ids), eligible)
+    rows, ids = np.nonzero(eligible)
+    return eligible.sum(axis=1).astype(np.int32), ids.astype(np.int32), normalized[rows, ids]
+
+def score_chunk(task):
+    '''
+    Worker task: scores users start..stop-1 with the worker's shared store.
+
+    Arguments:
+        task (tuple): (start, stop, k, tile_size); see score_users
+
+    Returns:
+        result (tuple): (counts, ids, scores); see score_users
+    '''
+    start, stop, k, tile_size = task
+    return score_users(worker_store, np.arange(start, stop), k, tile_size)
+
+def get_all_scores_parallel(store, n_workers, chunk_size=CHUNK_SIZE, k=None, memory_budget=MEMORY_BUDGET):
+    '''
+    Scores every user with a pool of n_workers processes.
+
+    Arguments:
+        store (ResponseStore): compiled responses
+        n_workers (int): number of worker processes
+        chunk_size (int): number of users per task
+        k (int): if set, only keep each user's top k candidates (see get_top_k_scores)
+        memory_budget (int): bytes per tile when k is set
+
+    Returns:
+        matrix (ScoreMatrix): normalized scores of every user's valid candidates
+            (or only their top k, if k is set)
+    '''
+    n = store.n_users
+    tile_size = get_tile_size(n, memory_budget) if k is not None else None
+    tasks = [(start, min(start + chunk_size, n), k, tile_size) for start in range(0, n, chunk_size)]
+
+    segments, spec = share_store(store)
+    try:
+        with Pool(n_workers, initializer=init_worker, initargs=(spec,)) as pool:
+            # imap yields chunks in task order, so the result doesn't depend on scheduling
+            chunks = list(pool.imap(score_chunk, tasks))
+    finally:
+        for segment in segments:
+            segment.close()
+            segment.unlink()
+    if not chunks:
+        return from_counts(np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32), np.zeros(0))
+    counts, ids, scores = [np.concatenate(arrays) for arrays in zip(*chunks)]
+
+    # top k candidates come best first; the matrix keeps each user's candidates in id order
+    return from_counts(counts, ids, scores, sort=k is not None)
@@ -0,0 +1,361 @@
+import os
+import sys
+import json
+import time
+import pstats
+import cProfile
+import threading
+import contextlib
+import tracemalloc
+
+'''
+profiling.py
+------------
+Instrumentation for the matching pipeline. A RunProfile records, for a
+single run:
+
+- stages: wall time and peak memory (traced by tracemalloc) of each stage
+- timings: wall time of steps inside the stages (e.g. sorting the edges)
+- counters: sizes of the intermediate results (pairs scored, mutual edges,
+  greedy loop iterations, filter rejections per conflict type, ...)
+- hotspots: optionally, the top functions found by cProfile or by sampling
+  the main thread's stack
+
+and saves them as a json run profile.
+'''
+
+# Modes of RunProfile.profile_functions
+PROFILE_MODES = [None, 'cprofile', 'sample']
+
+# Seconds between stack samples in 'sample' mode
+SAMPLE_INTERVAL = 0.005
+
+# Number of functions reported in hotspots
+N_HOTSPOTS = 30
+
+class StageProfiler:
+    '''
+    Measures wall time and peak traced memory of pipeline stages.
+
+    Peak memory is the largest amount allocated by the stage on top of what
+    was allocated before it started.
+
+    Attributes:
+        trace_memory (bool): whether to trace memory with tracemalloc
+        results (dict): stage -> {'seconds': float, 'peak_mb': float or None}
+    '''
+    def __init__(self, trace_memory=True):
+        self.trace_memory = trace_memory
+        self.results = {}
+        self.outer_peak = 0
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        '''
+        Context manager that measures the enclosed code as stage name.
+
+        Arguments:
+            name (string): stage name
+
+        Returns:
+            None
+        '''
+        started_tracing = self.trace_memory and not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            start_memory = tracemalloc.get_traced_memory()[0]
+            self.outer_peak = 0
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            peak_mb = None
+            if self.trace_memory:
+                peak = max(self.outer_peak, tracemalloc.get_traced_memory()[1])
+                peak_mb = (peak - start_memory)/2**20
+            if started_tracing:
+                tracemalloc.stop()
+            self.add(name, seconds, peak_mb)
+
+    def add(self, name, seconds, peak_mb):
+        '''
+        Adds a measurement to a stage: times add up, peaks take the max.
+
+        Arguments:
+            name (string): stage name
+            seconds (float): wall time
+            peak_mb (float): peak memory in MiB, or None if not traced
+
+        Returns:
+            None
+        '''
+        result = self.results.setdefault(name, {'seconds': 0.0, 'peak_mb': None})
+        result['seconds'] += seconds
+        if peak_mb is not None:
+            result['peak_mb'] = max(result['peak_mb'] or 0.0, peak_mb)
+
+    def wrap(self, name, func):
+        '''
+        Wraps func so each call is measured as stage name, nested inside the
+        enclosing stage. The enclosing stage's time still includes the calls;
+        see subtract.
+
+        Arguments:
+            name (string): stage name
+            func (function): function to measure
+
+        Returns:
+            wrapped (function): measured version of func
+        '''
+        def wrapped(*args, **kwargs):
+            tracing = self.trace_memory and tracemalloc.is_tracing()
+            if tracing:
+                start_memory, outer_peak = tracemalloc.get_traced_memory()
+                self.outer_peak = max(self.outer_peak, outer_peak)
+                tracemalloc.reset_peak()
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                seconds = time.perf_counter() - start
+                peak_mb = None
+                if tracing:
+                    peak = tracemalloc.get_traced_memory()[1]
+                    self.outer_peak = max(self.outer_peak, peak)
+                    peak_mb = (peak - start_memory)/2**20
+                self.add(name, seconds, peak_mb)
+        return wrapped
+
+    def subtract(self, name, nested_name):
+        '''
+        Removes the time of a nested stage from the stage enclosing it.
+
+        Arguments:
+            name (string): enclosing stage name
+            nested_name (string): nested stage name
+
+        Returns:
+            None
+        '''
+        nested = self.results.setdefault(nested_name, {'seconds': 0.0, 'peak_mb': None})
+        self.results[name]['seconds'] -= nested['seconds']
+
+class RunProfile(StageProfiler):
+    '''
+    Profile of one pipeline run (see module docstring).
+
+    Attributes:
+        trace_memory (bool): whether to trace memory with tracemalloc
+        results (dict): stage -> {'seconds': float, 'peak_mb': float or None}
+        timings (dict): step -> total wall time in seconds
+        counters (dict): name -> json-serializable value
+        hotspots (dict): profiler mode and top functions, or None
+    '''
+    def __init__(self, trace_memory=True):
+        StageProfiler.__init__(self, trace_memory)
+        self.timings = {}
+        self.counters = {}
+        self.hotspots = None
+
+    @contextlib.contextmanager
+    def time(self, name):
+        '''
+        Context manager that adds the wall time of the enclosed code to step name.
+
+        Arguments:
+            name (string): step name
+
+        Returns:
+            None
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0.0) + time.perf_counter() - start
+
+    def set(self, name, value):
+        '''
+        Records a counter.
+
+        Arguments:
+            name (string): counter name
+            value (object): json-serializable value
+
+        Returns:
+            None
+        '''
+        self.counters[name] = value
+
+    @contextlib.contextmanager
+    def profile_functions(self, mode):
+        '''
+        Context manager that profiles the functions called by the enclosed
+        code, and records the top ones in hotspots.
+
+        Arguments:
+            mode (string): 'cprofile' for deterministic profiling of every call,
+                'sample' for sampling the main thread's stack every SAMPLE_INTERVAL
+                seconds (much lower overhead), or None to not profile
+
+        Returns:
+            None
+        '''
+        if mode not in PROFILE_MODES:
+            raise ValueError('unknown profile mode %r, expected one of %r' % (mode, PROFILE_MODES))
+        if mode is None:
+            yield
+        elif mode == 'cprofile':
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                yield
+            finally:
+                profiler.disable()
+                self.hotspots = {'mode': mode, 'functions': get_cprofile_hotspots(profiler)}
+        else:
+            sampler = StackSampler(threading.get_ident())
+            sampler.start()
+            try:
+                yield
+            finally:
+                sampler.stop()
+                self.hotspots = {'mode': mode, 'interval': SAMPLE_INTERVAL,
+                                 'n_samples': sampler.n_samples, 'functions': sampler.get_hotspots()}
+
+    def to_dict(self):
+        '''
+        Returns the profile as a json-serializable dict.
+
+        Arguments:
+            None
+
+        Returns:
+            profile (dict): stages, timings, counters and hotspots
+        '''
+        return {'stages': self.results,
+                'timings': self.timings,
+                'counters': self.counters,
+                'hotspots': self.hotspots}
+
+    def save(self, path):
+        '''
+        Writes the profile to a json file.
+
+        Arguments:
+            path (string): destination json file
+
+        Returns:
+            None
+        '''
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+def get_function_name(filename, line, function):
+    '''
+    Formats a function as 'file.py:line(function)'.
+
+    Arguments:
+        filename (string): path of the source file
+        line (int): line the function starts on
+        function (string): function name
+
+    Returns:
+        name (string): formatted name
+    '''
+    return '%s:%d(%s)' % (os.path.basename(filename), line, function)
+
+def get_cprofile_hotspots(profiler):
+    '''
+    Lists the functions with the most cumulative time in a cProfile run.
+
+    Arguments:
+        profiler (cProfile.Profile): finished profiler
+
+    Returns:
+        hotspots (list): dicts of function, calls, self_seconds and
+            cumulative_seconds, most cumulative time first
+    '''
+    stats = pstats.Stats(profiler).stats
+    hotspots = []
+    for (filename, line, function), (_, n_calls, self_seconds, cumulative_seconds, _) in stats.items():
+        hotspots.append({'function': get_function_name(filename, line, function),
+                         'calls': n_calls,
+                         'self_seconds': self_seconds,
+                         'cumulative_seconds': cumulative_seconds})
+    hotspots.sort(key=lambda h: -h['cumulative_seconds'])
+    return hotspots[:N_HOTSPOTS]
+
+class StackSampler:
+    '''
+    Background thread that periodically samples the stack of another thread.
+
+    Attributes:
+        thread_id (int): ident of the sampled thread
+        n_samples (int): number of samples taken
+        self_counts (dict): function -> samples where it was running
+        cumulative_counts (dict): function -> samples where it was on the stack
+    '''
+    def __init__(self, thread_id):
+        self.thread_id = thread_id
+        self.n_samples = 0
+        self.self_counts = {}
+        self.cumulative_counts = {}
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        '''
+        Starts sampling.
+        '''
+        self.thread.start()
+
+    def stop(self):
+        '''
+        Stops sampling and waits for the sampling thread to exit.
+        '''
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        '''
+        Sampling thread: records the sampled thread's stack every SAMPLE_INTERVAL seconds.
+        '''
+        while not self.stopped.wait(SAMPLE_INTERVAL):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            self.n_samples += 1
+            on_stack = set()
+            leaf = True
+            while frame is not None:
+                code = frame.f_code
+                name = get_function_name(code.co_filename, code.co_firstlineno, code.co_name)
+                if leaf:
+                    self.self_counts[name] = self.self_counts.get(name, 0) + 1
+                    leaf = False
+                on_stack.add(name)
+                frame = frame.f_back
+            for name in on_stack:
+                self.cumulative_counts[name] = self.cumulative_counts.get(name, 0) + 1
+
+    def get_hotspots(self):
+        '''
+        Lists the functions that were on the stack in the most samples.
+
+        Arguments:
+            None
+
+        Returns:
+            hotspots (list): dicts of function, self_samples and cumulative_samples,
+                most cumulative samples first
+        '''
+        hotspots = [{'function': name,
+                     'self_samples': self.self_counts.get(name, 0),
+                     'cumulative_samples': count}
+                    for name, count in self.cumulative_counts.items()]
+        hotspots.sort(key=lambda h: -h['cumulative_samples'])
+        return hotspots[:N_HOTSPOTS]
@@ -2,12 +2,78 @@
 score.py
 --------
 util functions for computing the score between a user and candidate
+
+All scoring functions read from a compiled ResponseStore (see store.py)
+rather than from the raw csv rows, so no cell is parsed more than once.
 '''
 
+# See indices.txt for the question behind each index
+SOCIOECONOMIC_IDX = 12
+SOCIOECONOMIC_PREFER_IDX = 13
+MAJOR_IDX = 14
+MAJOR_PREFER_IDX = 15
+INTELLIGENCE_IDX = 19
+INTELLIGENCE_PREFER_IDX = 20
+SIMILARITY_WEIGHT_IDX = 22
+HANGOUT_IDX = 36
+CONTACT_IDX = 40
+MUSIC_IDX = 43
+ENJOY_TALKING_IDX = 44
+CHILL_IDX = 45
+
+SIMILARITY_QUESTION_IDX = [16, 17, 21, 23, 27, 28, 34, 35, 37, 38, 39, 41, 42]
+ACTIVITY_QUESTION_IDX = [18, 24, 25, 26, 29, 30, 31, 32, 33]
+
+# every question answered on a 1-5 scale
+LIKERT_IDX = sorted([SOCIOECONOMIC_PREFER_IDX, MAJOR_PREFER_IDX, INTELLIGENCE_IDX,
+                     INTELLIGENCE_PREFER_IDX, SIMILARITY_WEIGHT_IDX, CONTACT_IDX] +
+                    SIMILARITY_QUESTION_IDX + ACTIVITY_QUESTION_IDX)
+
+CLASS_IDX = { "Lower class" : 0,
+              "Lower-middle class": 1,
+              "Middle class": 2,
+              "Middle-upper class": 3,
+              "Upper class": 4 }
+
+HANGOUT_CATEGORY_IDX = { "Every meal" : 0,
+                         "Once a day": 1,
+                         "Couple times a week": 2,
+                         "Every weekend": 3,
+                         "Couple times a month": 4 }
+
+CHILL_CATEGORY_IDX = { "Literally down to do anything anytime anywhere anyhow anywhy." : 0,
+                       "Almost always down to go to L&L at 3am on a Wednesday.": 1,
+                       "\"I'm good with anything.\"": 2,
+                       "I get tilted when people flake on me.": 3,
+                       "I get pissed off when my roommate uses my tissue box without asking.": 4,
+                       "I freak out when the utensils aren't exactly where they should be on the dinner table.": 5 }
+
+SCHOOL_IDX = { "Aeronautics and Astronautics": 1,
+               "Anthropology": 2,
+               "Architectural Design": 1,
+               "Atmosphere/ Energy": 0,
+               "Biology": 2,
+               "Biomedical Computation": 1,
+               "Chemistry": 2,
+               "Community Health and Prevention Research": 2,
+               "Computer Science": 1,
+               "Earth Systems": 0,
+               "Energy Resources Engineering": 0,
+               "Geological Sciences": 0,
+               "Geophysics": 0,
+               "Honors in the Arts": 2,
+               "Laboratory Animal Science": 2,
+               "Mathematical and Computational Science": 1,
+               "Physics": 2,
+               "Product Design": 1,
+               "Public Policy": 2,
+               "Symbolic Systems": 1,
+               "Sustainability": 0 }
+
 def get_distance(user_rating, c_rating, offset, scale):
     '''
     Computes a score for distance between the user answer and candidate answer.
-    Smaller distance leads to larger score.
+    Smaller distance leads to larger score. Also works elementwise on numpy arrays.
 
     Arguments:
         user_rating (int): user answer for the question
@@ -21,46 +87,40 @@ def get_distance(user_rating, c_rating, offset, scale):
     dist = 5 - abs(user_rating - c_rating)
     return (dist + offset)/scale
 
-def get_set_intersection_score(user_ans, c_ans):
+def get_set_intersection_score(user_set, c_set):
     '''
     Computes a score between 0 and 1 representing similarity between user and candidate answer.
     Answers are treated as sets and we take set intersection to represent similarity.
-    Normalize by the number of items in user's set. 
+    Normalize by the number of items in user's set.
 
     Arguments:
-        user_ans (string): user's set parsed as string
-        c_ans (string): candidate's set parsed as string
+        user_set (int): user's answer, encoded as an integer bitset of vocabulary ids
+        c_set (int): candidate's answer, encoded as an integer bitset of vocabulary ids
 
     Returns:
         score (float): normalized score between user answer and candidate answer
     '''
-    user_set = set(''.join(user_ans.split()).split(','))
-    c_set = set(''.join(c_ans.split()).split(','))
-    return 1.0*len(user_set.intersection(c_set))/len(user_set)
+    return 1.0*bin(user_set & c_set).count('1')/bin(user_set).count('1')
 
-def get_socioeconomic_score(user_info, c_info):
+def get_socioeconomic_score(store, user_id, c_id):
     '''
     Computes a score between 0 and 2 for socioecnomic question (weight is 2).
     If either user or candidate does not provide an answer, the score is 0.
 
     Arguments:
-        user_info (list): complete user response
-        c_info (list): complete candidate reponse
+        store (ResponseStore): compiled responses
+        user_id (int): id (index) of user
+        c_id (int): id (index) of candidate
 
     Returns:
         score (float): normalized score between user answer and candidate answer
     '''
-    question_idx = 12
-    prefer_idx = 13
-    class_idx = { "Lower class" : 0,
-                  "Lower-middle class": 1,
-                  "Middle class": 2,
-                  "Middle-upper class": 3,
-                  "Upper class": 4 }
-    if user_info[question_idx] not in class_idx or c_info[question_idx] not in class_idx:
+    u_class = int(store.socioeconomic[user_id])
+    c_class = int(store.socioeconomic[c_id])
+    if u_class < 0 or c_class < 0:
         return 0
-    raw_score = get_distance(class_idx[user_info[question_idx]], class_idx[c_info[question_idx]], -3, 2.0)
-    preference = (int(user_info[prefer_idx]) - 1)/4.0
+    raw_score = get_distance(u_class, c_class, -3, 2.0)
+    preference = (int(store.likert[user_id, SOCIOECONOMIC_PREFER_IDX]) - 1)/4.0
     scaled_score = raw_score*preference
     return scaled_score*2
 
@@ -78,29 +138,8 @@ def get_schools(major):
     Returns:
         schools (set): set of indices correponding to the schools the major is part of
     '''
-    school_idx = { "Aeronautics and Astronautics": 1,
-                   "Anthropology": 2,
-                   "Architectural Design": 1,
-                   "Atmosphere/ Energy": 0,
-                   "Biology": 2,
-                   "Biomedical Computation": 1,
-                   "Chemistry": 2,
-                   "Community Health and Prevention Research": 2,
-                   "Computer Science": 1,
-                   "Earth Systems": 0,
-                   "Energy Resources Engineering": 0,
-                   "Geological Sciences": 0,
-                   "Geophysics": 0,
-                   "Honors in the Arts": 2,
-                   "Laboratory Animal Science": 2,
-                   "Mathematical and Computational Science": 1,
-                   "Physics": 2,
-                   "Product Design": 1,
-                   "Public Policy": 2,
-                   "Symbolic Systems": 1,
-                   "Sustainability": 0 }
-    if major in school_idx:
-        return set([school_idx[major]])
+    if major in SCHOOL_IDX:
+        return set([SCHOOL_IDX[major]])
     elif "Engineering" in major or "engineering" in major:
         return set([1])
     elif "CS" in major: #CS + X
@@ -108,156 +147,146 @@ def get_schools(major):
     else:
         return set([3])
 
-def get_majors_score(user_info, c_info):
+def get_majors_score(store, user_id, c_id):
     '''
-    Computes a score between 0 and 2 for socioecnomic question (weight is 2).
-    
+    Computes a score between 0 and 2 for majors question (weight is 2).
+
     Arguments:
-        user_info (list): complete user response
-        c_info (list): complete candidate reponse
+        store (ResponseStore): compiled responses
+        user_id (int): id (index) of user
+        c_id (int): id (index) of candidate
 
     Returns:
         score (float): normalized score between user answer and candidate answer
     '''
-    question_idx = 14
-    prefer_idx = 15
-    user_major = user_info[question_idx]
-    c_major = c_info[question_idx]
-    preference = int(user_info[prefer_idx])
+    user_major = store.major[user_id]
+    c_major = store.major[c_id]
+    preference = int(store.likert[user_id, MAJOR_PREFER_IDX])
     if preference == 3: # no preference
         return 1
     elif preference == 5: # only major
         return 2 if user_major == c_major else 0
     elif preference == 1: # only not major
         return 2 if user_major != c_major else 0
-    user_schools = get_schools(user_major)
-    c_schools = get_schools(c_major)
+    # schools are stored as bitmasks, one bit per school index
+    user_schools = int(store.schools[user_id])
+    c_schools = int(store.schools[c_id])
     if preference == 4: # at least one same school
-        return 2 if len(user_schools.intersection(c_schools)) > 0 else 0
+        return 2 if user_schools & c_schools else 0
     else: # at least one different school
-        return 2 if len(user_schools.intersection(c_schools)) != len(user_schools) else 0
+        return 2 if user_schools & ~c_schools else 0
 
-def get_intelligence_score(user_info, c_info):
+def get_intelligence_score(store, user_id, c_id):
     '''
     Computes a score between -2 and 2 for intelligence questions (weight is 2).
 
     Arguments:
-        user_info (list): complete user response
-        c_info (list): complete candidate reponse
+        store (ResponseStore): compiled responses
+        user_id (int): id (index) of user
+        c_id (int): id (index) of candidate
 
     Returns:
         score (float): normalized score between user answer and candidate answer
     '''
-    question_idx = 19
-    prefer_idx = 20
-    raw_score = 1 if int(user_info[question_idx]) <= int(c_info[question_idx]) else -1
-    preference = (int(user_info[prefer_idx]) - 3)/2.0
+    raw_score = 1 if store.likert[user_id, INTELLIGENCE_IDX] <= store.likert[c_id, INTELLIGENCE_IDX] else -1
+    preference = (int(store.likert[user_id, INTELLIGENCE_PREFER_IDX]) - 3)/2.0
     scaled_score = raw_score*preference
     return scaled_score*2
 
-def get_hangout_frequency_score(user_info, c_info):
+def get_hangout_frequency_score(store, user_id, c_id):
     '''
     Computes a score between 0 and 2 for hangout frequency question (weight is 2).
 
     Arguments:
-        user_info (list): complete user response
-        c_info (list): complete candidate reponse
+        store (ResponseStore): compiled responses
+        user_id (int): id (index) of user
+        c_id (int): id (index) of candidate
 
     Returns:
         score (float): normalized score between user answer and candidate answer
     '''
-    question_idx = 36
-    category_idx = { "Every meal" : 0,
-                     "Once a day": 1,
-                     "Couple times a week": 2,
-                     "Every weekend": 3,
-                     "Couple times a month": 4 } 
-    return get_distance(category_idx[user_info[question_idx]], category_idx[c_info[question_idx]], -1, 4.0)*2
-
-def get_music_score(user_info, c_info):
+    return get_distance(int(store.hangout[user_id]), int(store.hangout[c_id]), -1, 4.0)*2
+
+def get_music_score(store, user_id, c_id):
     '''
     Computes a score between 0 and 1 for music question.
 
     Arguments:
-        user_info (list): complete user response
-        c_info (list): complete candidate reponse
+        store (ResponseStore): compiled responses
+        user_id (int): id (index) of user
+        c_id (int): id (index) of candidate
 
     Returns:
         score (float): normalized score between user answer and candidate answer
     '''
-    question_idx = 43
-    return get_set_intersection_score((user_info[question_idx]).lower(), (c_info[question_idx]).lower())
+    return get_set_intersection_score(store.music[user_id], store.music[c_id])
 
-def get_enjoy_talking_score(user_info, c_info):
+def get_enjoy_talking_score(store, user_id, c_id):
     '''
     Computes a score between 0 and 2 for I enjoy talking about... question (weight is 2).
 
     Arguments:
-        user_info (list): complete user response
-        c_info (list): complete candidate reponse
+        store (ResponseStore): compiled responses
+        user_id (int): id (index) of user
+        c_id (int): id (index) of candidate
 
     Returns:
         score (float): normalized score between user answer and candidate answer
     '''
-    question_idx = 44
-    return get_set_intersection_score((user_info[question_idx]).lower(), (c_info[question_idx]).lower())*2
+    return get_set_intersection_score(store.enjoy_talking[user_id], store.enjoy_talking[c_id])*2
 
-def get_chill_score(user_info, c_info):
+def get_chill_score(store, user_id, c_id):
     '''
     Computes a score between -1 and 1 for chill question.
 
     Arguments:
-        user_info (list): complete user response
-        c_info (list): complete candidate reponse
+        store (ResponseStore): compiled responses
+        user_id (int): id (index) of user
+        c_id (int): id (index) of candidate
 
     Returns:
         score (float): normalized score between user answer and candidate answer
     '''
-    question_idx = 45
-    category_idx = { "Literally down to do anything anytime anywhere anyhow anywhy." : 0,
-                     "Almost always down to go to L&L at 3am on a Wednesday.": 1,
-                     "\"I'm good with anything.\"": 2,
-                     "I get tilted when people flake on me.": 3,
-                     "I get pissed off when my roommate uses my tissue box without asking.": 4, 
-                     "I freak out when the utensils aren't exactly where they should be on the dinner table.": 5 }
-    return get_distance(category_idx[user_info[question_idx]], category_idx[c_info[question_idx]], -3, 2.0)
-
-def get_similarity_score(user_info, c_info):
+    return get_distance(int(store.chill[user_id]), int(store.chill[c_id]), -3, 2.0)
+
+def get_similarity_score(store, user_id, c_id):
     '''
     Computes cumulative score of all similarity questions between user and candidate.
-    Multiplies sum by how similar or dissimilar user wants the match to be. 
-    Large positive score indicates high similarity, large negative score indicates high dissimilarity. 
+    Multiplies sum by how similar or dissimilar user wants the match to be.
+    Large positive score indicates high similarity, large negative score indicates high dissimilarity.
 
     Arguments:
-        user_info (list): complete user response
-        c_info (list): complete candidate reponse
+        store (ResponseStore): compiled responses
+        user_id (int): id (index) of user
+        c_id (int): id (index) of candidate
 
     Returns:
         score (float): normalized score between user answer and candidate answers
     '''
-    question_idx = [16, 17, 21, 23, 27, 28, 34, 35, 37, 38, 39, 41, 42]
-    similarity_idx = 22
-    similarity_weight = (int(user_info[similarity_idx]) - 3)/2.0
-    score = sum([get_distance(int(user_info[idx]), int(c_info[idx]), -3, 2.0) for idx in question_idx])
-    score += get_music_score(user_info, c_info)
-    score += get_chill_score(user_info, c_info)
+    u_row = store.likert[user_id].tolist()
+    c_row = store.likert[c_id].tolist()
+    similarity_weight = (u_row[SIMILARITY_WEIGHT_IDX] - 3)/2.0
+    score = sum([get_distance(u_row[idx], c_row[idx], -3, 2.0) for idx in SIMILARITY_QUESTION_IDX])
+    score += get_music_score(store, user_id, c_id)
+    score += get_chill_score(store, user_id, c_id)
     return score*similarity_weight
 
-def get_activity_score(user_info, c_info):
+def get_activity_score(store, user_id, c_id):
     '''
     Computes cumulative score of all activity questions between user and candidate.
     Large score means user and candidate like to do similar activities with friends.
 
     Arguments:
-        user_info (list): complete user response
-        c_info (list): complete candidate reponse
+        store (ResponseStore): compiled responses
+        user_id (int): id (index) of user
+        c_id (int): id (index) of candidate
 
     Returns:
         score (float): normalized score between user answer and candidate answers
     '''
-    question_idx = [18, 24, 25, 26, 29, 30, 31, 32, 33]
-    score = sum([get_distance(int(user_info[idx]), int(c_info[idx]), -1, 4.0) for idx in question_idx])
-    contact_idx = 40
-    score += get_distance(int(user_info[contact_idx]), int(c_info[contact_idx]), -1, 4.0)*2
-    score += get_hangout_frequency_score(user_info, c_info)
+    u_row = store.likert[user_id].tolist()
+    c_row = store.likert[c_id].tolist()
+    score = sum([get_distance(u_row[idx], c_row[idx], -1, 4.0) for idx in ACTIVITY_QUESTION_IDX])
+    score += get_distance(u_row[CONTACT_IDX], c_row[CONTACT_IDX], -1, 4.0)*2
+    score += get_hangout_frequency_score(store, user_id, c_id)
     return score
@@ -0,0 +1,481 @@
+import os
+import csv
+import ssl
+import sys
+import time
+import random
+import asyncio
+import hashlib
+import threading
+import smtplib
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from email.message import EmailMessage
+
+'''
+send_emails.py
+--------------
+Delivery stage for the match emails: sends every row of the auto-email
+sheet written by create_auto_email_sheet.py (recipients, names, message)
+over SMTP, instead of handing the sheet to a Google Sheets script.
+
+Rows are streamed from the sheet into a bounded queue and sent by
+N_CONNECTIONS asyncio workers, each with its own persistent SMTP
+connection (smtplib is blocking, so each connection's calls run in a
+thread). All workers share a rate limit. A failed send is retried with
+exponential backoff and jitter on a fresh connection, unless the server
+refused it permanently (5xx).
+
+Each sent row is appended to a checkpoint file as soon as the server has
+accepted it, and rows already in the checkpoint are skipped, so an
+interrupted run can simply be rerun. Rows are keyed by a digest of their
+contents, so the checkpoint still applies if the sheet is regenerated in
+another order. A row is only sent twice if the run dies between the
+server accepting it and the checkpoint line being written.
+
+The password is read from the SQUAD_SMTP_PASSWORD environment variable.
+To try it out without sending anything, run the local stand-in server
+of smtp_sink.py:
+
+    python smtp_sink.py --port 8025
+    python send_emails.py --sheet Auto_email_sheet.csv --sender squad@example.com --host localhost --port 8025
+'''
+
+# Default auto-email sheet to send (DEST_CSV of create_auto_email_sheet.py, not
+# imported so sending doesn't load the sheet writer)
+SHEET_CSV = 'Auto_email_sheet.csv'
+
+# Default subject; %s is the names column of the sheet ('firstname1 and firstname2')
+SUBJECT = 'Squad match: %s'
+
+# Default SMTP server
+SMTP_HOST = 'localhost'
+SMTP_PORT = 25
+
+# Environment variable holding the SMTP password, if the server needs a login
+PASSWORD_ENV = 'SQUAD_SMTP_PASSWORD'
+
+# Number of persistent SMTP connections sending concurrently
+N_CONNECTIONS = 4
+
+# Max messages sent per second over all connections; None for no limit
+RATE_LIMIT = None
+
+# Number of times a failed send is retried, and the backoff before retries:
+# BACKOFF_SECONDS * 2**attempt, at most MAX_BACKOFF_SECONDS, with jitter
+MAX_RETRIES = 5
+BACKOFF_SECONDS = 1.0
+MAX_BACKOFF_SECONDS = 60.0
+
+# Socket timeout of the SMTP connections, in seconds
+SMTP_TIMEOUT = 30
+
+# Default checkpoint file of the sent rows
+CHECKPOINT_FILE = 'Sent_emails.txt'
+
+class SmtpConfig:
+    '''
+    SMTP server and message settings.
+
+    Attributes:
+        host (string): SMTP server host
+        port (int): SMTP server port
+        sender (string): From address of the messages
+        subject (string): subject template, with %s for the names column
+        security (string): None for plain SMTP, 'starttls' or 'ssl'
+        user (string): login user, or None to send without logging in
+        password (string): login password
+        timeout (float): socket timeout in seconds
+    '''
+    def __init__(self, host, port, sender, subject=SUBJECT, security=None, user=None, password=None,
+                 timeout=SMTP_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.sender = sender
+        self.subject = subject
+        self.security = security
+        self.user = user
+        self.password = password
+        self.timeout = timeout
+
+def connect(config):
+    '''
+    Opens and logs into an SMTP connection (blocking).
+
+    Arguments:
+        config (SmtpConfig): server settings
+
+    Returns:
+        connection (smtplib.SMTP): the open connection
+    '''
+    if config.security == 'ssl':
+        connection = smtplib.SMTP_SSL(config.host, config.port, timeout=config.timeout,
+                                      context=ssl.create_default_context())
+    else:
+        connection = smtplib.SMTP(config.host, config.port, timeout=config.timeout)
+        if config.security == 'starttls':
+            connection.starttls(context=ssl.create_default_context())
+    if config.user is not None:
+        connection.login(config.user, config.password)
+    return connection
+
+def close_connection(connection):
+    '''
+    Closes an SMTP connection, politely if it is still up (blocking).
+
+    Arguments:
+        connection (smtplib.SMTP): connection, or None
+
+    Returns:
+        None
+    '''
+    if connection is None:
+        return
+    try:
+        connection.quit()
+    except (smtplib.SMTPException, OSError):
+        connection.close()
+
+def get_row_key(row):
+    '''
+    Returns the checkpoint key of a sheet row.
+
+    Arguments:
+        row (list): [recipients, names, message]
+
+    Returns:
+        key (string): hex digest of the row's contents
+    '''
+    return hashlib.sha256('\0'.join(row).encode('utf-8')).hexdigest()
+
+def build_message(row, config):
+    '''
+    Builds the email of a sheet row.
+
+    Arguments:
+        row (list): [recipients, names, message]
+        config (SmtpConfig): sender and subject settings
+
+    Returns:
+        message (EmailMessage): html email to the row's recipients
+    '''
+    recipients, names, html_message = row
+    message = EmailMessage()
+    message['From'] = config.sender
+    message['To'] = ', '.join(email.strip() for email in recipients.split(','))
+    message['Subject'] = config.subject % names
+    message.set_content(html_message, subtype='html')
+    return message
+
+def is_permanent_error(error):
+    '''
+    Returns whether retrying a failed send can't help: the server refused
+    the message or every recipient with a 5xx reply.
+
+    Arguments:
+        error (Exception): error raised while sending
+
+    Returns:
+        permanent (boolean): True iff the send shouldn't be retried
+    '''
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(500 <= code < 600 for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 500 <= error.smtp_code < 600
+    return False
+
+def get_backoff(attempt):
+    '''
+    Returns the delay before retry number attempt (0-based), with jitter.
+
+    Arguments:
+        attempt (int): number of the failed attempt
+
+    Returns:
+        delay (float): seconds to wait
+    '''
+    return min(MAX_BACKOFF_SECONDS, BACKOFF_SECONDS * 2**attempt) * random.uniform(0.5, 1.0)
+
+class Checkpoint:
+    '''
+    Append-only file of the keys of the sent rows (see get_row_key).
+
+    Attributes:
+        path (string): checkpoint file
+        sent (set): keys of the rows sent so far, including earlier runs
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.sent = set()
+        if os.path.exists(path):
+            with open(path) as f:
+                # a line cut short by an interrupted run is not a complete key
+                self.sent = set(line.strip() for line in f if len(line.strip()) == 64)
+        self.f = open(path, mode='a')
+        self.lock = threading.Lock()
+
+    def mark(self, key):
+        '''
+        Records a row as sent, flushing it to the file right away. Called
+        from the connections' threads.
+
+        Arguments:
+            key (string): key of the row
+
+        Returns:
+            None
+        '''
+        with self.lock:
+            self.sent.add(key)
+            self.f.write(key + '\n')
+            self.f.flush()
+
+    def close(self):
+        '''
+        Closes the checkpoint file.
+        '''
+        self.f.close()
+
+class RateLimiter:
+    '''
+    Spaces out sends over all connections to at most rate per second.
+
+    Attributes:
+        interval (float): seconds between sends, 0 for no limit
+        next_time (float): loop time of the next allowed send
+    '''
+    def __init__(self, rate=None):
+        self.interval = 1.0/rate if rate else 0.0
+        self.next_time = 0.0
+
+    async def wait(self):
+        '''
+        Waits until the next send is allowed, and reserves it.
+        '''
+        if not self.interval:
+            return
+        now = asyncio.get_running_loop().time()
+        send_time = max(now, self.next_time)
+        self.next_time = send_time + self.interval
+        if send_time > now:
+            await asyncio.sleep(send_time - now)
+
+def iterate_sheet(sheet_csv):
+    '''
+    Streams the rows of an auto-email sheet.
+
+    Arguments:
+        sheet_csv (string): sheet written by create_auto_email_sheet.py
+
+    Returns:
+        rows (generator): [recipients, names, message] rows
+    '''
+    with open(sheet_csv, newline='', encoding='utf-8') as f:
+        csv_reader = csv.reader(f)
+        header = next(csv_reader, None)
+        if header is None:
+            return
+        indices = [header.index(column) for column in ['recipients', 'names', 'message']]
+        for row in csv_reader:
+            yield [row[i] for i in indices]
+
+class SmtpConnection:
+    '''
+    Persistent SMTP connection, opened on first use and reopened after an
+    error. Its methods block, and are only called from its worker's thread.
+
+    Attributes:
+        config (SmtpConfig): server settings
+        connection (smtplib.SMTP): the open connection, or None
+    '''
+    def __init__(self, config):
+        self.config = config
+        self.connection = None
+
+    def send(self, message, key, checkpoint):
+        '''
+        Sends a message and checkpoints it. Both happen in the same thread,
+        so a message the server accepted is checkpointed even if the run is
+        interrupted (e.g. with Ctrl-C) while it is being sent.
+
+        Arguments:
+            message (EmailMessage): message to send
+            key (string): checkpoint key of the message's row
+            checkpoint (Checkpoint): receives the key once the server accepts the message
+
+        Returns:
+            refused (dict): recipient -> (code, reply) of the recipients the server refused
+        '''
+        if self.connection is None:
+            self.connection = connect(self.config)
+        refused = self.connection.send_message(message)
+        checkpoint.mark(key)
+        return refused
+
+    def close(self):
+        '''
+        Closes the connection, if it is open.
+        '''
+        close_connection(self.connection)
+        self.connection = None
+
+async def send_worker(queue, config, limiter, checkpoint, stats, max_retries):
+    '''
+    Sends rows from the queue over one persistent connection, until it gets None.
+
+    Arguments:
+        queue (asyncio.Queue): (key, row) items, then None
+        config (SmtpConfig): server settings
+        limiter (RateLimiter): rate limit shared by the workers
+        checkpoint (Checkpoint): receives the sent rows
+        stats (dict): sent/failed/retries counts, and 'failures' and 'refused' lists, updated in place
+        max_retries (int): number of times a failed send is retried
+
+    Returns:
+        None
+    '''
+    loop = asyncio.get_running_loop()
+    # one thread per connection, so a send still running when the worker is cancelled
+    # finishes (and is checkpointed) before the connection is closed
+    executor = ThreadPoolExecutor(max_workers=1)
+    connection = SmtpConnection(config)
+    try:
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            key, row = item
+            message = build_message(row, config)
+            for attempt in range(max_retries + 1):
+                await limiter.wait()
+                try:
+                    refused = await loop.run_in_executor(executor, connection.send, message, key, checkpoint)
+                except (smtplib.SMTPException, OSError) as error:
+                    # the connection may be in any state; start over on a new one
+                    await loop.run_in_executor(executor, connection.close)
+                    if is_permanent_error(error) or attempt == max_retries:
+                        stats['failed'] += 1
+                        stats['failures'].append((row[0], repr(error)))
+                        break
+                    stats['retries'] += 1
+                    await asyncio.sleep(get_backoff(attempt))
+                else:
+                    stats['sent'] += 1
+                    if refused:
+                        stats['refused'].append((row[0], ', '.join(sorted(refused))))
+                    break
+    finally:
+        executor.submit(connection.close)
+        executor.shutdown(wait=True)
+
+async def send_sheet_async(sheet_csv, config, checkpoint, n_connections, rate_limit, max_retries):
+    '''
+    Sends the rows of a sheet that aren't in the checkpoint (see send_sheet).
+    '''
+    stats = {'sent': 0, 'skipped': 0, 'failed': 0, 'retries': 0, 'failures': [], 'refused': []}
+    queue = asyncio.Queue(maxsize=2*n_connections)
+    limiter = RateLimiter(rate_limit)
+    workers = [asyncio.create_task(send_worker(queue, config, limiter, checkpoint, stats, max_retries))
+               for _ in range(n_connections)]
+    try:
+        seen = set()
+        for row in iterate_sheet(sheet_csv):
+            key = get_row_key(row)
+            if key in checkpoint.sent or key in seen:
+                stats['skipped'] += 1
+                continue
+            seen.add(key)
+            await queue.put((key, row))
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+    finally:
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+    return stats
+
+def send_sheet(sheet_csv, config, checkpoint_file=CHECKPOINT_FILE, n_connections=N_CONNECTIONS,
+               rate_limit=RATE_LIMIT, max_retries=MAX_RETRIES):
+    '''
+    Sends every row of an auto-email sheet that isn't in the checkpoint
+    (see module docstring).
+
+    Arguments:
+        sheet_csv (string): sheet written by create_auto_email_sheet.py
+        config (SmtpConfig): server and message settings
+        checkpoint_file (string): file of the rows sent so far, read and appended to
+        n_connections (int): number of connections sending concurrently
+        rate_limit (float): max messages per second, or None for no limit
+        max_retries (int): number of times a failed send is retried
+
+    Returns:
+        stats (dict): sent, skipped (sent before), failed and retried rows,
+            failures as (recipients, error) tuples, sent rows with refused
+            recipients as (recipients, refused) tuples, seconds and messages_per_second
+    '''
+    checkpoint = Checkpoint(checkpoint_file)
+    start = time.perf_counter()
+    try:
+        stats = asyncio.run(send_sheet_async(sheet_csv, config, checkpoint, max(1, n_connections),
+                                             rate_limit, max_retries))
+    finally:
+        checkpoint.close()
+    stats['seconds'] = time.perf_counter() - start
+    stats['messages_per_second'] = stats['sent']/stats['seconds'] if stats['seconds'] > 0 else 0.0
+    return stats
+
+def print_send_stats(stats):
+    '''
+    Prints the outcome and throughput of send_sheet.
+
+    Arguments:
+        stats (dict): stats returned by send_sheet
+
+    Returns:
+        None
+    '''
+    print('Sent %d emails in %.1f s (%.1f messages/s), %d retries' %
+          (stats['sent'], stats['seconds'], stats['messages_per_second'], stats['retries']))
+    print('Skipped %d emails already sent' % stats['skipped'])
+    if stats['refused']:
+        print('%d emails were sent, but not to every recipient:' % len(stats['refused']))
+        for recipients, refused in stats['refused']:
+            print('-- %s | refused %s' % (recipients, refused))
+    if stats['failed']:
+        print('Failed to send %d emails; rerun to retry them:' % stats['failed'])
+        for recipients, error in stats['failures']:
+            print('-- %s | %s' % (recipients, error))
+
+def main():
+    '''
+    Command-line entry point; see python send_emails.py --help.
+    '''
+    parser = argparse.ArgumentParser(description='Send the match emails of an auto-email sheet over SMTP.')
+    parser.add_argument('--sheet', default=SHEET_CSV, help='auto-email sheet to send')
+    parser.add_argument('--sender', required=True, help='From address of the emails')
+    parser.add_argument('--subject', default=SUBJECT, help='subject, with %%s for the names')
+    parser.add_argument('--host', default=SMTP_HOST, help='SMTP server host')
+    parser.add_argument('--port', type=int, default=SMTP_PORT, help='SMTP server port')
+    parser.add_argument('--security', choices=['starttls', 'ssl'], help='encrypt the connections')
+    parser.add_argument('--user', help='SMTP login user; the password is read from $' + PASSWORD_ENV)
+    parser.add_argument('--checkpoint', default=CHECKPOINT_FILE, help='file recording the emails sent so far')
+    parser.add_argument('--connections', type=int, default=N_CONNECTIONS, help='number of concurrent SMTP connections')
+    parser.add_argument('--rate', type=float, default=RATE_LIMIT, help='max messages per second')
+    parser.add_argument('--retries', type=int, default=MAX_RETRIES, help='number of retries of a failed send')
+    args = parser.parse_args()
+
+    password = os.environ.get(PASSWORD_ENV)
+    if args.user is not None and password is None:
+        sys.exit('set $%s to log in as %s' % (PASSWORD_ENV, args.user))
+    config = SmtpConfig(args.host, args.port, args.sender, args.subject, args.security, args.user, password)
+    try:
+        stats = send_sheet(args.sheet, config, args.checkpoint, args.connections, args.rate, args.retries)
+    except KeyboardInterrupt:
+        sys.exit('Interrupted; the emails sent so far are in %s, rerun to send the rest' % args.checkpoint)
+    print_send_stats(stats)
+    if stats['failed']:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,598 @@
+import os
+import json
+import time
+import argparse
+import threading
+import socketserver
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+import numpy as np
+import squad
+from ingest import EMAIL_IDX, FIRST_NAME_IDX, LAST_NAME_IDX, validate_row, ingest_responses
+from snapshot import get_snapshot_key, load_snapshot, save_snapshot
+from store import N_COLUMNS, append_responses
+from fused import ScoreRanges, iterate_block_pairs, get_block_pair_edges
+from pairing import exp
+from incremental import load_match_state, get_users_digest, extend_score_ranges
+from history import get_identity_keys, load_history, get_excluded_keys
+
+'''
+service.py
+----------
+Long-running match query service. Loads the responses once (like
+load_responses in squad.py, but without changing squad's loaded responses),
+keeps the compiled responses and every user's min/max raw score over their
+valid candidates (the statistics scores are normalized with) in memory, and
+answers queries over local HTTP, on a TCP port or a Unix socket:
+
+    GET  /candidates?user=<id or email>&k=10&by=score   top-k valid candidates of a user
+    GET  /pair?user1=<id or email>&user2=<id or email>  scores of a pair, in both directions
+    POST /respondents  {"row": [<49 csv cells>]}         adds a respondent, returns their id
+    GET  /metrics                                       latency of each endpoint
+
+Scores follow filter() and score() in squad.py: a user's score for a
+candidate is normalized with the user's min/max (get_scores_map), and the
+match score of a mutual pair is S = exp(score of A for B) + exp(score of B
+for A), as in the matching. by=mutual ranks the mutual candidates by S.
+
+A query scores one user against everyone in both directions, O(N). Adding
+a respondent compiles their row onto a copy of the store and scores them
+against everyone, updating everyone's min/max, like an incremental run
+(see incremental.py); an existing user's scores can change as a result.
+
+Queries read an immutable snapshot of the service's state, and a new
+respondent is added by building the next snapshot and swapping it in, so
+any number of concurrent readers need no lock and never see a half-added
+user; additions are serialized.
+
+The min/max are computed with one pass of the fused kernel at startup,
+unless --state names a match state of the same responses (see
+--incremental in squad.py), whose min/max are reused.
+
+Usage:
+    python service.py --responses Responses.csv --port 8765
+    curl 'localhost:8765/candidates?user=12&k=5'
+'''
+
+# Default address of the service
+HOST = '127.0.0.1'
+PORT = 8765
+
+# Default number of candidates returned by /candidates
+DEFAULT_K = 10
+
+# Number of most recent requests per endpoint the latency percentiles are computed over
+METRICS_WINDOW = 10000
+
+# Largest request body accepted, in bytes
+MAX_BODY_BYTES = 2**20
+
+class QueryError(Exception):
+    '''
+    Invalid query, reported to the client with an http status.
+
+    Attributes:
+        status (int): http status code
+    '''
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+class ServiceState:
+    '''
+    Immutable snapshot of what queries read. Adding a respondent builds a
+    new snapshot, with copies of the containers it changes.
+
+    Attributes:
+        store (ResponseStore): compiled responses
+        ranges (ScoreRanges): min/max raw score of every user over their valid candidates
+        names (list): full name of each user
+        emails (list): email of each user
+        user_ids (dict): normalized email -> id of its latest response
+        user_keys (np.ndarray): uint64 identity key of each user (see history.py)
+        history_pairs (np.ndarray): (n, 2) uint64 pairs of the pair history
+    '''
+    def __init__(self, store, ranges, names, emails, user_ids, user_keys, history_pairs):
+        self.store = store
+        self.ranges = ranges
+        self.names = names
+        self.emails = emails
+        self.user_ids = user_ids
+        self.user_keys = user_keys
+        self.history_pairs = history_pairs
+
+class LatencyMetrics:
+    '''
+    Thread-safe request counts and latencies per endpoint.
+
+    Attributes:
+        window (int): number of most recent latencies kept per endpoint
+        started (float): time.time() when the metrics started
+    '''
+    def __init__(self, window=METRICS_WINDOW):
+        self.window = window
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.errors = {}
+        self.latencies = {}
+
+    def record(self, endpoint, seconds, failed):
+        '''
+        Records a handled request.
+
+        Arguments:
+            endpoint (string): endpoint path
+            seconds (float): time spent handling the request
+            failed (boolean): whether the request failed
+
+        Returns:
+            None
+        '''
+        with self.lock:
+            if endpoint not in self.counts:
+                self.counts[endpoint] = 0
+                self.errors[endpoint] = 0
+                self.latencies[endpoint] = deque(maxlen=self.window)
+            self.counts[endpoint] += 1
+            self.errors[endpoint] += failed
+            self.latencies[endpoint].append(seconds)
+
+    def to_dict(self):
+        '''
+        Summarizes the metrics.
+
+        Arguments:
+            None
+
+        Returns:
+            metrics (dict): uptime, and per endpoint the request and error counts and
+                the mean, p50, p95, p99 and max latency in ms of the latest requests
+        '''
+        with self.lock:
+            endpoints = dict((endpoint, (self.counts[endpoint], self.errors[endpoint], list(latencies)))
+                             for endpoint, latencies in self.latencies.items())
+        metrics = {'uptime_seconds': time.time() - self.started, 'endpoints': {}}
+        for endpoint, (count, errors, latencies) in sorted(endpoints.items()):
+            ms = np.array(latencies)*1000
+            p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+            metrics['endpoints'][endpoint] = {'requests': count, 'errors': errors, 'mean_ms': ms.mean(),
+                                              'p50_ms': p50, 'p95_ms': p95, 'p99_ms': p99, 'max_ms': ms.max()}
+        return metrics
+
+def get_email_key(email):
+    '''
+    Normalizes an email for lookups.
+
+    Arguments:
+        email (string): email
+
+    Returns:
+        key (string): stripped, lowercased email
+    '''
+    return email.strip().lower()
+
+def get_score_ranges(store, state=None, params=None):
+    '''
+    Computes every user's min/max raw score over their valid candidates,
+    reusing a match state's if it covers the first users of store.
+
+    Arguments:
+        store (ResponseStore): compiled responses
+        state (MatchState): match state of an incremental run (see incremental.py), or None
+        params (dict): the state's digest parameters (see get_match_state_params in squad.py)
+
+    Returns:
+        ranges (ScoreRanges): min/max of every user
+    '''
+    if (state is not None and state.n_users <= store.n_users and
+            state.digest == get_users_digest(store, state.n_users, params)):
+        return extend_score_ranges(store, state.n_users, state)[0]
+    ranges = ScoreRanges(store.n_users)
+    for block_pair in iterate_block_pairs(store):
+        ranges.update(*block_pair)
+    return ranges
+
+def normalize_scores(raw, ids, ranges):
+    '''
+    Normalizes raw scores with the min/max of the users who gave them, as
+    get_normalized_map does.
+
+    Arguments:
+        raw (np.ndarray): raw scores
+        ids (np.ndarray): id of the user who gave each score
+        ranges (ScoreRanges): min/max of every user
+
+    Returns:
+        normalized (np.ndarray): normalized scores
+    '''
+    min_score = ranges.min_score[ids]
+    score_range = ranges.max_score[ids] - min_score
+    if np.any(score_range == 0):
+        raise ZeroDivisionError('float division by zero')
+    return (raw - min_score)/score_range
+
+class MatchService:
+    '''
+    In-memory match queries (see module docstring).
+
+    Attributes:
+        state (ServiceState): snapshot the queries read
+        metrics (LatencyMetrics): latency of each endpoint
+    '''
+    def __init__(self, state):
+        self.state = state
+        self.metrics = LatencyMetrics()
+        self.write_lock = threading.Lock()
+
+    def get_user_id(self, state, user):
+        '''
+        Looks up a user by id or email.
+
+        Arguments:
+            state (ServiceState): snapshot to look in
+            user (string): user id, or email
+
+        Returns:
+            user_id (int): id of the user
+        '''
+        if user is None:
+            raise QueryError('missing user')
+        if user.strip().isdigit():
+            user_id = int(user)
+        else:
+            user_id = state.user_ids.get(get_email_key(user), -1)
+        if not 0 <= user_id < state.store.n_users:
+            raise QueryError('unknown user %r' % user, 404)
+        return user_id
+
+    def get_user(self, state, user_id):
+        '''
+        Describes a user.
+
+        Arguments:
+            state (ServiceState): snapshot to read
+            user_id (int): id of the user
+
+        Returns:
+            user (dict): id, name and email of the user
+        '''
+        return {'id': user_id, 'name': state.names[user_id], 'email': state.emails[user_id]}
+
+    def score_user(self, state, user_id):
+        '''
+        Scores a user against everyone, in both directions.
+
+        Arguments:
+            state (ServiceState): snapshot to read
+            user_id (int): id of the user
+
+        Returns:
+            forward (np.ndarray): (N,) normalized score of the user for each candidate
+            forward_eligible (np.ndarray): (N,) candidates that pass the user's filters
+            backward (np.ndarray): (N,) normalized score of each candidate for the user
+            backward_eligible (np.ndarray): (N,) candidates whose filters the user passes
+        '''
+        all_ids = np.arange(state.store.n_users)
+        forward, forward_eligible, backward, backward_eligible = get_block_pair_edges(
+            state.store, np.array([user_id]), all_ids, False)
+        forward_eligible, backward_eligible = forward_eligible[0], backward_eligible[:, 0]
+        forward_normalized = np.zeros(len(all_ids))
+        backward_normalized = np.zeros(len(all_ids))
+        forward_normalized[forward_eligible] = normalize_scores(forward[0, forward_eligible], user_id, state.ranges)
+        backward_normalized[backward_eligible] = normalize_scores(backward[backward_eligible, 0],
+                                                                  all_ids[backward_eligible], state.ranges)
+        return forward_normalized, forward_eligible, backward_normalized, backward_eligible
+
+    def get_candidates(self, user, k=DEFAULT_K, by='score'):
+        '''
+        Gets a user's top candidates.
+
+        Arguments:
+            user (string): user id, or email
+            k (int): number of candidates
+            by (string): 'score' to rank the valid candidates by the user's score for
+                them, 'mutual' to rank the mutual candidates by match score S
+
+        Returns:
+            result (dict): the user, their number of valid and mutual candidates,
+                and the top candidates with both scores
+        '''
+        state = self.state
+        if by not in ['score', 'mutual']:
+            raise QueryError("by must be 'score' or 'mutual'")
+        if k < 0:
+            raise QueryError('k must not be negative')
+        user_id = self.get_user_id(state, user)
+        forward, forward_eligible, backward, backward_eligible = self.score_user(state, user_id)
+        mutual = forward_eligible & backward_eligible
+        match_scores = np.zeros(len(forward))
+        match_scores[mutual] = exp(forward[mutual]) + exp(backward[mutual])
+
+        c_ids = np.flatnonzero(mutual if by == 'mutual' else forward_eligible)
+        values = (match_scores if by == 'mutual' else forward)[c_ids]
+        if len(c_ids) > k:
+            # everyone tied with the k-th best is kept, so ties are broken by id below
+            threshold = np.partition(values, len(values) - k)[len(values) - k] if k else np.inf
+            c_ids, values = c_ids[values >= threshold], values[values >= threshold]
+        top = c_ids[np.lexsort((c_ids, -values))][:k]
+
+        candidates = []
+        for c_id in top.tolist():
+            candidate = self.get_user(state, c_id)
+            candidate['score'] = forward[c_id] if forward_eligible[c_id] else None
+            candidate['reverse_score'] = backward[c_id] if backward_eligible[c_id] else None
+            candidate['match_score'] = match_scores[c_id] if mutual[c_id] else None
+            candidates.append(candidate)
+        return {'user': self.get_user(state, user_id), 'valid_candidates': int(forward_eligible.sum()),
+                'mutual_candidates': int(mutual.sum()), 'candidates': candidates}
+
+    def get_pair(self, user1, user2):
+        '''
+        Scores a pair of users in both directions.
+
+        Arguments:
+            user1 (string): user id, or email
+            user2 (string): user id, or email
+
+        Returns:
+            result (dict): both users, each one's normalized score for the other
+                (None if the other fails their filters) and the match score S
+                (None unless the pair is mutual)
+        '''
+        state = self.state
+        id1, id2 = self.get_user_id(state, user1), self.get_user_id(state, user2)
+        forward, forward_eligible, backward, backward_eligible = get_block_pair_edges(
+            state.store, np.array([id1]), np.array([id2]), False)
+        score1 = normalize_scores(forward[0], id1, state.ranges)[0] if forward_eligible[0, 0] else None
+        score2 = normalize_scores(backward[0], id2, state.ranges)[0] if backward_eligible[0, 0] else None
+        match_score = None
+        if score1 is not None and score2 is not None:
+            match_score = exp(np.array([score1, score2])).sum()
+        return {'user1': self.get_user(state, id1), 'user2': self.get_user(state, id2),
+                'score1': score1, 'score2': score2, 'match_score': match_score}
+
+    def add_respondent(self, row):
+        '''
+        Adds a respondent, as if their row were appended to the responses csv.
+
+        Arguments:
+            row (list): the respondent's csv row of strings
+
+        Returns:
+            result (dict): the new user
+        '''
+        if not isinstance(row, list) or not all(isinstance(cell, str) for cell in row):
+            raise QueryError('row must be a list of %d strings' % N_COLUMNS)
+        reasons = validate_row(row)
+        if reasons:
+            raise QueryError('invalid row: ' + '; '.join(reasons))
+
+        with self.write_lock:
+            state = self.state
+            n_old = state.store.n_users
+            store = append_responses(state.store, [row])
+            user_keys = state.user_keys
+            if len(state.history_pairs):
+                # the other pairs were re-keyed by append_responses; only the new user's are missing
+                user_keys = np.append(user_keys, get_identity_keys([row[EMAIL_IDX]]))
+                pairs = state.history_pairs[np.any(state.history_pairs == user_keys[n_old], axis=1)]
+                new_keys = get_excluded_keys(pairs, user_keys)
+                store.excluded_keys = np.insert(store.excluded_keys, np.searchsorted(store.excluded_keys, new_keys),
+                                                new_keys)
+            ranges = extend_score_ranges(store, n_old, state.ranges)[0]
+
+            names = state.names + [row[FIRST_NAME_IDX] + ' ' + row[LAST_NAME_IDX]]
+            emails = state.emails + [row[EMAIL_IDX]]
+            user_ids = dict(state.user_ids)
+            user_ids[get_email_key(row[EMAIL_IDX])] = n_old
+            self.state = ServiceState(store, ranges, names, emails, user_ids, user_keys, state.history_pairs)
+        return {'user': self.get_user(self.state, n_old), 'n_users': store.n_users}
+
+    def get_metrics(self):
+        '''
+        Gets the latency metrics and the number of users.
+
+        Arguments:
+            None
+
+        Returns:
+            result (dict): see LatencyMetrics.to_dict
+        '''
+        metrics = self.metrics.to_dict()
+        metrics['n_users'] = self.state.store.n_users
+        return metrics
+
+def load_service(responses_csv, snapshot_dir=None, state_npz=None, pair_history_dir=None):
+    '''
+    Loads the responses and builds the service's first snapshot.
+
+    Arguments:
+        responses_csv (string): path of the responses csv
+        snapshot_dir (string): response snapshot directory, or None to always parse the csv
+        state_npz (string): match state whose min/max to reuse if it matches, or None
+        pair_history_dir (string): pair history to exclude (see history.py), or None
+
+    Returns:
+        service (MatchService): the service
+    '''
+    # compiled here rather than through squad.load_responses, which would rebind squad's loaded responses
+    snapshot = None
+    if snapshot_dir is not None:
+        snapshot_key = get_snapshot_key(responses_csv, {'political_exempt_rows': squad.POLITICAL_FILTER_EXEMPT_IDS})
+        snapshot = load_snapshot(snapshot_dir, snapshot_key)
+    if snapshot is not None:
+        header, store, side_table, ingest_report = snapshot
+    else:
+        header, store, side_table, ingest_report = ingest_responses(responses_csv, squad.POLITICAL_FILTER_EXEMPT_IDS)
+        if snapshot_dir is not None:
+            save_snapshot(snapshot_dir, snapshot_key, header, store, side_table, ingest_report)
+    names = [first + ' ' + last for first, last in zip(side_table.first_names, side_table.last_names)]
+    emails = list(side_table.emails)
+    user_ids = dict((get_email_key(email), user_id) for user_id, email in enumerate(emails))
+
+    # applied here rather than through squad.PAIR_HISTORY_DIR, which would change it for every squad user
+    history_pairs = np.zeros((0, 2), dtype=np.uint64)
+    user_keys = np.zeros(0, dtype=np.uint64)
+    store.excluded_keys = np.zeros(0, dtype=np.int64)
+    if pair_history_dir is not None:
+        history_pairs = load_history(pair_history_dir)
+        user_keys = get_identity_keys(emails)
+        store.excluded_keys = get_excluded_keys(history_pairs, user_keys)
+
+    state = load_match_state(state_npz) if state_npz is not None else None
+    ranges = get_score_ranges(store, state, squad.get_match_state_params())
+    return MatchService(ServiceState(store, ranges, names, emails, user_ids, user_keys, history_pairs))
+
+class RequestHandler(BaseHTTPRequestHandler):
+    '''
+    Http handler of the service's endpoints; the service is server.service.
+    '''
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.handle_query('GET')
+
+    def do_POST(self):
+        self.handle_query('POST')
+
+    def handle_query(self, method):
+        '''
+        Answers a request with json, and records its latency.
+
+        Arguments:
+            method (string): http method
+
+        Returns:
+            None
+        '''
+        start = time.perf_counter()
+        url = urlsplit(self.path)
+        service = self.server.service
+        try:
+            result = self.answer(service, method, url.path, dict((name, values[-1]) for name, values
+                                                                 in parse_qs(url.query).items()))
+            status = 200
+        except QueryError as e:
+            result, status = {'error': str(e)}, e.status
+        except Exception as e:
+            result, status = {'error': '%s: %s' % (type(e).__name__, e)}, 500
+        body = json.dumps(result).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        endpoint = url.path if url.path in ['/candidates', '/pair', '/respondents', '/metrics'] else 'other'
+        service.metrics.record(endpoint, time.perf_counter() - start, status != 200)
+
+    def answer(self, service, method, path, params):
+        '''
+        Dispatches a request to the service.
+
+        Arguments:
+            service (MatchService): the service
+            method (string): http method
+            path (string): endpoint path
+            params (dict): query parameters
+
+        Returns:
+            result (dict): json-serializable answer
+        '''
+        if method == 'GET' and path == '/candidates':
+            try:
+                k = int(params.get('k', DEFAULT_K))
+            except ValueError:
+                raise QueryError('k must be an integer')
+            return service.get_candidates(params.get('user'), k, params.get('by', 'score'))
+        if method == 'GET' and path == '/pair':
+            return service.get_pair(params.get('user1'), params.get('user2'))
+        if method == 'GET' and path == '/metrics':
+            return service.get_metrics()
+        if method == 'POST' and path == '/respondents':
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+            except ValueError:
+                raise QueryError('invalid Content-Length')
+            if length < 0:
+                raise QueryError('invalid Content-Length')
+            if length > MAX_BODY_BYTES:
+                raise QueryError('request body too large', 413)
+            try:
+                body = json.loads(self.rfile.read(length).decode('utf-8'))
+            except ValueError:
+                raise QueryError('request body must be json')
+            if not isinstance(body, dict):
+                raise QueryError('request body must be a json object')
+            return service.add_respondent(body.get('row'))
+        raise QueryError('no endpoint %s %s' % (method, path), 404)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        # requests are counted in the latency metrics instead
+        pass
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    '''
+    Threaded http server on a Unix socket.
+    '''
+    daemon_threads = True
+
+def make_server(service, host=HOST, port=PORT, unix_socket=None):
+    '''
+    Creates a threaded http server for the service, one thread per connection.
+
+    Arguments:
+        service (MatchService): the service
+        host (string): address to listen on
+        port (int): port to listen on (0 for any free port)
+        unix_socket (string): path of a Unix socket to listen on instead, or None
+
+    Returns:
+        server (socketserver.BaseServer): the server; call serve_forever to run it
+    '''
+    if unix_socket is not None:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        server = UnixHTTPServer(unix_socket, RequestHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), RequestHandler)
+        server.daemon_threads = True
+    server.service = service
+    return server
+
+def main():
+    '''
+    Command-line entry point; see python service.py --help.
+    '''
+    parser = argparse.ArgumentParser(description='Serve match queries over the Squad responses.')
+    parser.add_argument('--responses', default=squad.RESPONSES_CSV, help='form responses csv to read')
+    parser.add_argument('--cache-dir', default=squad.SNAPSHOT_DIR, help='response snapshot directory')
+    parser.add_argument('--no-cache', action='store_true', help="don't read or write the response snapshot")
+    parser.add_argument('--state', help='reuse the score ranges of this match state file if it matches')
+    parser.add_argument('--pair-history', help="don't offer the matches of earlier rounds recorded in this directory")
+    parser.add_argument('--host', default=HOST, help='address to listen on')
+    parser.add_argument('--port', type=int, default=PORT, help='port to listen on')
+    parser.add_argument('--unix-socket', help='listen on this Unix socket instead of a port')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    service = load_service(args.responses, None if args.no_cache else args.cache_dir, args.state, args.pair_history)
+    server = make_server(service, args.host, args.port, args.unix_socket)
+    print('Loaded %d users in %.2fs; serving on %s' % (service.state.store.n_users, time.perf_counter() - start,
+                                                      args.unix_socket or 'http://%s:%d' % server.server_address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.unix_socket is not None and os.path.exists(args.unix_socket):
+            os.remove(args.unix_socket)
+
+if __name__ == '__main__':
+    main()
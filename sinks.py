@@ -0,0 +1,207 @@
+import csv
+import numpy as np
+
+'''
+sinks.py
+--------
+Outputs of the matching results. The pipeline passes the matches to
+write_results as an (n, 2) array of user ids, and every sink receives
+them RESULTS_CHUNK_ROWS matches at a time:
+
+    ResultsCsvSink      the results csv: name, email and blurb of both users of each match
+    EmailSheetSink      the auto-email sheet (see create_auto_email_sheet.py)
+    ConsoleSink         the matches printed to the console, up to a limit
+    BinaryResultsSink   the user ids of the matches, as an (n, 2) int32 .npy array
+
+The names, emails and blurbs of a chunk are looked up (with get_info in
+squad.py) only if a sink needs them, and once for all sinks, so nothing
+is read back from the results csv.
+
+A sink has a needs_info attribute and open(n_matches), write(match_ids, rows)
+and close() methods.
+'''
+
+# Number of matches handed to the sinks at a time
+RESULTS_CHUNK_ROWS = 4096
+
+# Columns of the results csv
+RESULTS_HEADER = ['name1', 'email1', 'blurb1', 'name2', 'email2', 'blurb2']
+
+def get_match_ids(match_pairs):
+    '''
+    Converts matches to the array the sinks take.
+
+    Arguments:
+        match_pairs (list): matches as tuples of user ids, or an (n, 2) array
+
+    Returns:
+        match_ids (np.ndarray): (n, 2) int64 user ids of each match
+    '''
+    return np.asarray(match_pairs, dtype=np.int64).reshape(-1, 2)
+
+class ResultsCsvSink:
+    '''
+    Writes each match as a row of the results csv, with name/email/blurb for each person.
+
+    Attributes:
+        needs_info (boolean): whether write needs the rows of get_info
+        results_csv (string): destination csv
+    '''
+    needs_info = True
+
+    def __init__(self, results_csv):
+        self.results_csv = results_csv
+        self.f = None
+        self.csv_writer = None
+
+    def open(self, n_matches):
+        '''
+        Opens the sink before the first chunk.
+
+        Arguments:
+            n_matches (int): total number of matches that will be written
+
+        Returns:
+            None
+        '''
+        self.f = open(self.results_csv, mode='w')
+        self.csv_writer = csv.writer(self.f, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+        self.csv_writer.writerow(RESULTS_HEADER)
+
+    def write(self, match_ids, rows):
+        '''
+        Writes a chunk of matches.
+
+        Arguments:
+            match_ids (np.ndarray): (n, 2) user ids of the chunk's matches
+            rows (list): [name1, email1, blurb1, name2, email2, blurb2] of each
+                match (see get_info in squad.py), or None if no sink needs_info
+
+        Returns:
+            None
+        '''
+        self.csv_writer.writerows(rows)
+
+    def close(self):
+        '''
+        Closes the sink after the last chunk.
+        '''
+        self.f.close()
+
+class EmailSheetSink:
+    '''
+    Writes the auto-email sheet of the matches (see create_auto_email_sheet.py).
+    Methods as in ResultsCsvSink.
+
+    Attributes:
+        dest_csv (string): destination csv
+    '''
+    needs_info = True
+
+    def __init__(self, dest_csv):
+        self.dest_csv = dest_csv
+        self.f = None
+
+    def open(self, n_matches):
+        # imported here, so the other sinks don't pull in create_auto_email_sheet and its multiprocessing
+        from create_auto_email_sheet import open_sheet
+        self.f = open_sheet(self.dest_csv)
+
+    def write(self, match_ids, rows):
+        from create_auto_email_sheet import render_chunk
+        self.f.write(render_chunk(rows))
+
+    def close(self):
+        self.f.close()
+
+class ConsoleSink:
+    '''
+    Prints the matches to the console, and how many were left out if there
+    are more than max_matches. Methods as in ResultsCsvSink.
+
+    Attributes:
+        max_matches (int): number of matches to print, or None for all
+        n_printed (int): number of matches printed so far
+    '''
+    needs_info = True
+
+    def __init__(self, max_matches=None):
+        self.max_matches = max_matches
+        self.n_printed = 0
+        self.n_matches = 0
+
+    def open(self, n_matches):
+        self.n_matches = n_matches
+        print(' ')
+
+    def write(self, match_ids, rows):
+        if self.max_matches is not None:
+            rows = rows[:max(0, self.max_matches - self.n_printed)]
+        lines = []
+        for name1, email1, blurb1, name2, email2, blurb2 in rows:
+            lines.append('-- %s | %s | %s\n-- %s | %s | %s\n \n' % (name1, email1, blurb1, name2, email2, blurb2))
+        print(''.join(lines), end='')
+        self.n_printed += len(rows)
+
+    def close(self):
+        if self.n_printed < self.n_matches:
+            print('... and %d more matches\n' % (self.n_matches - self.n_printed))
+
+class BinaryResultsSink:
+    '''
+    Writes the user ids of the matches as an (n, 2) int32 .npy array, in
+    assignment order, for downstream tools (read it back with np.load).
+    Methods as in ResultsCsvSink.
+
+    Attributes:
+        results_npy (string): destination .npy file
+    '''
+    needs_info = False
+
+    def __init__(self, results_npy):
+        self.results_npy = results_npy
+        self.f = None
+
+    def open(self, n_matches):
+        # the header is written up front, so the ids can be streamed after it
+        self.f = open(self.results_npy, mode='wb')
+        np.lib.format.write_array_header_1_0(self.f, {'descr': np.lib.format.dtype_to_descr(np.dtype('<i4')),
+                                                      'fortran_order': False, 'shape': (n_matches, 2)})
+
+    def write(self, match_ids, rows):
+        self.f.write(match_ids.astype('<i4').tobytes())
+
+    def close(self):
+        self.f.close()
+
+def write_results(match_ids, sinks, get_info, chunk_rows=RESULTS_CHUNK_ROWS):
+    '''
+    Hands the matches to every sink, chunk_rows at a time.
+
+    Arguments:
+        match_ids (np.ndarray): (n, 2) user ids of each match (see get_match_ids)
+        sinks (list): sinks to write to
+        get_info (function): get_info(id, include_blurb) -> [name, email, (blurb)] of a user
+        chunk_rows (int): number of matches per chunk
+
+    Returns:
+        None
+    '''
+    match_ids = get_match_ids(match_ids)
+    needs_info = any(sink.needs_info for sink in sinks)
+    opened = []
+    try:
+        for sink in sinks:
+            sink.open(len(match_ids))
+            opened.append(sink)
+        for start in range(0, len(match_ids), chunk_rows):
+            chunk = match_ids[start:start + chunk_rows]
+            rows = None
+            if needs_info:
+                rows = [get_info(id1, include_blurb=True) + get_info(id2, include_blurb=True)
+                        for id1, id2 in chunk.tolist()]
+            for sink in sinks:
+                sink.write(chunk, rows)
+    finally:
+        for sink in opened:
+            sink.close()
@@ -0,0 +1,165 @@
+import threading
+import argparse
+import socketserver
+
+'''
+smtp_sink.py
+------------
+Local stand-in SMTP server, for trying out send_emails.py without sending
+anything: every message is accepted and kept in memory (and its envelope
+printed, when run from the command line). It speaks just enough SMTP for
+smtplib (EHLO/HELO, MAIL, RCPT, DATA, RSET, NOOP and QUIT), without TLS or
+login, and can refuse the first messages with a transient error to try out
+the retries.
+
+Usage:
+    python smtp_sink.py --port 8025
+    python send_emails.py --sheet Auto_email_sheet.csv --sender squad@example.com --host localhost --port 8025
+'''
+
+# Default address of the sink
+HOST = '127.0.0.1'
+PORT = 8025
+
+# Reply to a message refused with a transient error
+TRANSIENT_REPLY = '451 Try again later'
+
+class SinkHandler(socketserver.StreamRequestHandler):
+    '''
+    One SMTP session; received messages are passed to server.deliver.
+    '''
+    def reply(self, line):
+        '''
+        Sends a reply line to the client.
+
+        Arguments:
+            line (string): reply, without the line break
+
+        Returns:
+            None
+        '''
+        self.wfile.write((line + '\r\n').encode('utf-8'))
+        self.wfile.flush()
+
+    def read_data(self):
+        '''
+        Reads a message up to the line with a single dot, undoing the dot stuffing.
+
+        Arguments:
+            None
+
+        Returns:
+            data (bytes): the message
+        '''
+        lines = []
+        for line in self.rfile:
+            if line == b'.\r\n':
+                break
+            lines.append(line[1:] if line.startswith(b'..') else line)
+        return b''.join(lines)
+
+    def handle(self):
+        self.server.open_session()
+        self.reply('220 %s smtp_sink' % HOST)
+        sender, recipients = None, []
+        for line in self.rfile:
+            command = line.decode('utf-8', 'replace').strip()
+            verb = command[:4].upper()
+            if verb in ['EHLO', 'HELO']:
+                self.reply('250 smtp_sink')
+            elif verb == 'MAIL':
+                sender, recipients = command[len('MAIL FROM:'):].strip(' <>'), []
+                self.reply('250 OK')
+            elif verb == 'RCPT':
+                recipients.append(command[len('RCPT TO:'):].strip(' <>'))
+                self.reply('250 OK')
+            elif verb == 'DATA':
+                if not recipients:
+                    self.reply('503 RCPT first')
+                    continue
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                self.reply(self.server.deliver(sender, recipients, self.read_data()))
+                sender, recipients = None, []
+            elif verb == 'RSET':
+                sender, recipients = None, []
+                self.reply('250 OK')
+            elif verb == 'NOOP':
+                self.reply('250 OK')
+            elif verb == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+class SinkServer(socketserver.ThreadingTCPServer):
+    '''
+    Threaded stand-in SMTP server, one thread per connection.
+
+    Attributes:
+        messages (list): (sender, recipients, data) of every accepted message
+        n_sessions (int): number of connections opened so far
+        n_failures (int): number of messages still to refuse with TRANSIENT_REPLY
+        verbose (boolean): whether to print the envelope of each accepted message
+    '''
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=(HOST, PORT), n_failures=0, verbose=False):
+        super().__init__(address, SinkHandler)
+        self.messages = []
+        self.n_sessions = 0
+        self.n_failures = n_failures
+        self.verbose = verbose
+        self.lock = threading.Lock()
+
+    def open_session(self):
+        '''
+        Counts a new connection. Called from the connections' threads.
+        '''
+        with self.lock:
+            self.n_sessions += 1
+
+    def deliver(self, sender, recipients, data):
+        '''
+        Accepts a message, unless it is one of the first n_failures. Called
+        from the connections' threads.
+
+        Arguments:
+            sender (string): envelope sender
+            recipients (list): envelope recipients
+            data (bytes): the message
+
+        Returns:
+            reply (string): SMTP reply to the message
+        '''
+        with self.lock:
+            if self.n_failures > 0:
+                self.n_failures -= 1
+                return TRANSIENT_REPLY
+            self.messages.append((sender, list(recipients), data))
+        if self.verbose:
+            print('From %s to %s, %d bytes' % (sender, ', '.join(recipients), len(data)))
+        return '250 OK'
+
+def main():
+    '''
+    Command-line entry point; see python smtp_sink.py --help.
+    '''
+    parser = argparse.ArgumentParser(description='Accept SMTP messages locally without sending them.')
+    parser.add_argument('--host', default=HOST, help='address to listen on')
+    parser.add_argument('--port', type=int, default=PORT, help='port to listen on')
+    parser.add_argument('--fail', type=int, default=0, help='refuse the first messages with a transient error')
+    args = parser.parse_args()
+
+    server = SinkServer((args.host, args.port), args.fail, verbose=True)
+    print('Accepting SMTP on %s:%d' % server.server_address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print('Accepted %d messages' % len(server.messages))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+import os
+import glob
+import json
+import hashlib
+import importlib
+import numpy as np
+from store import ResponseStore
+from ingest import SideTable, IngestReport
+from bitset import unpack_bitsets
+from eligibility import FILTER_QUESTIONS
+from cache import hash_file
+
+'''
+snapshot.py
+-----------
+Binary snapshot of the compiled responses, so a run skips parsing and
+validating the csv whenever it hasn't changed. A snapshot is two files
+named by a key that hashes the csv contents, the compile parameters and
+the source of the modules that compile it:
+
+    responses-<key>.npz        arrays of the ResponseStore, plus a json
+                               blob with the vocabularies, csv header and
+                               ingestion report
+    responses-<key>.side.json  the SideTable (names, emails, blurbs), which
+                               is only read the first time it is accessed
+
+A snapshot under any other key is stale: it is ignored, and removed when
+the new one is saved.
+'''
+
+# Bump when the snapshot format changes
+SNAPSHOT_VERSION = 1
+
+# Modules whose source determines the compiled responses
+COMPILE_MODULES = ['score', 'store', 'ingest', 'bitset', 'eligibility', 'snapshot']
+
+# ResponseStore attributes saved as arrays
+STORE_ARRAYS = ['likert', 'socioeconomic', 'hangout', 'chill', 'major', 'schools',
+                'music_bits', 'enjoy_talking_bits']
+
+# ResponseStore attributes saved in the json blob
+STORE_VOCABS = ['major_vocab', 'music_vocab', 'enjoy_talking_vocab', 'identity_vocab', 'preference_vocab']
+
+# Per-filter ResponseStore attributes saved as arrays, as '<attribute>.<filter name>'
+FILTER_ARRAYS = ['identity', 'preference', 'preference_mask']
+
+class LazySideTable:
+    '''
+    SideTable that is read from its snapshot file the first time one of its
+    fields is accessed.
+
+    Attributes:
+        path (string): path of the side table json file
+        n_users (int): number of users, known without reading the file
+    '''
+    def __init__(self, path, n_users):
+        self.path = path
+        self.n_users = n_users
+        self.table = None
+
+    def __len__(self):
+        return self.n_users
+
+    def __getattr__(self, name):
+        if name not in ['first_names', 'last_names', 'emails', 'blurbs', 'row_numbers']:
+            raise AttributeError(name)
+        if self.table is None:
+            with open(self.path, encoding='utf-8') as f:
+                self.table = SideTable()
+                self.table.__dict__.update(json.load(f))
+        return getattr(self.table, name)
+
+def get_snapshot_key(responses_csv, params):
+    '''
+    Computes the snapshot key for a responses csv and compile parameters.
+
+    Arguments:
+        responses_csv (string): path of the responses csv
+        params (dict): json-serializable parameters that affect the compiled responses
+
+    Returns:
+        key (string): hex digest
+    '''
+    hasher = hashlib.sha256()
+    hasher.update(json.dumps({'version': SNAPSHOT_VERSION, 'params': params}, sort_keys=True).encode())
+    hash_file(responses_csv, hasher)
+    for name in COMPILE_MODULES:
+        hash_file(importlib.import_module(name).__file__, hasher)
+    return hasher.hexdigest()
+
+def get_snapshot_paths(snapshot_dir, key):
+    '''
+    Returns the paths of the snapshot files for a key.
+
+    Arguments:
+        snapshot_dir (string): snapshot directory
+        key (string): snapshot key
+
+    Returns:
+        arrays_path (string): path of the .npz file
+        side_path (string): path of the side table json file
+    '''
+    prefix = os.path.join(snapshot_dir, 'responses-%s' % key)
+    return prefix + '.npz', prefix + '.side.json'
+
+def save_snapshot(snapshot_dir, key, header, store, side_table, report):
+    '''
+    Saves compiled responses under key, and removes snapshots saved under any other key.
+
+    Arguments:
+        snapshot_dir (string): snapshot directory, created if needed
+        key (string): snapshot key
+        header (list): header row of the csv
+        store (ResponseStore): compiled responses
+        side_table (SideTable): text fields of the responses
+        report (IngestReport): ingestion report
+
+    Returns:
+        None
+    '''
+    if not os.path.isdir(snapshot_dir):
+        os.makedirs(snapshot_dir)
+    arrays_path, side_path = get_snapshot_paths(snapshot_dir, key)
+
+    arrays = dict((name, getattr(store, name)) for name in STORE_ARRAYS)
+    for attribute in FILTER_ARRAYS:
+        for name, _, _ in FILTER_QUESTIONS:
+            arrays['%s.%s' % (attribute, name)] = getattr(store, attribute)[name]
+    metadata = dict((name, getattr(store, name)) for name in STORE_VOCABS)
+    metadata['n_users'] = store.n_users
+    metadata['political_exempt_ids'] = store.political_exempt_ids
+    metadata['header'] = header
+    metadata['report'] = report.__dict__
+    arrays['metadata'] = np.frombuffer(json.dumps(metadata).encode('utf-8'), dtype=np.uint8)
+
+    # the side table is written first, since a snapshot counts as saved once its .npz exists;
+    # both are written to temporary files first, so an interrupted run never leaves a partial snapshot
+    with open(side_path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(side_table.__dict__, f)
+    os.replace(side_path + '.tmp', side_path)
+    with open(arrays_path + '.tmp', 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(arrays_path + '.tmp', arrays_path)
+
+    for stale_path in glob.glob(os.path.join(snapshot_dir, 'responses-*')):
+        if stale_path not in [arrays_path, side_path]:
+            os.remove(stale_path)
+
+def load_snapshot(snapshot_dir, key):
+    '''
+    Loads the compiled responses saved under key, if they exist.
+
+    Arguments:
+        snapshot_dir (string): snapshot directory
+        key (string): snapshot key
+
+    Returns:
+        snapshot (tuple): (header, store, side_table, report) as returned by
+            ingest_responses, with a LazySideTable; None if there is no snapshot for key
+    '''
+    arrays_path, side_path = get_snapshot_paths(snapshot_dir, key)
+    if not os.path.exists(arrays_path) or not os.path.exists(side_path):
+        return None
+
+    with np.load(arrays_path) as arrays:
+        metadata = json.loads(arrays['metadata'].tobytes().decode('utf-8'))
+        store = ResponseStore()
+        for name in STORE_ARRAYS:
+            setattr(store, name, arrays[name])
+        for attribute in FILTER_ARRAYS:
+            for name, _, _ in FILTER_QUESTIONS:
+                getattr(store, attribute)[name] = arrays['%s.%s' % (attribute, name)]
+
+    for name in STORE_VOCABS:
+        setattr(store, name, metadata[name])
+    store.n_users = metadata['n_users']
+    store.political_exempt_ids = metadata['political_exempt_ids']
+    store.music = unpack_bitsets(store.music_bits)
+    store.enjoy_talking = unpack_bitsets(store.enjoy_talking_bits)
+
+    report = IngestReport()
+    report.__dict__.update(metadata['report'])
+    return metadata['header'], store, LazySideTable(side_path, store.n_users), report
@@ -1,10 +1,21 @@
 import os
 import re
-import csv
 import math
-import pandas as pd
+import argparse
 import numpy as np
 from score import *
+from ingest import ingest_responses
+from snapshot import get_snapshot_key, load_snapshot, save_snapshot
+from engine import score_block, get_score_matrix, normalize_rows, get_top_k_scores, get_class_candidates
+from eligibility import get_eligibility_matrix, get_filter_classes, get_pruning_stats, get_rejection_counts, get_history_block
+from pairing import get_mutual_edges, sort_edges, assign_matches
+from fused import ScoreRanges, get_fused_edges, iterate_fused_edges
+from incremental import MatchState, get_users_digest, save_match_state, load_match_state, extends_state, extend_matches
+from csr import ScoreMatrix, from_counts, from_candidates, normalize_score_matrix
+from cache import get_cache_key, load_edges, save_edges
+from profiling import RunProfile
+from history import get_identity_keys, load_history, get_excluded_keys, get_history_digest, save_round
+from sinks import ResultsCsvSink, ConsoleSink, BinaryResultsSink, get_match_ids, write_results
 
 '''
 squad.py
@@ -14,31 +25,168 @@ Authors: Laura Cruz-Albrecht, Tara Iyer, Eric Yanmin Xu, Glenn Yu | 2018
 This program implements the Squad friendship-recommendation algorithm.
 It takes as input a csv with responses to a questionnaire, and outputs
 3-6 friend suggestions for each user in the system.
+
+Importing this module has no side effects: call load_responses() before
+using the filter, scoring and matching functions, or run_squad() to run
+the whole pipeline. From the command line:
+
+    python squad.py --responses First_343_Responses_Manually_Parsed.csv --results Results.csv
 '''
 
-# Read the form responses into a matrix
+# Default form responses csv to read
 # See indices.txt for quick reference on index for each question/field
 RESPONSES_CSV = 'First_343_Responses_Manually_Parsed.csv'
-parsed_csv = [row for row in csv.reader(open(RESPONSES_CSV, 'r'))]
-responses_header = parsed_csv[0]
 
-# Note: can use subset, ie [1:k], while testing/debugging, but for final
-# run should use all, ie: `parsed_csv[1:]`
-responses = parsed_csv[1:]  
+# Rows of the responses csv (0-based, not counting the header) that are not
+# filtered on political party; these are user ids unless rows are quarantined
+POLITICAL_FILTER_EXEMPT_IDS = [80]
+
+# Default csv that rows failing validation are written to (see ingest.py)
+QUARANTINE_CSV = 'Quarantined_responses.csv'
+
+# Default directory where the compiled responses are snapshotted, so they are
+# only parsed again when the csv changes (see snapshot.py); None to always parse
+SNAPSHOT_DIR = '.squad_cache'
+
+# Loaded responses, set by load_responses: the csv they were read from, its
+# header row, the names/emails/blurbs of the users (see SideTable in ingest.py),
+# and how many rows were read and quarantined
+loaded_responses_csv = None
+responses_header = None
+side_table = None
+ingest_report = None
 
-N_users = len(responses)
+# Typed, columnar copy of responses that the scoring and filter functions read from
+store = None
+
+# Users grouped by their filter answers; users in the same preference class share candidates
+filter_classes = None
+
+N_users = 0
 MIN_MATCHES = 3
 MATCH_THRESHOLD = 5
 
-# CSV to write the recommendation results to
+# If set, only each user's TOP_K best candidates are kept, and scoring runs in
+# tiles whose temporaries fit in SCORING_MEMORY_BUDGET bytes; memory then grows
+# with N * TOP_K rather than N * N. If None, every valid candidate is kept.
+TOP_K = None
+SCORING_MEMORY_BUDGET = 256*2**20
+
+# Number of processes to score with, and number of users per task; with
+# N_WORKERS > 1 the compiled responses are shared with the workers (see parallel.py)
+N_WORKERS = 1
+CHUNK_SIZE = 256
+
+# Whether get_sorted_edges scores each unordered pair once and builds the edges
+# directly (see fused.py) instead of going through every user's candidate scores.
+# Only used with TOP_K = None and N_WORKERS = 1; the edges are identical either way
+FUSED_EDGES = True
+
+# If set, each user is only scored against their ANN_NEIGHBOURS nearest users
+# by answer vector (and the users they are nearest to), found with a random
+# projection forest (see ann.py), instead of every valid candidate. Scales
+# to large populations at the cost of missing some matches; TOP_K and
+# N_WORKERS don't apply. Measured recall of the exact greedy matches with the
+# ann.py defaults (100 neighbours, 16 trees, leaves of 128) on generated
+# cohorts: about 0.5 at 300-400 users and 0.23 at 3000 users (0.29 with 200
+# neighbours, 0.35 with 400); more trees barely help. Check a cohort with
+# python ann.py before relying on it
+ANN_NEIGHBOURS = None
+
+# If set, the mutual edges are sorted out of core with runs of at most this many
+# bytes, and streamed into the greedy matching (see extsort.py), for edge sets
+# that don't fit in memory. Uses the fused kernel, so needs the same settings
+# as FUSED_EDGES; skips the edge cache
+EDGE_MEMORY_BUDGET = None
+
+# Parent directory of the temporary run files; None for the system default
+EDGE_RUN_DIR = None
+
+# Default match state file of incremental runs (see incremental.py and run_squad)
+MATCH_STATE_NPZ = 'Match_state.npz'
+
+# Default csv to write the recommendation results to
 RESULTS_CSV = 'Results.csv'
 
-def is_gender_conflict(user_id, c_id):
+# Number of matches run_squad prints to the console (see sinks.py); None for all
+CONSOLE_MATCHES = None
+
+# Directory of the pairs matched in earlier rounds, which are never matched again
+# (see history.py); None to ignore the history
+PAIR_HISTORY_DIR = None
+
+# Name of this round in the pair history: its matches are recorded under it, and
+# an earlier record of it is not excluded, so rerunning a round gives the same matches
+HISTORY_ROUND = None
+
+# Directory where the sorted mutual edges are cached between runs (see cache.py);
+# set to None to always rescore
+SCORE_CACHE_DIR = '.squad_cache'
+
+# Default json file run_squad writes its run profile to (stage timings and peak memory,
+# filter rejections, pairs scored, edges built, ...; see profiling.py); None to skip
+RUN_PROFILE_JSON = 'Run_profile.json'
+
+# Whether the run profile traces peak memory per stage; this slows down the pure python stages
+PROFILE_MEMORY = True
+
+# None, 'cprofile' or 'sample': also record the functions the run spends the most time in
+PROFILE_MODE = None
+
+# Profile the pipeline functions record into; run_squad starts a fresh one per run
+run_profile = RunProfile(trace_memory=False)
+
+def load_responses(responses_csv=RESPONSES_CSV, quarantine_csv=QUARANTINE_CSV, snapshot_dir=SNAPSHOT_DIR):
     '''
-    Returns whether user user_id, and candidate c_id conflict with
-    regards to user_id's preference for gender.
+    Streams and validates the form responses csv, compiles the valid
+    responses for scoring and groups users by their filter answers. Invalid
+    rows are skipped and written to quarantine_csv. If snapshot_dir is set,
+    the compiled responses are loaded from a snapshot of the same csv
+    instead, or saved to one after compiling.
+
+    Arguments:
+        responses_csv (string): path of the responses csv
+        quarantine_csv (string): destination csv for invalid rows, or None
+        snapshot_dir (string): snapshot directory, or None to always parse the csv
+
+    Returns:
+        None
+    '''
+    global loaded_responses_csv, responses_header, side_table, ingest_report, store, filter_classes, N_users
+    snapshot = None
+    if snapshot_dir is not None:
+        snapshot_key = get_snapshot_key(responses_csv, {'political_exempt_rows': POLITICAL_FILTER_EXEMPT_IDS})
+        snapshot = load_snapshot(snapshot_dir, snapshot_key)
+    run_profile.set('snapshot_hit', snapshot is not None)
+
+    if snapshot is not None:
+        responses_header, store, side_table, ingest_report = snapshot
+    else:
+        responses_header, store, side_table, ingest_report = ingest_responses(
+            responses_csv, POLITICAL_FILTER_EXEMPT_IDS, quarantine_csv)
+        if snapshot_dir is not None:
+            save_snapshot(snapshot_dir, snapshot_key, responses_header, store, side_table, ingest_report)
+    loaded_responses_csv = responses_csv
+    filter_classes = get_filter_classes(store)
+    N_users = store.n_users
+
+    if PAIR_HISTORY_DIR is not None:
+        store.excluded_keys = get_excluded_keys(load_history(PAIR_HISTORY_DIR, HISTORY_ROUND),
+                                                get_identity_keys(side_table.emails))
+        run_profile.set('history_excluded_pairs', len(store.excluded_keys)//2)
+        print('Excluding %d pairs matched in earlier rounds\n' % (len(store.excluded_keys)//2))
+
+    if ingest_report.quarantined:
+        print('Quarantined %d of %d responses%s\n' % (len(ingest_report.quarantined), ingest_report.n_rows,
+                                                     ' (see %s)' % quarantine_csv if quarantine_csv else ''))
+
+def is_conflict(name, user_id, c_id):
+    '''
+    Returns whether user user_id, and candidate c_id conflict with regards
+    to user_id's preference for one of the filter questions.
 
     Arguments:
+        name (string): filter question; 'gender', 'religion' or 'party'
         user_id (int): id (index) of user we are trying to get matches for
         c_id (int): id (index) of candidate user
 
@@ -46,23 +194,26 @@ def is_gender_conflict(user_id, c_id):
         is_conflict (boolean): True if c_id is not a valid candidate
             for user_id, False otherwise
     '''
-    gender_idx = 6
-    gender_preference_idx = 7
+    # c is a valid candidate (no conflict) iff the bit of c's answer is in u's preference mask
+    # ('Any/all of the above' sets every bit)
+    u_mask = int(store.preference_mask[name][user_id])
+    c_bit = 1 << int(store.identity[name][c_id])
+    return u_mask & c_bit == 0
 
-    u_gender = responses[user_id][gender_idx]
-    c_gender = responses[c_id][gender_idx]
-    u_gender_preference = responses[user_id][gender_preference_idx]
-
-    # if 'Any/all of the above' in u's preferences, then c is valid candidate (no conflict)
-    if 'Any/all of the above' in u_gender_preference:
-        return False
+def is_gender_conflict(user_id, c_id):
+    '''
+    Returns whether user user_id, and candidate c_id conflict with
+    regards to user_id's preference for gender.
 
-    # if c's gender is in u's preferences, then c is valid candidate (no conflict)
-    if c_gender in u_gender_preference:
-        return False
+    Arguments:
+        user_id (int): id (index) of user we are trying to get matches for
+        c_id (int): id (index) of candidate user
 
-    # otherwise, there's a conflict
-    return True
+    Returns:
+        is_conflict (boolean): True if c_id is not a valid candidate
+            for user_id, False otherwise
+    '''
+    return is_conflict('gender', user_id, c_id)
 
 def is_religion_conflict(user_id, c_id):
     '''
@@ -77,28 +228,13 @@ def is_religion_conflict(user_id, c_id):
         is_conflict (boolean): True if c_id is not a valid candidate
             for user_id, False otherwise
     '''
-    religion_idx = 8
-    religion_preference_idx = 9
-
-    u_religion = responses[user_id][religion_idx]
-    c_religion = responses[c_id][religion_idx]
-    u_religion_preference = responses[user_id][religion_preference_idx]
-
-    # if 'Any/all of the above' in u's preferences, then c is valid candidate (no conflict)
-    if 'Any/all of the above' in u_religion_preference:
-        return False
-
-    # if c's religion is in u's preferences, then c is valid candidate (no conflict)
-    if c_religion in u_religion_preference:
-        return False
-
-    # otherwise, there's a conflict
-    return True
+    return is_conflict('religion', user_id, c_id)
 
 def is_political_conflict(user_id, c_id):
     '''
     Returns whether user user_id, and candidate c_id conflict with
-    regards to user_id's preference for political party.
+    regards to user_id's preference for political party. Users in
+    POLITICAL_FILTER_EXEMPT_IDS never have a conflict.
 
     Arguments:
         user_id (int): id (index) of user we are trying to get matches for
@@ -108,25 +244,7 @@ def is_political_conflict(user_id, c_id):
         is_conflict (boolean): True if c_id is not a valid candidate
             for user_id, False otherwise
     '''
-    if user_id == 80:
-        return False
-    party_idx = 10
-    party_preference_idx = 11
-
-    u_party = responses[user_id][party_idx]
-    c_party = responses[c_id][party_idx]
-    u_party_preference = responses[user_id][party_preference_idx]
-
-    # if 'Any/all of the above' in u's preferences, then c is valid candidate (no conflict)
-    if 'Any/all of the above' in u_party_preference:
-        return False
-
-    # if c's party is in u's preferences, then c is valid candidate (no conflict)
-    if c_party in u_party_preference:
-        return False
-
-    # otherwise, there's a conflict
-    return True
+    return is_conflict('party', user_id, c_id)
 
 def filter(user_id):
     '''
@@ -142,20 +260,13 @@ def filter(user_id):
                 user_id's filtering criteria
     '''
 
-    # initially make all users except the given user_id a candidate
-    candidate_flags = [True] * N_users
-    candidate_flags[user_id] = False
+    # users without a gender/religion/political party conflict are the members of the
+    # identity classes that user_id's preference class accepts
+    candidate_user_ids = filter_classes.get_candidates(filter_classes.preference_class[user_id])
 
-    # filter out candidates that have gender/religion/political party conflict
-    for c_id in range(N_users):
-        if (is_gender_conflict(user_id, c_id) 
-            or is_religion_conflict (user_id, c_id) 
-            or is_political_conflict(user_id, c_id)):
-            candidate_flags[c_id] = False
-
-    # use candidate_flags to get list of valid candidate ids
-    candidate_user_ids = [i for i in range(N_users) if candidate_flags[i]]
-    return candidate_user_ids
+    # a user is not their own candidate, nor the candidate of anyone they were matched with before
+    allowed = get_history_block(store, [user_id], candidate_user_ids)[0]
+    return [c_id for c_id in candidate_user_ids[allowed].tolist() if c_id != user_id]
 
 def score(user_id, c_id):
     '''
@@ -171,25 +282,30 @@ def score(user_id, c_id):
         score (float): value indicating how good of a match candididate c_id 
         is for user user_id.
     '''
-    score = get_socioeconomic_score(responses[user_id], responses[c_id])
-    score += get_majors_score(responses[user_id], responses[c_id])
-    score += get_intelligence_score(responses[user_id], responses[c_id])
-    score += get_enjoy_talking_score(responses[user_id], responses[c_id])
-    score += get_similarity_score(responses[user_id], responses[c_id])
-    score += get_activity_score(responses[user_id], responses[c_id])
+    score = get_socioeconomic_score(store, user_id, c_id)
+    score += get_majors_score(store, user_id, c_id)
+    score += get_intelligence_score(store, user_id, c_id)
+    score += get_enjoy_talking_score(store, user_id, c_id)
+    score += get_similarity_score(store, user_id, c_id)
+    score += get_activity_score(store, user_id, c_id)
     return score
 
 def get_normalized_map(scores_map):
     '''
     Normalizes the scores map so that all scores are between 0 and 1.
+    Given a ScoreMatrix (see csr.py), normalizes every user's row at once.
 
     Arguments:
         scores_map (int->float dict): map from user id to candidate score for each
-                                      valid candidate for user with id user_id
+                                      valid candidate for user with id user_id;
+                                      or a ScoreMatrix of the scores of all users
     
     Returns:
-        normalized_map (int->float dict): map from user id to candidate score between 0 and 1
+        normalized_map (int->float dict): map from user id to candidate score between 0 and 1;
+                                          a ScoreMatrix if given one
     '''
+    if isinstance(scores_map, ScoreMatrix):
+        return normalize_score_matrix(scores_map)
     if len(scores_map) == 0:
         return scores_map
     min_score = min(scores_map.values())
@@ -217,20 +333,87 @@ def get_scores_map(user_id):
     '''
     # gets list of candidate user ids
     candidate_user_ids = filter(user_id)
+    if len(candidate_user_ids) == 0:
+        return {}
 
-    # initialize scores map: key is candidate id, value is candidate score (init to 0)
-    scores_map = dict.fromkeys(candidate_user_ids, 0)
+    # score all candidates at once, then normalize
+    scores = score_block(store, [user_id], candidate_user_ids)
+    normalized = normalize_rows(scores, np.ones(scores.shape, dtype=bool))[0]
+    return dict(zip(candidate_user_ids, normalized.tolist()))
 
-    # score each candidate
-    for c_id in scores_map:
-        candidate_score = score(user_id, c_id)
-        scores_map[c_id] = candidate_score
-    
-    return get_normalized_map(scores_map)
+def get_all_candidates():
+    '''
+    Gets the filtering result for all users as a matrix.
+
+    Arguments:
+        None
+
+    Returns:
+        eligible (np.ndarray): N_users x N_users boolean matrix;
+            eligible[i, j] = True iff j is a valid candidate for user i
+    '''
+    return get_eligibility_matrix(store)
+
+def get_normalized_score_matrix():
+    '''
+    Gets the normalized candidate scores of all users, computed for all pairs at once.
+
+    Arguments:
+        None
+
+    Returns:
+        normalized (np.ndarray): N_users x N_users matrix; normalized[i, j] = normalized
+            score of candidate j for user i (0 if j is not a valid candidate)
+        eligible (np.ndarray): N_users x N_users boolean matrix of valid candidates
+    '''
+    eligible = get_all_candidates()
+    normalized = normalize_rows(get_score_matrix(store), eligible)
+    return normalized, eligible
+
+def get_all_scores():
+    '''
+    Gets the normalized candidate scores of all users. If ANN_NEIGHBOURS is
+    set, users are only scored against their approximate nearest neighbours
+    (see get_ann_scores in ann.py). If TOP_K is set, each
+    user only keeps their TOP_K best candidates (see get_top_k_scores in engine.py).
+    If N_WORKERS > 1, users are scored in parallel. Otherwise users are scored
+    one filter class at a time, against only their valid candidates.
+
+    Arguments:
+        None
+
+    Returns:
+        scores (ScoreMatrix): row i holds user i's valid candidates and their
+            scores, in candidate id order (see csr.py)
+    '''
+    stats = get_pruning_stats(filter_classes)
+    run_profile.set('filter_rejections', get_rejection_counts(store, filter_classes))
+    run_profile.set('eligible_pairs', stats['eligible_pairs'])
+
+    if ANN_NEIGHBOURS is not None:
+        from ann import get_ann_scores
+        scores, n_pairs = get_ann_scores(store, ANN_NEIGHBOURS)
+        run_profile.set('pairs_scored', n_pairs)
+        return scores
+
+    # the parallel and top-K paths score every pair, and drop the ineligible ones afterwards
+    run_profile.set('pairs_scored', N_users*N_users if N_WORKERS > 1 or TOP_K is not None else stats['eligible_pairs'])
+
+    if N_WORKERS > 1:
+        from parallel import get_all_scores_parallel
+        return get_all_scores_parallel(store, N_WORKERS, CHUNK_SIZE, TOP_K, SCORING_MEMORY_BUDGET)
+
+    if TOP_K is not None:
+        top_ids, top_scores = get_top_k_scores(store, TOP_K, SCORING_MEMORY_BUDGET)
+        valid = top_ids >= 0
+        return from_counts(valid.sum(axis=1), top_ids[valid], top_scores[valid], sort=True)
+
+    print_pruning_stats(stats)
+    return from_candidates(get_class_candidates(store, filter_classes))
 
 def get_all_scores_maps():
     '''
-    Gets scores map for all users.
+    Gets scores map for all users (see get_all_scores).
 
     Arguments:
         None
@@ -239,16 +422,30 @@ def get_all_scores_maps():
         scores_map_list (list of int->float dicts): list of scores map for all users;
             scores_map_list[i] = scores map (map from candidate to candidate score) for user i
     '''
-    scores_map_list = []
-    for i in range(N_users):
-        scores_map_for_i = get_scores_map(i)
-        scores_map_list.append(scores_map_for_i)
+    return get_all_scores().to_scores_maps()
+
+def print_pruning_stats(stats, pairs_scored=None):
+    '''
+    Prints how many of the N^2 candidate pairs the filters rule out, and how
+    many pairs were actually scored, if given.
 
-    return scores_map_list
+    Arguments:
+        stats (dict): see get_pruning_stats in eligibility.py
+        pairs_scored (int): number of (user, candidate) pairs scored, or None
 
-def get_all_pairings(scores_map_list):
+    Returns:
+        None
+    '''
+    print('%d identity classes, %d preference classes' % (stats['n_identity_classes'], stats['n_preference_classes']))
+    print('%d of %d candidate pairs pass the filters (%.1f%% pruned)'
+          % (stats['eligible_pairs'], stats['candidate_pairs'], 100*stats['pruned_fraction']))
+    if pairs_scored is not None:
+        print('Scored %d pairs' % pairs_scored)
+    print('')
+
+def get_all_pairings(scores):
     '''
-    Gets matches for all users, based on the scores_map and score function S.
+    Gets matches for all users, based on their candidate scores and score function S.
     In particular, for people A and B, compute match score S defined below
 
         S(A, B) = exp(A's score for B) + exp(B's score for A)
@@ -258,34 +455,208 @@ def get_all_pairings(scores_map_list):
     or at least one of them has at least MATCH_THRESHOLD matches.
 
     Arguments:
-        scores_map_list (list of int->float dicts): list of scores map for all users;
-            scores_map_list[i] = scores map (map from candidate to candidate score) for user i
+        scores (ScoreMatrix): candidate scores of all users (see get_all_scores)
 
     Returns:
-         match_pairs (list): a list of all matches between users expressed as tuples of user ids
-    '''
-    edges = []
-    for user1 in range(N_users):
-        for user2 in range(user1 + 1, N_users):
-            if user2 not in scores_map_list[user1] or user1 not in scores_map_list[user2]:
-                continue
-            match_score = math.exp(scores_map_list[user1][user2]) + math.exp(scores_map_list[user2][user1])
-            edges.append((user1, user2, match_score))
-    
-    edges.sort(key=lambda x: -x[2])
-    match_cnts = [0 for _ in range(N_users)]
-    match_pairs = []
-    for user1, user2, _ in edges:
-        if match_cnts[user1] >= MIN_MATCHES and match_cnts[user2] >= MIN_MATCHES:
-            continue
-        elif match_cnts[user1] >= MATCH_THRESHOLD or match_cnts[user2] >= MATCH_THRESHOLD:
-            continue
-        match_cnts[user1] += 1
-        match_cnts[user2] += 1
-        match_pairs.append((user1, user2))
+         match_ids (np.ndarray): (n, 2) user ids of each match, in assignment order
+    '''
+    edge_u, edge_v, _ = get_edges_from_scores(scores)
+    return get_pairings_from_edges(edge_u, edge_v)
+
+def get_edges_from_scores(scores):
+    '''
+    Builds the mutual edges from the candidate scores, sorted by decreasing match score S.
+
+    Arguments:
+        scores (ScoreMatrix): candidate scores of all users
+
+    Returns:
+        edge_u (np.ndarray): first user of each edge, best edge first
+        edge_v (np.ndarray): second user of each edge
+        edge_scores (np.ndarray): match score S of each edge
+    '''
+    # mutual edges as (user1, user2, score) arrays, user1 < user2 (see pairing.py)
+    with run_profile.time('get_mutual_edges'):
+        edge_u, edge_v, edge_scores = get_mutual_edges(scores)
+    run_profile.set('mutual_edges', len(edge_scores))
+
+    with run_profile.time('sort_edges'):
+        order = sort_edges(edge_scores)
+        edge_u, edge_v, edge_scores = edge_u[order], edge_v[order], edge_scores[order]
+    return edge_u, edge_v, edge_scores
+
+def get_pairings_from_edges(edge_u, edge_v):
+    '''
+    Greedily assigns matches from mutual edges that are already sorted by
+    decreasing match score S (see get_all_pairings).
+
+    Arguments:
+        edge_u (np.ndarray): first user of each edge, best edge first
+        edge_v (np.ndarray): second user of each edge
+
+    Returns:
+         match_ids (np.ndarray): (n, 2) user ids of each match, in assignment order
+    '''
+    with run_profile.time('assign_matches'):
+        match_pairs, match_cnts, n_iterations = assign_matches(edge_u, edge_v, None, N_users, MIN_MATCHES, MATCH_THRESHOLD)
+    run_profile.set('greedy_iterations', n_iterations)
+    run_profile.set('matches', len(match_pairs))
+
+    print_match_stats(match_cnts)
+    return get_match_ids(match_pairs)
+
+def sweep_pairings(configs, cache_dir=SCORE_CACHE_DIR, n_workers=1):
+    '''
+    Gets the sorted mutual edges once, and runs the greedy matching on them
+    for every (MIN_MATCHES, MATCH_THRESHOLD) configuration (see sweep.py).
+
+    Arguments:
+        configs (list): (min_matches, match_threshold) tuples
+        cache_dir (string): edge cache directory, or None to always rescore
+        n_workers (int): number of processes to run configurations in
+
+    Returns:
+        results (list): matches, mean match score, histogram and greedy
+            iterations of each configuration, in configs order
+    '''
+    from sweep import sweep_matches
+    edge_u, edge_v, edge_scores = get_sorted_edges(cache_dir)
+    return sweep_matches(edge_u, edge_v, edge_scores, N_users, configs, n_workers)
+
+def is_external_sort():
+    '''
+    Returns whether the edges are sorted out of core (see EDGE_MEMORY_BUDGET).
+    '''
+    return EDGE_MEMORY_BUDGET is not None and ANN_NEIGHBOURS is None and TOP_K is None and N_WORKERS == 1
+
+def get_pairings_external():
+    '''
+    Gets all matches like get_all_pairings, but streams the mutual edges
+    through sorted runs on disk instead of holding them in memory.
+
+    Arguments:
+        None
 
+    Returns:
+         match_ids (np.ndarray): (n, 2) user ids of each match, in assignment order
+    '''
+    run_profile.set('filter_rejections', get_rejection_counts(store, filter_classes))
+    stats = get_pruning_stats(filter_classes)
+    run_profile.set('eligible_pairs', stats['eligible_pairs'])
+    print_pruning_stats(stats)
+
+    from extsort import assign_matches_external
+    with run_profile.time('assign_matches_external'):
+        match_pairs, match_cnts, external_stats = assign_matches_external(
+            iterate_fused_edges(store, classes=filter_classes), N_users, MIN_MATCHES, MATCH_THRESHOLD, EDGE_MEMORY_BUDGET, EDGE_RUN_DIR)
+    run_profile.set('mutual_edges', external_stats['edges'])
+    run_profile.set('edge_runs', external_stats['runs'])
+    run_profile.set('greedy_iterations', external_stats['greedy_iterations'])
+    run_profile.set('matches', len(match_pairs))
+
+    print_match_stats(match_cnts)
+    return get_match_ids(match_pairs)
+
+def get_match_state_params():
+    '''
+    Gets the parameters besides the responses that a match state depends on
+    (see get_users_digest in incremental.py).
+
+    Arguments:
+        None
+
+    Returns:
+        params (dict): json-serializable parameters
+    '''
+    return {'political_exempt_ids': POLITICAL_FILTER_EXEMPT_IDS}
+
+def get_pairings_incremental(state_npz=MATCH_STATE_NPZ):
+    '''
+    Gets all matches, extending the matches saved in state_npz if the loaded
+    responses only add users to that run, and saves the new match state
+    (see incremental.py). Otherwise matches everyone, like get_all_pairings.
+
+    Arguments:
+        state_npz (string): match state file, read if it exists and rewritten
+
+    Returns:
+         match_ids (np.ndarray): (n, 2) user ids of each match, in assignment order
+    '''
+    if ANN_NEIGHBOURS is not None or TOP_K is not None or N_WORKERS != 1:
+        raise ValueError('incremental matching needs ANN_NEIGHBOURS = None, TOP_K = None and N_WORKERS = 1')
+    params = get_match_state_params()
+    state = load_match_state(state_npz)
+    if extends_state(state, store, MIN_MATCHES, MATCH_THRESHOLD, params):
+        with run_profile.time('extend_matches'):
+            match_pairs, match_cnts, ranges, stats = extend_matches(store, state)
+        for name, value in stats.items():
+            run_profile.set(name, value)
+        print('Matched %d new users against %d existing users\n' % (stats['new_users'], state.n_users))
+    else:
+        stats = get_pruning_stats(filter_classes)
+        run_profile.set('eligible_pairs', stats['eligible_pairs'])
+        ranges = ScoreRanges(N_users)
+        with run_profile.time('get_fused_edges'):
+            edge_u, edge_v, _, n_pairs = get_fused_edges(store, ranges=ranges, classes=filter_classes)
+        run_profile.set('pairs_scored', n_pairs)
+        print_pruning_stats(stats, n_pairs)
+        run_profile.set('mutual_edges', len(edge_u))
+        with run_profile.time('assign_matches'):
+            match_pairs, match_cnts, n_iterations = assign_matches(edge_u, edge_v, None, N_users,
+                                                                   MIN_MATCHES, MATCH_THRESHOLD)
+        run_profile.set('greedy_iterations', n_iterations)
+
+    save_match_state(state_npz, MatchState(N_users, get_users_digest(store, N_users, params),
+                                           MIN_MATCHES, MATCH_THRESHOLD, ranges, match_pairs))
+    run_profile.set('matches', len(match_pairs))
     print_match_stats(match_cnts)
-    return match_pairs
+    return get_match_ids(match_pairs)
+
+def get_sorted_edges(cache_dir=SCORE_CACHE_DIR):
+    '''
+    Gets the mutual edges of all users sorted by decreasing match score S,
+    with the fused kernel if FUSED_EDGES applies. If cache_dir is set, edges are memory-mapped from the cache when it is
+    up to date with the loaded responses csv and the scoring code, and
+    otherwise computed and saved to it.
+
+    Arguments:
+        cache_dir (string): edge cache directory, or None to always rescore
+
+    Returns:
+        edge_u (np.ndarray): first user of each edge, best edge first
+        edge_v (np.ndarray): second user of each edge
+        edge_scores (np.ndarray): match score S of each edge
+    '''
+    if cache_dir is not None:
+        cache_key = get_cache_key(loaded_responses_csv, {'top_k': TOP_K, 'ann_neighbours': ANN_NEIGHBOURS,
+                                                  'political_exempt_ids': POLITICAL_FILTER_EXEMPT_IDS,
+                                                  'pair_history': get_history_digest(store.excluded_keys)})
+        edges = load_edges(cache_dir, cache_key)
+        run_profile.set('edge_cache_hit', edges is not None)
+        if edges is not None:
+            run_profile.set('mutual_edges', len(edges[0]))
+            return edges
+
+    if FUSED_EDGES and ANN_NEIGHBOURS is None and TOP_K is None and N_WORKERS == 1:
+        run_profile.set('filter_rejections', get_rejection_counts(store, filter_classes))
+        stats = get_pruning_stats(filter_classes)
+        run_profile.set('eligible_pairs', stats['eligible_pairs'])
+        with run_profile.time('get_fused_edges'):
+            edge_u, edge_v, edge_scores, n_pairs = get_fused_edges(store, classes=filter_classes)
+        run_profile.set('pairs_scored', n_pairs)
+        print_pruning_stats(stats, n_pairs)
+        run_profile.set('mutual_edges', len(edge_scores))
+    else:
+        with run_profile.time('get_all_scores'):
+            scores = get_all_scores()
+        run_profile.set('scores_kept', scores.nnz)
+        run_profile.set('score_matrix_bytes', scores.nbytes)
+        edge_u, edge_v, edge_scores = get_edges_from_scores(scores)
+        del scores
+
+    if cache_dir is not None:
+        save_edges(cache_dir, cache_key, edge_u, edge_v, edge_scores)
+    return edge_u, edge_v, edge_scores
 
 def print_match_stats(match_cnts):
     '''
@@ -304,9 +675,7 @@ def print_match_stats(match_cnts):
     for i in range(len(histogram)):
         print('%d users have %d matches.' % (histogram[i], i))
 
-    first_name_idx = 2
-    last_name_idx = 3
-    user_cnts = [(responses[user_id][first_name_idx], responses[user_id][last_name_idx], match_cnts[user_id]) \
+    user_cnts = [(side_table.first_names[user_id], side_table.last_names[user_id], match_cnts[user_id]) \
                  for user_id in range(N_users)]
     user_cnts.sort(key=lambda x: -x[2])
     for entry in user_cnts:
@@ -326,80 +695,165 @@ def get_info(id, include_blurb=False):
         info (list): list containing: [name, email, (optional) blurb]
             note: name consists of concatenating first and last time
     '''
-    email_idx = 1
-    first_name_idx = 2
-    last_name_idx = 3
-    blurb_idx = 46
-
-    row = responses[id]
-    name = row[first_name_idx] + ' ' + row[last_name_idx]
-    email = row[email_idx]
+    name = side_table.first_names[id] + ' ' + side_table.last_names[id]
+    email = side_table.emails[id]
 
     info = [name, email]
     if include_blurb:
-        blurb = row[blurb_idx]
+        blurb = side_table.blurbs[id]
         if len(blurb) < 1: blurb = 'None provided'
         info.append(blurb)
 
     return info
 
-def format_and_save(match_pairs):
+def format_and_save(match_pairs, results_csv=RESULTS_CSV):
     '''
     Formats and saves match pairs into a file. Each row is a single match
     pair, with name/email/blurb for each person.
 
     Arguments: 
-        match_pairs (list): list of tuples of ints, (id1, id2) of users where
-            at least one person was a recommendation (appeared in the top-3 list)
-            for the other person
+        match_pairs (np.ndarray): (n, 2) user ids of each match, or a list of
+            tuples of ints, (id1, id2) of users
+        results_csv (string): destination csv
 
     Returns:
         None
     '''
-    with open(RESULTS_CSV, mode='w') as f:
-        csv_writer = csv.writer(f, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-
-        # write header
-        header = [
-            'name1', 'email1', 'blurb1',
-            'name2', 'email2', 'blurb2', 
-        ]
-        csv_writer.writerow(header)
+    write_results(match_pairs, [ResultsCsvSink(results_csv)], get_info)
 
-        # write contents
-        for tup in match_pairs:
-            id1, id2 = tup
-            row = get_info(id1, include_blurb=True) + get_info(id2, include_blurb=True)
-            csv_writer.writerow(row)
-
-def print_results():
+def print_results(match_pairs, max_matches=CONSOLE_MATCHES):
     '''
-    Open results csv and print contents nicely to console.
+    Prints the matches nicely to console.
 
     Arguments:
-        None
+        match_pairs (np.ndarray): (n, 2) user ids of each match
+        max_matches (int): number of matches to print, or None for all
 
     Returns:
         None
     '''
-    df = pd.read_csv(RESULTS_CSV)
-    print (' ')
-    for index, row in df.iterrows():
-        print ('-- %s | %s | %s' % (row['name1'], row['email1'], row['blurb1']))
-        print ('-- %s | %s | %s' % (row['name2'], row['email2'], row['blurb2']))
-        print (' ')
+    write_results(match_pairs, [ConsoleSink(max_matches)], get_info)
 
-def run_squad():
-    # 1. for each person, get scores map containing candidate score for each valid candidate
-    scores_map_list = get_all_scores_maps()
-
-    # 2. get all matches as a list of tuples of user ids
-    match_pairs = get_all_pairings(scores_map_list)
-
-    # 3. extract and save the names/emails/blurbs to results csv file
-    format_and_save(match_pairs)
+def run_squad(responses_csv=RESPONSES_CSV, results_csv=RESULTS_CSV, cache_dir=SCORE_CACHE_DIR,
+              profile_json=RUN_PROFILE_JSON, quarantine_csv=QUARANTINE_CSV, state_npz=None,
+              email_sheet_csv=None, results_npy=None, console_matches=CONSOLE_MATCHES):
+    '''
+    Runs the whole pipeline: reads the responses, matches users, and saves
+    and prints the results.
 
-    # 4. open results csv and print contents nicely to console
-    print_results()
+    Arguments:
+        responses_csv (string): path of the responses csv
+        results_csv (string): destination csv for the matches
+        cache_dir (string): directory for the response snapshot and edge cache, or None
+            to always parse and rescore
+        profile_json (string): destination json for the run profile, or None
+        quarantine_csv (string): destination csv for invalid response rows, or None
+        state_npz (string): match state file to extend and update (see get_pairings_incremental),
+            or None to match everyone from scratch
+        email_sheet_csv (string): destination csv for the auto-email sheet, or None
+        results_npy (string): destination .npy file for the user ids of the matches, or None
+        console_matches (int): number of matches to print, or None for all
 
-run_squad()
+    Returns:
+        None
+    '''
+    global run_profile
+    run_profile = RunProfile(PROFILE_MEMORY)
+
+    with run_profile.profile_functions(PROFILE_MODE):
+        # 0. read and compile the form responses
+        with run_profile.stage('load_responses'):
+            load_responses(responses_csv, quarantine_csv, cache_dir)
+        run_profile.set('n_users', N_users)
+        run_profile.set('ingest', ingest_report.to_dict())
+
+        if state_npz is not None:
+            # 1-2. score only the users added since the saved run, and extend its matches
+            with run_profile.stage('get_pairings_incremental'):
+                match_ids = get_pairings_incremental(state_npz)
+        elif is_external_sort():
+            # 1-2. stream the mutual edges through sorted runs on disk into the matching
+            with run_profile.stage('get_pairings_external'):
+                match_ids = get_pairings_external()
+        else:
+            # 1. for each person, get scores map containing candidate score for each valid candidate,
+            #    and combine them into mutual edges sorted by match score (cached between runs)
+            with run_profile.stage('get_sorted_edges'):
+                edge_u, edge_v, _ = get_sorted_edges(cache_dir)
+
+            # 2. get all matches as a list of tuples of user ids
+            with run_profile.stage('get_pairings_from_edges'):
+                match_ids = get_pairings_from_edges(edge_u, edge_v)
+
+        # 3. look up the names/emails/blurbs of the matches and write them to the results csv,
+        #    the console and any other sinks, in one pass (see sinks.py)
+        sinks = [ResultsCsvSink(results_csv)]
+        if email_sheet_csv is not None:
+            from sinks import EmailSheetSink
+            sinks.append(EmailSheetSink(email_sheet_csv))
+        if results_npy is not None:
+            sinks.append(BinaryResultsSink(results_npy))
+        sinks.append(ConsoleSink(console_matches))
+        with run_profile.stage('write_results'):
+            write_results(match_ids, sinks, get_info)
+
+        # 4. record the matches in the pair history, so later rounds don't repeat them
+        if PAIR_HISTORY_DIR is not None and HISTORY_ROUND is not None:
+            with run_profile.stage('save_pair_history'):
+                emails = side_table.emails
+                save_round(PAIR_HISTORY_DIR, HISTORY_ROUND, [emails[id1] for id1 in match_ids[:, 0].tolist()],
+                           [emails[id2] for id2 in match_ids[:, 1].tolist()])
+
+    if profile_json is not None:
+        run_profile.save(profile_json)
+
+def main():
+    '''
+    Command-line entry point; see python squad.py --help.
+    '''
+    global TOP_K, N_WORKERS, ANN_NEIGHBOURS, EDGE_MEMORY_BUDGET, PROFILE_MODE, PAIR_HISTORY_DIR, HISTORY_ROUND
+    parser = argparse.ArgumentParser(description='Squad friendship-matching algorithm.')
+    parser.add_argument('--responses', default=RESPONSES_CSV, help='form responses csv to read')
+    parser.add_argument('--results', default=RESULTS_CSV, help='csv to write the matches to')
+    parser.add_argument('--email-sheet', help='also write the auto-email sheet to this csv')
+    parser.add_argument('--results-npy', help='also write the user ids of the matches to this .npy file')
+    parser.add_argument('--console-matches', type=int, default=CONSOLE_MATCHES,
+                        help='only print this many matches to the console')
+    parser.add_argument('--quarantine', default=QUARANTINE_CSV, help='csv to write invalid response rows to')
+    parser.add_argument('--cache-dir', default=SCORE_CACHE_DIR, help='response snapshot and edge cache directory')
+    parser.add_argument('--no-cache', action='store_true', help="don't read or write the snapshot or edge cache")
+    parser.add_argument('--profile-json', default=RUN_PROFILE_JSON, help='json file to write the run profile to')
+    parser.add_argument('--no-profile-json', action='store_true', help="don't write the run profile")
+    parser.add_argument('--profile-mode', choices=['cprofile', 'sample'], default=PROFILE_MODE,
+                        help='also record the functions the run spends the most time in')
+    parser.add_argument('--top-k', type=int, default=TOP_K, help="only keep each user's top k candidates")
+    parser.add_argument('--workers', type=int, default=N_WORKERS, help='number of processes to score with')
+    parser.add_argument('--ann-neighbours', type=int, default=ANN_NEIGHBOURS,
+                        help='only score each user against their n approximate nearest neighbours')
+    parser.add_argument('--edge-memory-mb', type=float,
+                        help='sort the match edges on disk, in runs of at most this many MiB')
+    parser.add_argument('--incremental', nargs='?', const=MATCH_STATE_NPZ,
+                        help='extend the matches saved in this match state file with any new responses')
+    parser.add_argument('--pair-history', default=PAIR_HISTORY_DIR,
+                        help="don't repeat the matches of earlier rounds recorded in this directory (see history.py)")
+    parser.add_argument('--history-round', default=HISTORY_ROUND,
+                        help='record the matches as this round of the pair history')
+    args = parser.parse_args()
+    if args.history_round is not None and args.pair_history is None:
+        parser.error('--history-round needs --pair-history')
+
+    TOP_K = args.top_k
+    N_WORKERS = args.workers
+    ANN_NEIGHBOURS = args.ann_neighbours
+    if args.edge_memory_mb is not None:
+        EDGE_MEMORY_BUDGET = int(args.edge_memory_mb*2**20)
+    PROFILE_MODE = args.profile_mode
+    PAIR_HISTORY_DIR = args.pair_history
+    HISTORY_ROUND = args.history_round
+    run_squad(args.responses, args.results,
+              None if args.no_cache else args.cache_dir,
+              None if args.no_profile_json else args.profile_json, args.quarantine, args.incremental,
+              args.email_sheet, args.results_npy, args.console_matches)
+
+if __name__ == '__main__':
+    main()
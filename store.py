@@ -0,0 +1,273 @@
+import numpy as np
+from score import *
+from eligibility import FILTER_QUESTIONS, get_preference_masks
+from bitset import pack_bitsets
+
+'''
+store.py
+--------
+Compiles the parsed questionnaire responses into typed, column-oriented
+numpy arrays. Every cell is parsed exactly once here, so the scoring
+functions in score.py never call int() or look up a category dict per pair.
+'''
+
+# Number of columns in the form csv (see indices.txt)
+N_COLUMNS = 49
+
+# Rows compiled at a time; a chunk's 1-5 answers are packed into int8 before the next chunk is read
+CHUNK_ROWS = 4096
+
+class ResponseStore:
+    '''
+    Compiled, columnar copy of the questionnaire responses.
+
+    Attributes:
+        n_users (int): number of users
+        likert (np.ndarray): int8 array of shape (n_users, N_COLUMNS); likert[i, idx] is
+            user i's 1-5 answer to question idx (0 if unanswered, or if idx is not a 1-5 question)
+        socioeconomic (np.ndarray): int8 code from CLASS_IDX per user, -1 if unanswered
+        hangout (np.ndarray): int8 code from HANGOUT_CATEGORY_IDX per user
+        chill (np.ndarray): int8 code from CHILL_CATEGORY_IDX per user
+        major (np.ndarray): int32 code into major_vocab per user
+        schools (np.ndarray): uint8 bitmask per user of the schools of their major (see get_schools)
+        music (list): integer bitset of music_vocab ids per user (see bitset.py)
+        enjoy_talking (list): integer bitset of enjoy_talking_vocab ids per user
+        music_bits (np.ndarray): music packed into (n_users, n_words) uint64 words
+        enjoy_talking_bits (np.ndarray): enjoy_talking packed into (n_users, n_words) uint64 words
+        major_vocab (dict): major string -> code
+        music_vocab (dict): music category -> id
+        enjoy_talking_vocab (dict): topic -> id
+        identity (dict): filter name (see FILTER_QUESTIONS) -> int16 bit position of each user's identity answer
+        identity_vocab (dict): filter name -> dict of identity answer -> bit position
+        preference (dict): filter name -> int32 code into preference_vocab of each user's preference answer
+        preference_vocab (dict): filter name -> dict of preference answer -> code
+        preference_mask (dict): filter name -> uint64 bitmask per user of the identities they accept
+        political_exempt_ids (list): ids of users exempt from the political party filter
+        excluded_keys (np.ndarray): sorted int64 keys user_id*n_users + c_id of the pairs
+            excluded by the pair history (see history.py), in both directions
+    '''
+    def __init__(self):
+        self.n_users = 0
+        self.likert = np.zeros((0, N_COLUMNS), dtype=np.int8)
+        self.socioeconomic = np.zeros(0, dtype=np.int8)
+        self.hangout = np.zeros(0, dtype=np.int8)
+        self.chill = np.zeros(0, dtype=np.int8)
+        self.major = np.zeros(0, dtype=np.int32)
+        self.schools = np.zeros(0, dtype=np.uint8)
+        self.music = []
+        self.enjoy_talking = []
+        self.music_bits = np.zeros((0, 1), dtype=np.uint64)
+        self.enjoy_talking_bits = np.zeros((0, 1), dtype=np.uint64)
+        self.major_vocab = {}
+        self.music_vocab = {}
+        self.enjoy_talking_vocab = {}
+        self.identity = {}
+        self.identity_vocab = {}
+        self.preference = {}
+        self.preference_vocab = {}
+        self.preference_mask = {}
+        self.political_exempt_ids = []
+        self.excluded_keys = np.zeros(0, dtype=np.int64)
+
+def get_code(vocab, value):
+    '''
+    Returns the code of value in vocab, adding it with the next free code if unseen.
+
+    Arguments:
+        vocab (dict): value -> code
+        value (hashable): value to encode
+
+    Returns:
+        code (int): code of value
+    '''
+    if value not in vocab:
+        vocab[value] = len(vocab)
+    return vocab[value]
+
+def parse_multi_select(answer):
+    '''
+    Splits a comma-separated multi-select answer into its (lowercased,
+    whitespace-stripped) items. An empty answer is the set {''}.
+
+    Arguments:
+        answer (string): raw multi-select answer
+
+    Returns:
+        items (set): set of answer items
+    '''
+    return set(''.join(answer.lower().split()).split(','))
+
+def encode_multi_select(vocab, answer):
+    '''
+    Encodes a multi-select answer as an integer bitset of vocabulary ids.
+
+    Arguments:
+        vocab (dict): item -> id, extended with unseen items
+        answer (string): raw multi-select answer
+
+    Returns:
+        bits (int): bit i is set iff the item with id i is in answer
+    '''
+    bits = 0
+    # sorted, so that ids don't depend on the set's (hash-seeded) iteration order
+    for item in sorted(parse_multi_select(answer)):
+        bits |= 1 << get_code(vocab, item)
+    return bits
+
+def get_schools_mask(major):
+    '''
+    Returns the schools of a major (see get_schools) as a bitmask.
+
+    Arguments:
+        major (string): major
+
+    Returns:
+        mask (int): bit s is set iff the major is part of school s
+    '''
+    mask = 0
+    for school in get_schools(major):
+        mask |= 1 << school
+    return mask
+
+def parse_likert(cell):
+    '''
+    Parses a 1-5 answer, mapping an empty cell to 0.
+
+    Arguments:
+        cell (string): raw csv cell
+
+    Returns:
+        rating (int): parsed answer
+    '''
+    cell = cell.strip()
+    return int(cell) if cell else 0
+
+def compile_responses(responses, political_exempt_ids=(), vocabularies=None):
+    '''
+    Compiles raw csv rows into a ResponseStore.
+
+    Arguments:
+        responses (iterable): rows of the parsed csv (without header), each a list of
+            strings; read once, so this can be a generator
+        political_exempt_ids (list): ids of users exempt from the political party filter
+        vocabularies (ResponseStore): store whose vocabularies are copied and extended,
+            so the codes agree with it (see append_responses), or None to start empty
+
+    Returns:
+        store (ResponseStore): compiled responses
+    '''
+    store = ResponseStore()
+    if vocabularies is not None:
+        store.major_vocab = dict(vocabularies.major_vocab)
+        store.music_vocab = dict(vocabularies.music_vocab)
+        store.enjoy_talking_vocab = dict(vocabularies.enjoy_talking_vocab)
+    likert_chunks, likert, socioeconomic, hangout, chill, major = [], [], [], [], [], []
+    schools_by_major = {}
+    identity = dict((name, []) for name, _, _ in FILTER_QUESTIONS)
+    preference = dict((name, []) for name, _, _ in FILTER_QUESTIONS)
+    for name, _, _ in FILTER_QUESTIONS:
+        store.identity_vocab[name] = dict(vocabularies.identity_vocab[name]) if vocabularies is not None else {}
+        store.preference_vocab[name] = dict(vocabularies.preference_vocab[name]) if vocabularies is not None else {}
+
+    for row in responses:
+        ratings = [0] * N_COLUMNS
+        for idx in LIKERT_IDX:
+            ratings[idx] = parse_likert(row[idx])
+        likert.append(ratings)
+        if len(likert) == CHUNK_ROWS:
+            likert_chunks.append(np.array(likert, dtype=np.int8))
+            likert = []
+
+        socioeconomic.append(CLASS_IDX.get(row[SOCIOECONOMIC_IDX], -1))
+        hangout.append(HANGOUT_CATEGORY_IDX[row[HANGOUT_IDX]])
+        chill.append(CHILL_CATEGORY_IDX[row[CHILL_IDX]])
+
+        major_code = get_code(store.major_vocab, row[MAJOR_IDX])
+        if major_code not in schools_by_major:
+            schools_by_major[major_code] = get_schools_mask(row[MAJOR_IDX])
+        major.append(major_code)
+
+        store.music.append(encode_multi_select(store.music_vocab, row[MUSIC_IDX]))
+        store.enjoy_talking.append(encode_multi_select(store.enjoy_talking_vocab, row[ENJOY_TALKING_IDX]))
+
+        for name, identity_idx, preference_idx in FILTER_QUESTIONS:
+            identity[name].append(get_code(store.identity_vocab[name], row[identity_idx]))
+            preference[name].append(get_code(store.preference_vocab[name], row[preference_idx]))
+
+    store.n_users = len(major)
+    likert_chunks.append(np.array(likert, dtype=np.int8).reshape(-1, N_COLUMNS))
+    store.likert = np.concatenate(likert_chunks)
+    store.socioeconomic = np.array(socioeconomic, dtype=np.int8)
+    store.hangout = np.array(hangout, dtype=np.int8)
+    store.chill = np.array(chill, dtype=np.int8)
+    store.major = np.array(major, dtype=np.int32)
+    store.schools = np.array([schools_by_major[m] for m in major], dtype=np.uint8)
+    store.music_bits = pack_bitsets(store.music, len(store.music_vocab))
+    store.enjoy_talking_bits = pack_bitsets(store.enjoy_talking, len(store.enjoy_talking_vocab))
+    store.political_exempt_ids = list(political_exempt_ids)
+    for name, _, _ in FILTER_QUESTIONS:
+        store.identity[name] = np.array(identity[name], dtype=np.int16)
+        store.preference[name] = np.array(preference[name], dtype=np.int32)
+    update_preference_masks(store)
+    return store
+
+def append_responses(store, responses):
+    '''
+    Compiles more rows onto a store, as if they followed its rows in the csv.
+    The store itself is left as it is, so it can still be read meanwhile: the
+    result is a new store, with copies of its arrays and vocabularies.
+
+    Arguments:
+        store (ResponseStore): compiled responses
+        responses (iterable): rows of the parsed csv, each a list of strings
+
+    Returns:
+        appended (ResponseStore): the users of store followed by the new users
+    '''
+    added = compile_responses(responses, vocabularies=store)
+    appended = ResponseStore()
+    appended.n_users = store.n_users + added.n_users
+    for name in ['likert', 'socioeconomic', 'hangout', 'chill', 'major', 'schools']:
+        setattr(appended, name, np.concatenate([getattr(store, name), getattr(added, name)]))
+    appended.music = store.music + added.music
+    appended.enjoy_talking = store.enjoy_talking + added.enjoy_talking
+
+    # the new rows are packed with the extended vocabularies, which may need more words
+    for name in ['music_bits', 'enjoy_talking_bits']:
+        bits, added_bits = getattr(store, name), getattr(added, name)
+        padded = np.zeros((store.n_users, added_bits.shape[1]), dtype=np.uint64)
+        padded[:, :bits.shape[1]] = bits
+        setattr(appended, name, np.concatenate([padded, added_bits]))
+
+    appended.major_vocab = added.major_vocab
+    appended.music_vocab = added.music_vocab
+    appended.enjoy_talking_vocab = added.enjoy_talking_vocab
+    appended.identity_vocab = added.identity_vocab
+    appended.preference_vocab = added.preference_vocab
+    for name, _, _ in FILTER_QUESTIONS:
+        appended.identity[name] = np.concatenate([store.identity[name], added.identity[name]])
+        appended.preference[name] = np.concatenate([store.preference[name], added.preference[name]])
+    appended.political_exempt_ids = list(store.political_exempt_ids)
+    update_preference_masks(appended)
+
+    # excluded pair keys are user_id*n_users + c_id, so they are re-keyed for the new number of users
+    if len(store.excluded_keys):
+        user_ids, c_ids = np.divmod(store.excluded_keys, store.n_users)
+        appended.excluded_keys = user_ids*appended.n_users + c_ids
+    return appended
+
+def update_preference_masks(store):
+    '''
+    Recomputes every user's filter preference bitmasks. Needs to be called
+    whenever new identity answers are added to the store's vocabularies.
+
+    Arguments:
+        store (ResponseStore): compiled responses
+
+    Returns:
+        None
+    '''
+    for name, _, _ in FILTER_QUESTIONS:
+        exempt_ids = store.political_exempt_ids if name == 'party' else ()
+        store.preference_mask[name] = get_preference_masks(store.preference[name], store.preference_vocab[name],
+                                                           store.identity_vocab[name], exempt_ids)
@@ -0,0 +1,155 @@
+import json
+import argparse
+import itertools
+import numpy as np
+from multiprocessing import Pool
+from pairing import assign_matches
+
+'''
+sweep.py
+--------
+Parameter sweep of the greedy matching. The mutual edges are built and
+sorted once (see get_sorted_edges in squad.py), and the greedy assignment
+is then run for every (MIN_MATCHES, MATCH_THRESHOLD) configuration of a
+grid, optionally in a process pool, giving a comparison table of:
+
+    matches       total number of matches
+    mean score    mean match score S of the matches
+    histogram     number of users with 0, 1, 2, ... matches
+
+Usage:
+    python sweep.py --responses First_343_Responses_Manually_Parsed.csv --min-matches 2 3 4 --thresholds 4 5 6
+'''
+
+# Edges of the sweep, set in each worker process by init_worker
+worker_edges = None
+
+def get_configs(min_matches_values, match_threshold_values):
+    '''
+    Lists every (min_matches, match_threshold) configuration of a grid.
+
+    Arguments:
+        min_matches_values (list): values of MIN_MATCHES
+        match_threshold_values (list): values of MATCH_THRESHOLD
+
+    Returns:
+        configs (list): (min_matches, match_threshold) tuples
+    '''
+    return list(itertools.product(min_matches_values, match_threshold_values))
+
+def run_config(edges, config):
+    '''
+    Runs the greedy assignment for one configuration.
+
+    Arguments:
+        edges (tuple): (edge_u, edge_v, edge_scores, n_users), edges sorted best first
+        config (tuple): (min_matches, match_threshold)
+
+    Returns:
+        result (dict): min_matches, match_threshold, matches, mean_score,
+            histogram and greedy iterations of the configuration
+    '''
+    edge_u, edge_v, edge_scores, n_users = edges
+    min_matches, match_threshold = config
+    match_pairs, match_cnts, n_iterations = assign_matches(edge_u, edge_v, None, n_users, min_matches, match_threshold)
+
+    # matches are assigned in edge order, so their edges are found among the first n_iterations
+    considered = edge_u[:n_iterations].astype(np.int64)*n_users + edge_v[:n_iterations]
+    order = np.argsort(considered)
+    pairs = np.array(match_pairs, dtype=np.int64).reshape(-1, 2)
+    matched = order[np.searchsorted(considered, pairs[:, 0]*n_users + pairs[:, 1], sorter=order)]
+    return {'min_matches': min_matches,
+            'match_threshold': match_threshold,
+            'matches': len(match_pairs),
+            'mean_score': float(np.mean(edge_scores[matched])) if len(match_pairs) else None,
+            'histogram': np.bincount(match_cnts, minlength=1).tolist() if n_users else [],
+            'iterations': n_iterations}
+
+def init_worker(edges):
+    '''
+    Pool initializer: keeps the edges in the worker process.
+
+    Arguments:
+        edges (tuple): (edge_u, edge_v, edge_scores, n_users)
+
+    Returns:
+        None
+    '''
+    global worker_edges
+    worker_edges = edges
+
+def run_worker_config(config):
+    '''
+    Pool task: runs one configuration on the worker's edges (see run_config).
+    '''
+    return run_config(worker_edges, config)
+
+def sweep_matches(edge_u, edge_v, edge_scores, n_users, configs, n_workers=1):
+    '''
+    Runs the greedy assignment for every configuration on the same sorted edges.
+
+    Arguments:
+        edge_u (np.ndarray): first user of each edge, best edge first
+        edge_v (np.ndarray): second user of each edge
+        edge_scores (np.ndarray): match score S of each edge
+        n_users (int): number of users
+        configs (list): (min_matches, match_threshold) tuples
+        n_workers (int): number of processes to run configurations in
+
+    Returns:
+        results (list): result of each configuration (see run_config), in configs order
+    '''
+    edges = (np.asarray(edge_u), np.asarray(edge_v), np.asarray(edge_scores), n_users)
+    if n_workers <= 1 or len(configs) <= 1:
+        return [run_config(edges, config) for config in configs]
+    # with the fork start method, workers inherit the edges instead of receiving a copy
+    with Pool(min(n_workers, len(configs)), initializer=init_worker, initargs=(edges,)) as pool:
+        return pool.map(run_worker_config, configs)
+
+def print_sweep(results):
+    '''
+    Prints a comparison table of the configurations.
+
+    Arguments:
+        results (list): results of sweep_matches
+
+    Returns:
+        None
+    '''
+    n_columns = max([len(result['histogram']) for result in results] + [1])
+    print('%5s %9s %8s %10s %10s  %s' % ('min', 'threshold', 'matches', 'mean S', 'iterations',
+                                         ' '.join('%6s' % ('=%d' % i) for i in range(n_columns))))
+    for result in results:
+        histogram = result['histogram'] + [0]*(n_columns - len(result['histogram']))
+        mean_score = '-' if result['mean_score'] is None else '%.4f' % result['mean_score']
+        print('%5d %9d %8d %10s %10d  %s' % (result['min_matches'], result['match_threshold'], result['matches'],
+                                             mean_score, result['iterations'],
+                                             ' '.join('%6d' % count for count in histogram)))
+
+def main():
+    '''
+    Command-line entry point: prints the sweep table of a responses csv.
+    '''
+    import squad
+    parser = argparse.ArgumentParser(description='Compare greedy matching configurations on the same scored edges.')
+    parser.add_argument('--responses', default=squad.RESPONSES_CSV, help='form responses csv to read')
+    parser.add_argument('--min-matches', type=int, nargs='+', default=[squad.MIN_MATCHES],
+                        help='values of MIN_MATCHES to try')
+    parser.add_argument('--thresholds', type=int, nargs='+', default=[squad.MATCH_THRESHOLD],
+                        help='values of MATCH_THRESHOLD to try')
+    parser.add_argument('--workers', type=int, default=1, help='number of processes to run configurations in')
+    parser.add_argument('--cache-dir', default=squad.SCORE_CACHE_DIR, help='response snapshot and edge cache directory')
+    parser.add_argument('--no-cache', action='store_true', help="don't read or write the snapshot or edge cache")
+    parser.add_argument('--json', help='json file to also write the results to')
+    args = parser.parse_args()
+
+    cache_dir = None if args.no_cache else args.cache_dir
+    squad.load_responses(args.responses, None, cache_dir)
+    results = squad.sweep_pairings(get_configs(args.min_matches, args.thresholds), cache_dir, args.workers)
+    print_sweep(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
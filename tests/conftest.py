@@ -0,0 +1,10 @@
+import os
+import sys
+
+'''
+conftest.py
+-----------
+Makes the repo's top-level modules importable from the tests.
+'''
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
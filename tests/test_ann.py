@@ -0,0 +1,24 @@
+import squad
+from ann import get_ann_scores, get_recall_report
+from generate_responses import write_responses_csv
+
+'''
+test_ann.py
+-----------
+Approximate candidate generation (see ann.py) recovers every exact match
+when every user is a neighbour.
+'''
+
+def test_recall_is_one_with_all_neighbours(tmp_path):
+    responses_csv = str(tmp_path / 'responses.csv')
+    write_responses_csv(responses_csv, 150, seed=23)
+    squad.load_responses(responses_csv, str(tmp_path / 'quarantined.csv'), None)
+
+    exact_scores = squad.get_all_scores()
+    exact_pairs = squad.get_all_pairings(exact_scores)
+    for n_neighbours in [squad.N_users, 2*squad.N_users]:
+        approx_scores, n_pairs = get_ann_scores(squad.store, n_neighbours)
+        report = get_recall_report(exact_pairs, squad.get_all_pairings(approx_scores), approx_scores)
+        assert report['exact_matches'] > 0
+        assert report['recall'] == 1.0
+        assert report['candidate_recall'] == 1.0
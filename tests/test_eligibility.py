@@ -0,0 +1,53 @@
+import csv
+import numpy as np
+import squad
+from eligibility import ANY_PREFERENCE, FILTER_QUESTIONS, get_pair_eligibility
+from generate_responses import generate_responses
+from ingest import get_header
+
+'''
+test_eligibility.py
+-------------------
+The bitmask filters (see eligibility.py) against the original string filters.
+'''
+
+def is_baseline_conflict(rows, name, identity_idx, preference_idx, user_id, c_id):
+    '''
+    The original is_gender/religion/political_conflict: substring match of the
+    candidate's answer in the user's preference, and user 80 exempt from the party filter.
+    '''
+    if name == 'party' and user_id == 80:
+        return False
+    preference = rows[user_id][preference_idx]
+    return ANY_PREFERENCE not in preference and rows[c_id][identity_idx] not in preference
+
+def test_pair_eligibility_equals_string_filters(tmp_path):
+    rows = list(generate_responses(120, seed=13))
+    # 'Christian' is a substring of 'Christianity', so user 0 also accepts user 3
+    rows[0][7:12] = [ANY_PREFERENCE, rows[0][8], 'Christianity', rows[0][10], ANY_PREFERENCE]
+    rows[3][6:12] = [rows[3][6], ANY_PREFERENCE, 'Christian', ANY_PREFERENCE, rows[3][10], ANY_PREFERENCE]
+    # 'Any/all of the above' accepts everyone, whatever else is selected
+    rows[1][9] = 'Judaism, ' + ANY_PREFERENCE
+    # user 80 is exempt from the party filter, so accepts non-Libertarians too
+    rows[80][7:12] = [ANY_PREFERENCE, rows[80][8], ANY_PREFERENCE, rows[80][10], 'Libertarian']
+    responses_csv = str(tmp_path / 'responses.csv')
+    with open(responses_csv, mode='w', newline='') as f:
+        csv.writer(f).writerows([get_header()] + rows)
+    squad.load_responses(responses_csv, str(tmp_path / 'quarantined.csv'), None)
+    assert squad.N_users == len(rows)
+
+    ids = np.arange(len(rows))
+    user_ids, c_ids = np.repeat(ids, len(ids)), np.tile(ids, len(ids))
+    expected = [user_id != c_id and not any(is_baseline_conflict(rows, name, identity_idx, preference_idx,
+                                                                 user_id, c_id)
+                                            for name, identity_idx, preference_idx in FILTER_QUESTIONS)
+                for user_id, c_id in zip(user_ids.tolist(), c_ids.tolist())]
+    eligible = get_pair_eligibility(squad.store, user_ids, c_ids)
+    assert eligible.tolist() == expected
+
+    # the fixture exercises each case
+    eligible = eligible.reshape(len(ids), len(ids))
+    assert eligible[0, 3]
+    assert eligible[80, [row[10] != 'Libertarian' for row in rows]].any()
+    for user_id in [0, 1, 80]:
+        assert squad.filter(user_id) == np.flatnonzero(eligible[user_id]).tolist()
@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+import squad
+from engine import score_block, normalize_rows
+from generate_responses import write_responses_csv
+
+'''
+test_engine.py
+--------------
+The vectorized scoring engine (see engine.py) against the per-pair score() in squad.py.
+'''
+
+def test_score_block_equals_score(tmp_path):
+    responses_csv = str(tmp_path / 'responses.csv')
+    write_responses_csv(responses_csv, 120, seed=11)
+    squad.load_responses(responses_csv, str(tmp_path / 'quarantined.csv'), None)
+    ids = np.arange(squad.N_users)
+    expected = np.array([[squad.score(user_id, c_id) for c_id in ids.tolist()] for user_id in ids.tolist()])
+    assert np.array_equal(score_block(squad.store, ids, ids), expected)
+
+    # blocks of other shapes, in any order
+    user_ids, c_ids = ids[::7], ids[::-3]
+    assert np.array_equal(score_block(squad.store, user_ids, c_ids), expected[np.ix_(user_ids, c_ids)])
+
+def test_normalize_rows_raises_if_all_scores_are_equal():
+    scores = np.array([[1.0, 2.0, 3.0], [4.0, 4.0, 0.0]])
+    eligible = np.array([[True, True, True], [True, True, False]])
+    with pytest.raises(ZeroDivisionError):
+        normalize_rows(scores, eligible)
+    with pytest.raises(ZeroDivisionError):
+        squad.get_normalized_map({0: 4.0, 1: 4.0})
+    assert normalize_rows(scores[:1], eligible[:1]).tolist() == [list(squad.get_normalized_map({0: 1.0, 1: 2.0, 2: 3.0}).values())]
+
+    # a user without any valid candidate has nothing to normalize
+    normalized = normalize_rows(scores, np.array([[True, False, True], [False, False, False]]))
+    assert np.array_equal(normalized, [[0.0, 0.0, 1.0], [0.0, 0.0, 0.0]])
@@ -0,0 +1,24 @@
+import squad
+from extsort import BYTES_PER_EDGE
+from generate_responses import write_responses_csv
+
+'''
+test_extsort.py
+---------------
+Out-of-core edge sorting and streamed matching (see extsort.py) against
+the in-memory get_all_pairings.
+'''
+
+def test_external_pairings_equal_in_memory(tmp_path, monkeypatch):
+    responses_csv = str(tmp_path / 'responses.csv')
+    write_responses_csv(responses_csv, 200, seed=19)
+    squad.load_responses(responses_csv, str(tmp_path / 'quarantined.csv'), None)
+    expected = squad.get_all_pairings(squad.get_all_scores())
+
+    # a budget of 500 edges per run
+    monkeypatch.setattr(squad, 'EDGE_MEMORY_BUDGET', 500*BYTES_PER_EDGE)
+    monkeypatch.setattr(squad, 'EDGE_RUN_DIR', str(tmp_path))
+    match_ids = squad.get_pairings_external()
+    assert squad.run_profile.counters['edge_runs'] >= 3
+    assert match_ids.tolist() == expected.tolist()
+    assert list(tmp_path.glob('squad_runs_*')) == []
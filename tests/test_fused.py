@@ -0,0 +1,42 @@
+import numpy as np
+import squad
+from eligibility import get_filter_classes, get_pruning_stats
+from fused import get_fused_edges
+from generate_responses import write_responses_csv
+
+'''
+test_fused.py
+-------------
+The fused mutual-edge kernel (see fused.py) only scores pairs that pass the filters.
+'''
+
+def load_store(tmp_path, n_users, seed):
+    '''
+    Loads n_users synthetic responses, and returns their compiled store.
+    '''
+    responses_csv = str(tmp_path / 'responses.csv')
+    write_responses_csv(responses_csv, n_users, seed=seed)
+    squad.load_responses(responses_csv, str(tmp_path / 'quarantined.csv'), None)
+    return squad.store
+
+def test_only_eligible_pairs_are_scored(tmp_path):
+    store = load_store(tmp_path, 400, 5)
+    classes = get_filter_classes(store)
+    n_pairs = get_fused_edges(store, classes=classes)[3]
+    assert n_pairs == get_pruning_stats(classes)['eligible_pairs']
+    assert n_pairs < store.n_users*(store.n_users - 1)
+
+def test_edges_do_not_depend_on_blocks(tmp_path):
+    store = load_store(tmp_path, 200, 5)
+
+    # two halves that only accept their own gender identity, so most block pairs are skipped
+    identity = store.identity['gender']
+    identity[:] = np.arange(store.n_users) % 2
+    store.preference_mask['gender'][:] = np.left_shift(np.uint64(1), identity.astype(np.uint64))
+    classes = get_filter_classes(store)
+
+    expected = get_fused_edges(store, store.n_users, classes=classes)
+    edges = get_fused_edges(store, 25, classes=classes)
+    for actual, wanted in zip(edges, expected):
+        assert np.array_equal(actual, wanted)
+    assert edges[3] == get_pruning_stats(classes)['eligible_pairs']
@@ -0,0 +1,49 @@
+import csv
+import squad
+from generate_responses import write_responses_csv
+
+'''
+test_incremental.py
+-------------------
+Incremental re-matching (see incremental.py) with a pair history present.
+'''
+
+def write_first_rows(src_csv, dest_csv, n_rows):
+    '''
+    Copies the header and the first n_rows responses of a csv.
+    '''
+    with open(src_csv, newline='') as f:
+        rows = list(csv.reader(f))[:n_rows + 1]
+    with open(dest_csv, mode='w', newline='') as f:
+        csv.writer(f).writerows(rows)
+
+def run(responses_csv, results_csv, state_npz=None):
+    '''
+    Runs the pipeline without caches, and returns its run profile counters.
+    '''
+    squad.run_squad(responses_csv, results_csv, None, None, None, state_npz, console_matches=0)
+    return squad.run_profile.counters
+
+def test_appended_responses_extend_state_with_pair_history(tmp_path, monkeypatch):
+    monkeypatch.setattr(squad, 'PROFILE_MEMORY', False)
+    monkeypatch.setattr(squad, 'PAIR_HISTORY_DIR', str(tmp_path / 'history'))
+    full_csv, part_csv = str(tmp_path / 'full.csv'), str(tmp_path / 'part.csv')
+    write_responses_csv(full_csv, 400, seed=3)
+    write_first_rows(full_csv, part_csv, 300)
+
+    # an earlier round, so this round's matching excludes some pairs
+    monkeypatch.setattr(squad, 'HISTORY_ROUND', 'r1')
+    run(part_csv, str(tmp_path / 'r1.csv'))
+    monkeypatch.setattr(squad, 'HISTORY_ROUND', 'r2')
+    state_npz = str(tmp_path / 'state.npz')
+    counters = run(part_csv, str(tmp_path / 'r2.csv'), state_npz)
+    assert counters['history_excluded_pairs'] > 0
+    assert 'new_users' not in counters
+
+    # the appended responses change the excluded keys, but not the pairs they stand for
+    counters = run(full_csv, str(tmp_path / 'r2_full.csv'), state_npz)
+    assert counters['new_users'] == 100
+    with open(str(tmp_path / 'r2.csv'), newline='') as f:
+        old_matches = list(csv.reader(f))
+    with open(str(tmp_path / 'r2_full.csv'), newline='') as f:
+        assert list(csv.reader(f))[:len(old_matches)] == old_matches
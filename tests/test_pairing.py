@@ -0,0 +1,69 @@
+import math
+import random
+import numpy as np
+import squad
+from csr import from_scores_maps
+from pairing import get_mutual_edges, sort_edges, assign_matches
+from generate_responses import write_responses_csv
+
+'''
+test_pairing.py
+---------------
+Mutual edges and greedy matching (see pairing.py) against the original
+get_all_pairings loop.
+'''
+
+def get_baseline_pairings(scores_map_list, min_matches, match_threshold):
+    '''
+    The original get_all_pairings: edges in (user1, user2) order, stably sorted by decreasing S.
+    '''
+    n_users = len(scores_map_list)
+    edges = []
+    for user1 in range(n_users):
+        for user2 in range(user1 + 1, n_users):
+            if user2 not in scores_map_list[user1] or user1 not in scores_map_list[user2]:
+                continue
+            match_score = math.exp(scores_map_list[user1][user2]) + math.exp(scores_map_list[user2][user1])
+            edges.append((user1, user2, match_score))
+
+    edges.sort(key=lambda x: -x[2])
+    match_cnts = [0 for _ in range(n_users)]
+    match_pairs = []
+    for user1, user2, _ in edges:
+        if match_cnts[user1] >= min_matches and match_cnts[user2] >= min_matches:
+            continue
+        elif match_cnts[user1] >= match_threshold or match_cnts[user2] >= match_threshold:
+            continue
+        match_cnts[user1] += 1
+        match_cnts[user2] += 1
+        match_pairs.append((user1, user2))
+    return match_pairs
+
+def get_pairings(scores_map_list, min_matches, match_threshold):
+    '''
+    Matches scores maps with the vectorized pairing.
+    '''
+    edge_u, edge_v, edge_scores = get_mutual_edges(from_scores_maps(scores_map_list))
+    return assign_matches(edge_u, edge_v, sort_edges(edge_scores), len(scores_map_list),
+                          min_matches, match_threshold)[0]
+
+def test_pairings_equal_baseline_on_cohort(tmp_path):
+    responses_csv = str(tmp_path / 'responses.csv')
+    write_responses_csv(responses_csv, 150, seed=17)
+    squad.load_responses(responses_csv, str(tmp_path / 'quarantined.csv'), None)
+    scores_map_list = squad.get_all_scores_maps()
+    expected = get_baseline_pairings(scores_map_list, squad.MIN_MATCHES, squad.MATCH_THRESHOLD)
+    match_ids = squad.get_all_pairings(squad.get_all_scores())
+    assert [tuple(pair) for pair in match_ids.tolist()] == expected
+
+def test_tied_edges_keep_baseline_order():
+    # scores from a few values, so most edges tie with many others
+    rng = random.Random(3)
+    n_users = 60
+    scores_map_list = [dict((c_id, rng.choice([0.0, 0.5, 1.0])) for c_id in range(n_users)
+                            if c_id != user_id and rng.random() < 0.7) for user_id in range(n_users)]
+    edge_scores = get_mutual_edges(from_scores_maps(scores_map_list))[2]
+    assert len(np.unique(edge_scores)) < len(edge_scores)/10
+    for min_matches, match_threshold in [(3, 5), (2, 2), (5, 3)]:
+        assert get_pairings(scores_map_list, min_matches, match_threshold) == get_baseline_pairings(
+            scores_map_list, min_matches, match_threshold)
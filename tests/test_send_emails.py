@@ -0,0 +1,53 @@
+import csv
+import threading
+from email import message_from_bytes
+import send_emails
+from send_emails import SmtpConfig, send_sheet
+from smtp_sink import SinkServer
+
+'''
+test_send_emails.py
+-------------------
+Concurrent delivery and checkpoint/resume of send_emails.py, against the
+local stand-in server of smtp_sink.py.
+'''
+
+def write_sheet(sheet_csv, n_rows):
+    '''
+    Writes an auto-email sheet of n_rows matches.
+    '''
+    with open(sheet_csv, mode='w', newline='', encoding='utf-8') as f:
+        csv_writer = csv.writer(f)
+        csv_writer.writerow(['recipients', 'names', 'message'])
+        for i in range(n_rows):
+            csv_writer.writerow(['a%d@example.com, b%d@example.com' % (i, i), 'A%d and B%d' % (i, i),
+                                 '<p>Meet B%d</p>\n.\n<p>bye</p>' % i])
+
+def test_interrupted_send_resumes_from_checkpoint(tmp_path, monkeypatch):
+    monkeypatch.setattr(send_emails, 'BACKOFF_SECONDS', 0.0)
+    server = SinkServer(('127.0.0.1', 0), n_failures=3)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        config = SmtpConfig(*server.server_address, sender='squad@example.com')
+        checkpoint_file = str(tmp_path / 'sent.txt')
+
+        # the first run only gets through part of the sheet
+        sheet_csv = str(tmp_path / 'sheet.csv')
+        write_sheet(sheet_csv, 12)
+        stats = send_sheet(sheet_csv, config, checkpoint_file, n_connections=4)
+        assert (stats['sent'], stats['skipped'], stats['failed'], stats['retries']) == (12, 0, 0, 3)
+        assert server.n_sessions > 1
+
+        write_sheet(sheet_csv, 20)
+        stats = send_sheet(sheet_csv, config, checkpoint_file, n_connections=4)
+        assert (stats['sent'], stats['skipped'], stats['failed']) == (8, 12, 0)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    messages = [message_from_bytes(data) for _, _, data in server.messages]
+    assert sorted(message['To'] for message in messages) == sorted(
+        'a%d@example.com, b%d@example.com' % (i, i) for i in range(20))
+    assert sorted(len(recipients) for _, recipients, _ in server.messages) == [2]*20
+    assert all('\n.\n' in message.get_payload(decode=True).decode().replace('\r\n', '\n') for message in messages)
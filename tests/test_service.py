@@ -0,0 +1,74 @@
+import csv
+import http.client
+import threading
+import squad
+from generate_responses import write_responses_csv
+from ingest import EMAIL_IDX
+from service import load_service, make_server
+
+'''
+test_service.py
+---------------
+Match query service (see service.py): snapshots and request validation.
+'''
+
+def load_test_service(tmp_path, n_users):
+    '''
+    Loads a service over the first n_users of 201 synthetic responses, and
+    returns it and the last response's row.
+    '''
+    responses_csv = str(tmp_path / 'responses.csv')
+    write_responses_csv(responses_csv, 201, seed=7)
+    with open(responses_csv, newline='') as f:
+        rows = list(csv.reader(f))
+    with open(responses_csv, mode='w', newline='') as f:
+        csv.writer(f).writerows(rows[:n_users + 1])
+    return load_service(responses_csv), rows[-1]
+
+def test_added_respondent_leaves_earlier_snapshot_unchanged(tmp_path, monkeypatch):
+    monkeypatch.setattr(squad, 'PAIR_HISTORY_DIR', None)
+    service, row = load_test_service(tmp_path, 200)
+    before = service.state
+    result = service.add_respondent(row)
+    assert result['user']['id'] == 200
+    assert len(before.names) == len(before.emails) == len(before.user_ids) == 200
+    assert len(service.state.names) == len(service.state.emails) == 201
+    assert service.get_user_id(service.state, row[EMAIL_IDX]) == 200
+
+def test_load_service_leaves_pair_history_setting_alone(tmp_path, monkeypatch):
+    monkeypatch.setattr(squad, 'PAIR_HISTORY_DIR', None)
+    load_test_service(tmp_path, 50)
+    load_service(str(tmp_path / 'responses.csv'), pair_history_dir=str(tmp_path / 'history'))
+    assert squad.PAIR_HISTORY_DIR is None
+
+def test_malformed_content_length_is_rejected(tmp_path):
+    service, _ = load_test_service(tmp_path, 50)
+    server = make_server(service, port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        connection = http.client.HTTPConnection(*server.server_address, timeout=10)
+        connection.putrequest('POST', '/respondents')
+        connection.putheader('Content-Length', 'abc')
+        connection.endheaders()
+        assert connection.getresponse().status == 400
+        connection.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def test_load_service_leaves_squad_responses_alone(tmp_path):
+    responses_csv = str(tmp_path / 'squad.csv')
+    write_responses_csv(responses_csv, 30, seed=3)
+    squad.load_responses(responses_csv, None, None)
+    store, side_table = squad.store, squad.side_table
+    service, _ = load_test_service(tmp_path, 50)
+    assert squad.store is store and squad.side_table is side_table
+    assert squad.N_users == 30 and squad.loaded_responses_csv == responses_csv
+    assert service.state.store is not store and service.state.store.n_users == 50
+
+    # and through a snapshot, saved then loaded
+    for _ in range(2):
+        service = load_service(str(tmp_path / 'responses.csv'), str(tmp_path / 'snapshots'))
+        assert service.state.store.n_users == 50
+    assert squad.store is store and squad.N_users == 30
@@ -0,0 +1,18 @@
+import numpy as np
+from sweep import sweep_matches
+
+'''
+test_sweep.py
+-------------
+Parameter sweep (see sweep.py) on int32 edges, as read from the edge cache.
+'''
+
+def test_mean_score_with_int32_edges_of_many_users():
+    # pair keys u*N + v of these edges overflow int32
+    n_users = 100000
+    edge_u = np.array([60000, 70000, 80000], dtype='<i4')
+    edge_v = np.array([60001, 70001, 80001], dtype='<i4')
+    edge_scores = np.array([3.0, 2.0, 1.0])
+    result, = sweep_matches(edge_u, edge_v, edge_scores, n_users, [(1, 1)])
+    assert result['matches'] == 3
+    assert result['mean_score'] == 2.0